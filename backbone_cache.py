@@ -0,0 +1,106 @@
+import contextlib
+import copy
+import hashlib
+import json
+import logging
+import time
+
+import torch
+
+from transformers import AutoConfig, AutoModel, AutoTokenizer, PretrainedConfig, T5EncoderModel
+
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+logger = logging.getLogger("flair")
+
+# Classes whose pretrained instances are cached: used by TransformerWordEmbeddings and ByT5Embeddings
+CACHED_CLASSES = [AutoConfig, AutoTokenizer, AutoModel, T5EncoderModel]
+
+
+def _cache_key(cls: type, args: tuple, kwargs: dict) -> str:
+    def serialize(value: Any) -> str:
+        # E.g. the config, that a model is loaded with
+        if isinstance(value, PretrainedConfig):
+            return value.to_json_string()
+        return repr(value)
+
+    return json.dumps([cls.__name__, args, kwargs], sort_keys=True, default=serialize)
+
+
+def _rng_state_digest() -> str:
+    return hashlib.sha1(torch.get_rng_state().numpy().tobytes()).hexdigest()
+
+
+class _CacheEntry(NamedTuple):
+    # Random state before and after loading the instance
+    rng_state_digest: str
+    instance: Any
+    rng_state: torch.Tensor
+
+
+class BackboneCache:
+    """Process-level cache of pretrained configs, tokenizers and transformer models.
+
+    Within `patch()`, `from_pretrained` of the cached classes only loads a checkpoint the first time. The loaded
+    (pristine) instance is kept on CPU and never handed out: every call returns a deep copy, so every run gets fresh
+    trainable weights, that are cloned in memory instead of being parsed from the checkpoint files again.
+
+    Loading can consume random numbers, e.g. for weights, that are not in the checkpoint and newly initialized. A
+    cached instance is therefore only reused for the random state it was loaded with, and the random state after
+    loading is restored: seeded runs are the same, no matter if their backbone is cached or not. Runs of a grid with
+    the same seed share the cached instance, the first run of every other seed loads the checkpoint again.
+    """
+
+    def __init__(self):
+        self.entries: Dict[str, _CacheEntry] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def _from_pretrained(self, cls: type, original_from_pretrained, *args, **kwargs):
+        key = _cache_key(cls, args, kwargs)
+        rng_state_digest = _rng_state_digest()
+
+        if key not in self.entries or self.entries[key].rng_state_digest != rng_state_digest:
+            start_time = time.perf_counter()
+
+            # Only the instance of the latest random state is kept, grids run all configurations of a seed in a row
+            instance = original_from_pretrained(*args, **kwargs)
+            self.entries[key] = _CacheEntry(rng_state_digest, instance, torch.get_rng_state())
+
+            self.misses += 1
+            logger.info(f"Backbone cache: loaded {cls.__name__} {args[0]} in {time.perf_counter() - start_time:.2f}s")
+        else:
+            # Random numbers are consumed as by loading the checkpoint
+            torch.set_rng_state(self.entries[key].rng_state)
+            self.hits += 1
+
+        return copy.deepcopy(self.entries[key].instance)
+
+    @contextlib.contextmanager
+    def patch(self):
+        originals: List[Tuple[type, Any]] = []
+
+        for cls in CACHED_CLASSES:
+            # from_pretrained might be inherited, then the class itself has no own attribute to restore
+            originals.append((cls, cls.__dict__.get("from_pretrained")))
+
+            def from_pretrained(*args, cls=cls, original_from_pretrained=cls.from_pretrained, **kwargs):
+                return self._from_pretrained(cls, original_from_pretrained, *args, **kwargs)
+
+            cls.from_pretrained = from_pretrained
+
+        try:
+            yield self
+        finally:
+            for cls, original in originals:
+                if original is None:
+                    del cls.from_pretrained
+                else:
+                    cls.from_pretrained = original
+
+
+# Backbones of the current process: all runs of a grid use the same pretrained model
+BACKBONE_CACHE = BackboneCache()
@@ -0,0 +1,168 @@
+import contextlib
+
+import torch
+
+import flair.models.sequence_tagger_model
+import flair.nn.model
+import flair.trainers.trainer
+
+from flair.data import Sentence
+from flair.datasets import DataLoader
+from torch.utils.data import Dataset, Sampler
+
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Units, in which the budget of a mini-batch is measured
+BATCHING_UNITS = ["tokens", "bytes"]
+
+
+def get_length_fn(unit: str) -> Callable[[Sentence], int]:
+    if unit == "tokens":
+        return len
+
+    if unit == "bytes":
+        # Input length of ByT5
+        return lambda sentence: len(sentence.to_original_text().encode("utf-8"))
+
+    raise ValueError(f"Unknown batching unit {unit}, expected one of {BATCHING_UNITS}")
+
+
+def make_budget_batches(indices: List[int], lengths: List[int], budget: int) -> List[List[int]]:
+    # Sentences are added as long as the padded batch (number of sentences * longest sentence) fits into the budget.
+    # A sentence, that exceeds the budget on its own, forms its own batch
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    max_length = 0
+
+    for index in indices:
+        length = lengths[index]
+
+        if batch and (len(batch) + 1) * max(max_length, length) > budget:
+            batches.append(batch)
+            batch, max_length = [], 0
+
+        batch.append(index)
+        max_length = max(max_length, length)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Forms mini-batches of sentences of similar length, whose padded size stays within a token (or byte) budget.
+
+    With shuffling, sentences are shuffled and split into pools of `pool_size` sentences. Every pool is sorted by
+    length and cut into batches, then the batches of all pools are shuffled. Without shuffling, all sentences are
+    sorted by length (longest first), as done by `predict`.
+
+    Shuffling uses PyTorch's global RNG, so batches are reproducible with a seed (and resumed checkpoints).
+    """
+
+    def __init__(self, lengths: List[int], budget: int, shuffle: bool = False, pool_size: int = 1000):
+        super().__init__()
+        self.lengths = lengths
+        self.budget = budget
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+
+        # Batches of the next epoch: formed by `__len__`, that the trainer calls before iterating
+        self._batches: Optional[List[List[int]]] = None
+
+    def _make_batches(self) -> List[List[int]]:
+        if not self.shuffle:
+            indices = sorted(range(len(self.lengths)), key=lambda index: self.lengths[index], reverse=True)
+            return make_budget_batches(indices, self.lengths, self.budget)
+
+        indices = torch.randperm(len(self.lengths)).tolist()
+
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[start: start + self.pool_size], key=lambda index: self.lengths[index])
+            batches.extend(make_budget_batches(pool, self.lengths, self.budget))
+
+        return [batches[index] for index in torch.randperm(len(batches)).tolist()]
+
+    def __len__(self) -> int:
+        if self._batches is None:
+            self._batches = self._make_batches()
+        return len(self._batches)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._batches if self._batches is not None else self._make_batches()
+        self._batches = None
+        return iter(batches)
+
+
+class TokenBudgetBatching:
+    """Replaces the fixed-size mini-batches of training and evaluation with token budget batches.
+
+    Within `patch()`, data loaders created by the trainer use `train_budget` and the ones created by `evaluate` and
+    `predict` use `eval_budget`. The mini-batch size passed to `fine_tune` should be `mini_batch_size()`, it is only
+    used for the learning rate schedule. Predictions are written to dev.tsv and test.tsv sorted by length.
+    """
+
+    def __init__(self, unit: str, train_budget: int, eval_budget: int, pool_size: int = 1000):
+        self.length_fn = get_length_fn(unit)
+        self.unit = unit
+        self.train_budget = train_budget
+        self.eval_budget = eval_budget
+        self.pool_size = pool_size
+
+        # Lengths of the sentences of the corpus splits, they are needed again in every epoch
+        self._lengths: Dict[int, Tuple[Dataset, List[int]]] = {}
+
+    def _get_lengths(self, dataset: Dataset, cache: bool = False) -> List[int]:
+        # The dataset is kept as well, so that its id cannot be reused by another dataset
+        if id(dataset) in self._lengths and self._lengths[id(dataset)][0] is dataset:
+            return self._lengths[id(dataset)][1]
+
+        lengths = [self.length_fn(dataset[index]) for index in range(len(dataset))]
+
+        if cache:
+            self._lengths[id(dataset)] = (dataset, lengths)
+
+        return lengths
+
+    def batch_sampler(
+        self, dataset: Dataset, budget: int, shuffle: bool = False, cache_lengths: bool = False
+    ) -> TokenBudgetBatchSampler:
+        return TokenBudgetBatchSampler(self._get_lengths(dataset, cache_lengths), budget, shuffle, self.pool_size)
+
+    def mini_batch_size(self, dataset: Dataset) -> int:
+        # fine_tune computes the learning rate schedule from the number of sentences per mini-batch. The number of
+        # batches of an epoch is estimated without consuming random numbers of training
+        with torch.random.fork_rng(devices=[]):
+            number_of_batches = len(self.batch_sampler(dataset, self.train_budget, shuffle=True, cache_lengths=True))
+
+        return max(len(dataset) // number_of_batches, 1)
+
+    def train_batches(self, sentences: List[Sentence]) -> List[List[Sentence]]:
+        batch_sampler = self.batch_sampler(sentences, self.train_budget, shuffle=True)
+        return [[sentences[index] for index in batch] for batch in batch_sampler]
+
+    def _data_loader_factory(self, budget: int, cache_lengths: bool):
+        def data_loader(dataset, batch_size=1, shuffle=False, sampler=None, **kwargs) -> DataLoader:
+            if sampler is not None:
+                raise ValueError("Token budget batching cannot be combined with a sampler")
+
+            return DataLoader(dataset, batch_sampler=self.batch_sampler(dataset, budget, shuffle, cache_lengths))
+
+        return data_loader
+
+    @contextlib.contextmanager
+    def patch(self):
+        modules = [flair.trainers.trainer, flair.nn.model, flair.models.sequence_tagger_model]
+        originals = [module.DataLoader for module in modules]
+
+        # Training and evaluation iterate over corpus splits, `predict` only over a batch of the evaluation
+        flair.trainers.trainer.DataLoader = self._data_loader_factory(self.train_budget, cache_lengths=True)
+        flair.nn.model.DataLoader = self._data_loader_factory(self.eval_budget, cache_lengths=True)
+        flair.models.sequence_tagger_model.DataLoader = self._data_loader_factory(self.eval_budget, cache_lengths=False)
+
+        try:
+            yield self
+        finally:
+            for module, original in zip(modules, originals):
+                module.DataLoader = original
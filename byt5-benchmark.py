@@ -0,0 +1,418 @@
+# Benchmarks for ByT5Embeddings
+#
+# Usage:
+# $ python3 byt5-benchmark.py inference [--tagger best-model.pt --dataset newseye/fi]
+# $ python3 byt5-benchmark.py checkpointing [--model hmbyt5/byt5-small-historic-multilingual-span20-flax]
+# $ python3 byt5-benchmark.py packing [--dataset ajmc/de --window-size 512]
+# $ python3 byt5-benchmark.py startup [--model hmbyt5/byt5-small-historic-multilingual-span20-flax --runs 5]
+#
+# Without --model or --tagger, a tiny randomly initialized ByT5 model is used, so benchmarks also run offline.
+import argparse
+import contextlib
+import importlib
+import multiprocessing
+import random
+import resource
+import tempfile
+import time
+import flair
+import torch
+
+from flair.data import Dictionary, Sentence
+from flair.models import SequenceTagger
+from tabulate import tabulate
+from transformers import T5Config
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from backbone_cache import BACKBONE_CACHE
+from byt5_embeddings import ByT5Embeddings
+
+# Some historic-looking words, including hyphenation and long s, for synthetic sentences
+SYNTHETIC_ENTITY_TYPES = ["PER", "LOC", "ORG"]
+
+SYNTHETIC_WORDS = [
+    "Der", "die", "das", "und", "Stadt", "Regierung", "Zeitung", "ſeine", "Majeſtät", "König", "Berlin", "Paris",
+    "Helsingfors", "Stockholm", "Versammlung", "Kriegsministerium", "geſtern", "Uhr", ",", ".", "-", "¬", "1848",
+    "Mr.", "Herrn", "Weltausſtellung", "Départements", "l'Assemblée", "öffentlichen", "Hülfe",
+]
+
+
+def tiny_byt5_embeddings(**kwargs) -> ByT5Embeddings:
+    config = T5Config(
+        vocab_size=384,
+        d_model=64,
+        d_kv=16,
+        d_ff=128,
+        num_layers=4,
+        num_heads=4,
+        is_encoder_decoder=False,
+        output_hidden_states=True,
+    )
+    return ByT5Embeddings(model="google/byt5-small", saved_config=config, **kwargs)
+
+
+def synthetic_sentences(number_of_sentences: int, seed: int = 42) -> List[Sentence]:
+    generator = random.Random(seed)
+
+    sentences = []
+    for _ in range(number_of_sentences):
+        # Skewed length distribution: many short headlines, some long OCR paragraphs
+        sentence_length = min(int(generator.expovariate(1 / 20)) + 1, 200)
+        sentence = Sentence([generator.choice(SYNTHETIC_WORDS) for _ in range(sentence_length)])
+
+        for index in range(len(sentence)):
+            if generator.random() < 0.1:
+                sentence[index : index + 1].add_label("ner", generator.choice(SYNTHETIC_ENTITY_TYPES))
+
+        sentences.append(sentence)
+
+    return sentences
+
+
+def load_sentences(dataset: Optional[str], number_of_sentences: int) -> List[Sentence]:
+    if dataset is None:
+        return synthetic_sentences(number_of_sentences)
+
+    fine_tuner = importlib.import_module("flair-fine-tuner")
+    corpus = fine_tuner.load_corpus(dataset)
+
+    return list(corpus.test)[:number_of_sentences]
+
+
+def load_tagger(args, fine_tune: bool = False, **embedding_options) -> SequenceTagger:
+    if args.tagger:
+        return SequenceTagger.load(args.tagger)
+
+    # Same seed for every call, so that all modes use identical random weights
+    torch.manual_seed(args.seed)
+
+    if args.model:
+        embeddings = ByT5Embeddings(model=args.model, fine_tune=fine_tune, **embedding_options)
+    else:
+        embeddings = tiny_byt5_embeddings(fine_tune=fine_tune, **embedding_options)
+
+    # Randomly initialized tagger: drift is measured as agreement with fp32 predictions
+    tag_dictionary = Dictionary(add_unk=False)
+    for entity_type in SYNTHETIC_ENTITY_TYPES:
+        tag_dictionary.add_item(entity_type)
+    tag_dictionary.span_labels = True
+
+    return SequenceTagger(
+        hidden_size=256,
+        embeddings=embeddings,
+        tag_dictionary=tag_dictionary,
+        tag_type="ner",
+        use_crf=False,
+        use_rnn=False,
+        reproject_embeddings=False,
+    )
+
+
+def get_spans(sentences: List[Sentence], label_type: str) -> Set[Tuple[int, str, str]]:
+    return {
+        (sentence_index, span.unlabeled_identifier, span.get_label(label_type).value)
+        for sentence_index, sentence in enumerate(sentences)
+        for span in sentence.get_spans(label_type)
+    }
+
+
+def predict_spans(tagger: SequenceTagger, sentences: List[Sentence], batch_size: int) -> Set[Tuple[int, str, str]]:
+    tagger.predict(sentences, mini_batch_size=batch_size, label_name="benchmark")
+    return get_spans(sentences, "benchmark")
+
+
+def span_f1(gold_spans: Set[Tuple[int, str, str]], predicted_spans: Set[Tuple[int, str, str]]) -> float:
+    if not gold_spans and not predicted_spans:
+        return 1.0
+
+    true_positives = len(gold_spans & predicted_spans)
+    return 2 * true_positives / (len(gold_spans) + len(predicted_spans))
+
+
+def benchmark_inference(args):
+    torch.set_num_threads(args.threads)
+
+    sentences = load_sentences(args.dataset, args.sentences)
+    number_of_bytes = sum(len(sentence.to_tokenized_string().encode("utf-8")) for sentence in sentences)
+
+    gold_spans: Optional[Set[Tuple[int, str, str]]] = None
+    if args.dataset:
+        gold_spans = get_spans(sentences, "ner")
+
+    modes: Dict[str, dict] = {
+        "fp32": {},
+        "inference_mode": {"bf16": False, "int8": False},
+        "bf16": {"bf16": True},
+        "int8": {"int8": True},
+    }
+
+    reference_spans: Optional[Set[Tuple[int, str, str]]] = None
+    table = []
+
+    for mode, inference_options in modes.items():
+        if mode not in args.modes:
+            continue
+
+        tagger = load_tagger(args)
+        tagger.eval()
+
+        if mode != "fp32":
+            tagger.embeddings.enable_inference_mode(**inference_options)
+
+        # Warm-up
+        predict_spans(tagger, sentences[: args.batch_size], args.batch_size)
+
+        start_time = time.perf_counter()
+        predicted_spans = predict_spans(tagger, sentences, args.batch_size)
+        elapsed = time.perf_counter() - start_time
+
+        if reference_spans is None:
+            reference_spans = predicted_spans
+
+        number_of_batches = (len(sentences) + args.batch_size - 1) // args.batch_size
+
+        row = [
+            mode,
+            round(elapsed / number_of_batches * 1000, 2),
+            round(len(sentences) / elapsed, 1),
+            round(number_of_bytes / elapsed, 1),
+            round(span_f1(reference_spans, predicted_spans) * 100, 2),
+        ]
+
+        if gold_spans is not None:
+            row.append(round(span_f1(gold_spans, predicted_spans) * 100, 2))
+
+        table.append(row)
+
+    header = ["Mode", "Latency (ms/batch)", "Sentences/s", "Bytes/s", "Agreement with first mode (F1)"]
+    if gold_spans is not None:
+        header.append("Test F1")
+
+    print(tabulate(table, headers=header, tablefmt="github"))
+
+
+def measure_training(args, embedding_options: dict) -> Dict[str, Optional[float]]:
+    # Runs in a fresh process, so that the peak memory of one mode does not hide the one of another
+    torch.set_num_threads(args.threads)
+    flair.device = torch.device(args.device)
+
+    tagger = load_tagger(args, fine_tune=True, **embedding_options)
+    tagger.train()
+
+    optimizer = torch.optim.AdamW(tagger.parameters(), lr=5e-5)
+
+    sentences = synthetic_sentences(args.batch_size * (args.steps + 1), seed=args.seed)
+    batches = [sentences[index : index + args.batch_size] for index in range(0, len(sentences), args.batch_size)]
+
+    step_times = []
+    for batch in batches:
+        start_time = time.perf_counter()
+
+        loss, number_of_labels = tagger.forward_loss(batch)
+        (loss / number_of_labels).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+        for sentence in batch:
+            sentence.clear_embeddings()
+
+        step_times.append(time.perf_counter() - start_time)
+
+    peak_accelerator_memory = None
+    if flair.device.type == "cuda":
+        peak_accelerator_memory = torch.cuda.max_memory_allocated(flair.device) / 2**20
+
+    return {
+        # First step is a warm-up step
+        "step_time": sum(step_times[1:]) / len(step_times[1:]),
+        # ru_maxrss is given in kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_accelerator_memory": peak_accelerator_memory,
+    }
+
+
+def benchmark_checkpointing(args):
+    table = []
+
+    for gradient_checkpointing in [False, True]:
+        embedding_options = {
+            "gradient_checkpointing": gradient_checkpointing,
+            "allow_long_sentences": args.window_size is not None,
+            "window_size": args.window_size or 1024,
+        }
+
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            result = pool.apply(measure_training, (args, embedding_options))
+
+        table.append(
+            [
+                gradient_checkpointing,
+                round(result["step_time"] * 1000, 2),
+                round(result["peak_rss"], 1),
+                round(result["peak_accelerator_memory"], 1) if result["peak_accelerator_memory"] else "-",
+            ]
+        )
+
+    header = ["Gradient checkpointing", "Step time (ms)", "Peak RSS (MB)", "Peak accelerator memory (MB)"]
+    print(tabulate(table, headers=header, tablefmt="github"))
+
+
+def benchmark_packing(args):
+    torch.set_num_threads(args.threads)
+
+    sentences = load_sentences(args.dataset, args.sentences)
+    batches = [sentences[index : index + args.batch_size] for index in range(0, len(sentences), args.batch_size)]
+    number_of_tokens = sum(len(sentence) for sentence in sentences)
+
+    reference_embeddings: Optional[List[torch.Tensor]] = None
+    table = []
+
+    for pack_sequences in [False, True]:
+        tagger = load_tagger(args, window_size=args.window_size)
+        tagger.eval()
+
+        embeddings = tagger.embeddings
+        embeddings.pack_sequences = pack_sequences
+
+        # Count real and padded byte positions of every encoder call
+        positions = {"real": 0, "total": 0}
+
+        def count_positions(module, inputs, kwargs):
+            positions["real"] += int(kwargs["attention_mask"].sum())
+            positions["total"] += kwargs["attention_mask"].numel()
+
+        hook = embeddings.model.register_forward_pre_hook(count_positions, with_kwargs=True)
+
+        # Warm-up
+        embeddings.embed(batches[0])
+        for sentence in batches[0]:
+            sentence.clear_embeddings()
+        positions["real"], positions["total"] = 0, 0
+
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            for batch in batches:
+                embeddings.embed(batch)
+        elapsed = time.perf_counter() - start_time
+
+        hook.remove()
+
+        token_embeddings = [token.get_embedding().cpu() for sentence in sentences for token in sentence]
+        for sentence in sentences:
+            sentence.clear_embeddings()
+
+        if reference_embeddings is None:
+            reference_embeddings = token_embeddings
+
+        max_difference = max(
+            (embedding - reference_embedding).abs().max().item()
+            for embedding, reference_embedding in zip(token_embeddings, reference_embeddings)
+        )
+
+        table.append(
+            [
+                pack_sequences,
+                round(elapsed * 1000, 2),
+                round(number_of_tokens / elapsed, 1),
+                round(positions["real"] / elapsed, 1),
+                round((1 - positions["real"] / positions["total"]) * 100, 2),
+                f"{max_difference:.2e}",
+            ]
+        )
+
+    header = ["Packing", "Time (ms)", "Tokens/s", "Effective bytes/s", "Padding (%)", "Max. difference to unpacked"]
+    print(tabulate(table, headers=header, tablefmt="github"))
+
+
+def measure_startup(args, use_backbone_cache: bool) -> List[Tuple[float, float]]:
+    # Runs in a fresh process, so that the first run has to load the backbone in both modes
+    torch.set_num_threads(args.threads)
+    flair.device = torch.device(args.device)
+
+    batch = synthetic_sentences(args.batch_size, seed=args.seed)
+
+    startup_times = []
+    for _ in range(args.runs):
+        # Every run is seeded, as in run_experiment: the cached backbone is only reused for the same random state
+        flair.set_seed(args.seed)
+        start_time = time.perf_counter()
+
+        with BACKBONE_CACHE.patch() if use_backbone_cache else contextlib.nullcontext():
+            tagger = load_tagger(args, fine_tune=True)
+
+        load_time = time.perf_counter() - start_time
+
+        # Time to first batch: create tagger and optimizer, then do the first training step
+        optimizer = torch.optim.AdamW(tagger.parameters(), lr=5e-5)
+
+        loss, number_of_labels = tagger.forward_loss(batch)
+        (loss / number_of_labels).backward()
+        optimizer.step()
+
+        startup_times.append((load_time, time.perf_counter() - start_time))
+
+        for sentence in batch:
+            sentence.clear_embeddings()
+
+    return startup_times
+
+
+def benchmark_startup(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.model is None:
+            # The tiny model is saved, so it is loaded like a pretrained model
+            tiny_byt5_embeddings().model.save_pretrained(temp_dir)
+            args.model = temp_dir
+
+        table = []
+
+        for use_backbone_cache in [False, True]:
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                startup_times = pool.apply(measure_startup, (args, use_backbone_cache))
+
+            for run, (load_time, time_to_first_batch) in enumerate(startup_times, start=1):
+                table.append([use_backbone_cache, run, round(load_time, 3), round(time_to_first_batch, 3)])
+
+    header = ["Backbone cache", "Run", "Model loading (s)", "Time to first batch (s)"]
+    print(tabulate(table, headers=header, tablefmt="github"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for ByT5Embeddings")
+    parser.add_argument("--model", type=str, default=None, help="ByT5 model, otherwise a tiny random model is used")
+    parser.add_argument("--tagger", type=str, default=None, help="Trained SequenceTagger with ByT5Embeddings")
+    parser.add_argument("--dataset", type=str, default=None, help="Evaluate on test split, e.g. newseye/fi")
+    parser.add_argument("--sentences", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=42)
+
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    inference_parser = subparsers.add_parser("inference", help="Latency, throughput and F1 drift of inference modes")
+    inference_parser.add_argument("--modes", nargs="+", default=["fp32", "inference_mode", "bf16", "int8"])
+
+    checkpointing_parser = subparsers.add_parser("checkpointing", help="Step time and peak memory of fine-tuning")
+    checkpointing_parser.add_argument("--steps", type=int, default=10)
+    checkpointing_parser.add_argument("--window-size", type=int, default=None)
+
+    packing_parser = subparsers.add_parser("packing", help="Effective throughput with and without sequence packing")
+    packing_parser.add_argument("--window-size", type=int, default=1024)
+
+    startup_parser = subparsers.add_parser("startup", help="Time to first batch of consecutive runs of a grid")
+    startup_parser.add_argument("--runs", type=int, default=5)
+
+    args = parser.parse_args()
+
+    flair.device = torch.device(args.device)
+
+    if args.benchmark == "inference":
+        benchmark_inference(args)
+    elif args.benchmark == "checkpointing":
+        benchmark_checkpointing(args)
+    elif args.benchmark == "packing":
+        benchmark_packing(args)
+    elif args.benchmark == "startup":
+        benchmark_startup(args)
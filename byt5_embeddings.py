@@ -1,19 +1,46 @@
+import contextlib
+import itertools
 import os
+import random
 import flair
 import torch
 
-from flair.data import Sentence
+from flair.data import Sentence, Token
 from flair.embeddings import TokenEmbeddings
 from flair.embeddings.base import register_embeddings
 from flair.embeddings.transformer import TransformerBaseEmbeddings
 from transformers import T5EncoderModel, ByT5Tokenizer, AutoConfig, PretrainedConfig
 
 from io import BytesIO
+from pathlib import Path
+
+from typing import Dict, List, Tuple, Union, Optional
+
+from embedding_cache import HiddenStateCacheMixin
+
+class _StopEncoder(Exception):
+    """Raised to stop the encoder once all requested hidden states are computed."""
+
+
+class _BlockAttentionBias(torch.nn.Module):
+    """Temporarily wraps the first encoder block to replace the padding mask by an additive attention bias.
+
+    T5 adds the mask to the relative position bias in the first block and shares the sum with all following blocks,
+    so the bias applies to the whole encoder. The wrapped block is called with the bias as argument, so it is also
+    used when the block is recomputed for gradient checkpointing.
+    """
+
+    def __init__(self, block: torch.nn.Module, attention_bias: torch.Tensor):
+        super().__init__()
+        self.block = block
+        self.attention_bias = attention_bias
+
+    def forward(self, hidden_states, attention_mask=None, *args, **kwargs):
+        return self.block(hidden_states, self.attention_bias, *args, **kwargs)
 
-from typing import Dict, List, Union, Optional
 
 @register_embeddings
-class ByT5Embeddings(TransformerBaseEmbeddings):
+class ByT5Embeddings(HiddenStateCacheMixin, TransformerBaseEmbeddings):
     def __init__(
         self,
         model: str = "google/byt5-base",
@@ -25,6 +52,9 @@ class ByT5Embeddings(TransformerBaseEmbeddings):
         is_token_embedding: bool = True,
         is_document_embedding: bool = False,
         allow_long_sentences: bool = False,
+        window_size: int = 1024,
+        stride: Optional[int] = None,
+        pack_sequences: bool = False,
         use_context: Union[bool, int] = False,
         respect_document_boundaries: bool = False,
         context_dropout: float = 0.0,
@@ -35,6 +65,8 @@ class ByT5Embeddings(TransformerBaseEmbeddings):
         force_max_length: bool = False,
         needs_manual_ocr: Optional[bool] = None,
         use_context_separator: bool = True,
+        cache_dir: Optional[Union[str, Path]] = None,
+        gradient_checkpointing: bool = False,
         **kwargs,
     ):
         self.instance_parameters = self.get_instance_parameters(locals=locals())
@@ -71,13 +103,29 @@ class ByT5Embeddings(TransformerBaseEmbeddings):
 
         transformer_model = transformer_model.to(flair.device)
 
+        # Trade recomputation of encoder blocks in the backward pass for activation memory
+        self.gradient_checkpointing = gradient_checkpointing
+        if gradient_checkpointing:
+            transformer_model.gradient_checkpointing_enable()
+
         self.truncate = True
         self.force_max_length = force_max_length
 
-        allow_long_sentences = False
         self.truncate = False
 
-        self.stride = self.tokenizer.model_max_length // 2 if allow_long_sentences else 0
+        # Long byte sequences are split into overlapping windows of `window_size` bytes,
+        # where `stride` is the number of bytes that consecutive windows overlap
+        if stride is None:
+            stride = window_size // 2 if allow_long_sentences else 0
+
+        if allow_long_sentences and not 0 <= stride < window_size:
+            raise ValueError(f"Stride `{stride}` must be smaller than the window size `{window_size}`")
+
+        self.window_size = window_size
+        self.stride = stride
+
+        # Short sequences are packed into rows of up to `window_size` bytes, that only attend within their own block
+        self.pack_sequences = pack_sequences
         self.allow_long_sentences = allow_long_sentences
         self.use_lang_emb = hasattr(transformer_model, "use_lang_emb") and transformer_model.use_lang_emb
 
@@ -94,26 +142,40 @@ class ByT5Embeddings(TransformerBaseEmbeddings):
         if self.token_embedding and subtoken_pooling not in ["first", "last", "first_last", "mean"]:
             raise ValueError(f"Subtoken Pooling operation `{subtoken_pooling}` is not defined for TransformerEmbedding")
 
-        self.context_length = 0
+        # Contiguous sentences of a document are packed into one sequence, surrounded by
+        # `context_length` tokens of left and right context (FLERT)
+        if isinstance(use_context, bool):
+            self.context_length: int = 64 if use_context else 0
+        else:
+            self.context_length = use_context
 
         self.context_dropout = context_dropout
         self.respect_document_boundaries = respect_document_boundaries
 
         # embedding parameters
+        # hidden states are the embedding output, followed by the output of every encoder block
+        number_of_hidden_states = transformer_model.config.num_layers + 1
+
         if layers == "all":
-            # send mini-token through to check how many layers the model has
-            input_ids = torch.tensor([1], device=flair.device).unsqueeze(0)
-            hidden_states = self.model(input_ids).hidden_states
-            self.layer_indexes = [int(x) for x in range(len(hidden_states))]
+            self.layer_indexes = [int(x) for x in range(number_of_hidden_states)]
         else:
             self.layer_indexes = [int(x) for x in layers.split(",")]
 
+        for layer_index in self.layer_indexes:
+            if not -number_of_hidden_states <= layer_index < number_of_hidden_states:
+                raise ValueError(f"Layer `{layer_index}` is not defined for a model with {number_of_hidden_states - 1} layers")
+
         self.cls_pooling = cls_pooling
         self.subtoken_pooling = subtoken_pooling
         self.layer_mean = layer_mean
         self.fine_tune = fine_tune
         self.static_embeddings = not self.fine_tune
 
+        # Inference-optimized execution for prediction, see enable_inference_mode()
+        self.use_inference_mode = False
+        self.inference_bf16 = False
+        self.inference_int8 = False
+
         # return length
         self.embedding_length_internal = self._calculate_embedding_length(transformer_model)
         self.needs_manual_ocr = False
@@ -132,6 +194,9 @@ class ByT5Embeddings(TransformerBaseEmbeddings):
         # when initializing, embeddings are in eval mode by default
         self.eval()
 
+        # Frozen embeddings can be read from an on-disk cache instead of running the encoder again
+        self._init_hidden_state_cache(cache_dir)
+
     @property
     def embedding_length(self) -> int:
         if not hasattr(self, "embedding_length_internal"):
@@ -236,6 +301,9 @@ class ByT5Embeddings(TransformerBaseEmbeddings):
             "layer_mean": self.layer_mean,
             "subtoken_pooling": self.subtoken_pooling,
             "cls_pooling": self.cls_pooling,
+            "window_size": self.window_size,
+            "pack_sequences": self.pack_sequences,
+            "gradient_checkpointing": self.gradient_checkpointing,
             "config_state_dict": config_dict,
         }
 
@@ -250,56 +318,368 @@ class ByT5Embeddings(TransformerBaseEmbeddings):
             and self.initial_cls_token
         )
 
-    def _add_embeddings_internal(self, sentences: List[Sentence]) -> List[Sentence]:
+    @staticmethod
+    def _token_byte_offsets(tokens: List[Token]) -> Tuple[List[int], List[int]]:
+        # ByT5 operates on UTF-8 bytes, so the length of a token equals its byte count
+        # and tokens are separated by exactly one whitespace byte in the tokenized string
+        token_lengths = [len(token.text.encode("utf-8")) for token in tokens]
+        token_offsets = [0, *itertools.accumulate(token_length + 1 for token_length in token_lengths[:-1])]
+        return token_offsets, token_lengths
+
+    def _continues_document(self, sentence: Sentence, next_sentence: Sentence) -> bool:
+        return not self.respect_document_boundaries or not (
+            sentence.is_document_boundary or next_sentence.is_document_boundary
+        )
+
+    def _build_sequences(self, sentences: List[Sentence]) -> List[Tuple[List[Token], int, int]]:
+        # Returns the tokens of every sequence to encode, together with the range of tokens that are embedded
+        if self.context_length == 0:
+            return [(sentence.tokens, 0, len(sentence)) for sentence in sentences]
+
+        if self.hidden_state_cache is not None:
+            # Cached sentences are keyed by their own context, so they must not be packed with their neighbours
+            return [self._build_context_sequence([sentence]) for sentence in sentences]
+
+        batch_sentences = {id(sentence): sentence for sentence in sentences}
+
+        # Group sentences of the mini-batch that directly follow each other in a document into runs
+        runs: List[List[Sentence]] = []
+
         for sentence in sentences:
-            encoding = self.tokenizer([sentence.to_tokenized_string()], padding="longest", return_tensors="pt")
+            previous_sentence = sentence.previous_sentence()
+
+            if (
+                previous_sentence is not None
+                and id(previous_sentence) in batch_sentences
+                and self._continues_document(previous_sentence, sentence)
+            ):
+                # Sentence will be packed into the run of its predecessor
+                continue
+
+            run = [sentence]
+            run_length = len(sentence.to_tokenized_string().encode("utf-8")) + 1
+
+            while True:
+                next_sentence = run[-1].next_sentence()
+
+                if (
+                    next_sentence is None
+                    or id(next_sentence) not in batch_sentences
+                    or not self._continues_document(run[-1], next_sentence)
+                ):
+                    break
+
+                # Start a new run once the packed sequence would exceed the window size
+                next_sentence_length = len(next_sentence.to_tokenized_string().encode("utf-8")) + 1
+
+                if run_length + next_sentence_length > self.window_size:
+                    runs.append(run)
+                    run, run_length = [], 0
+
+                run.append(next_sentence)
+                run_length += next_sentence_length
+
+            runs.append(run)
+
+        packed_sentences = {id(run_sentence) for run in runs for run_sentence in run}
+
+        # Sentences with a predecessor in the mini-batch that could not be reached from it
+        runs.extend([sentence] for sentence in sentences if id(sentence) not in packed_sentences)
+
+        return [self._build_context_sequence(run) for run in runs]
 
-            # Pass to model
-            encoding["input_ids"] = encoding["input_ids"].to(flair.device)
-            encoding["attention_mask"] = encoding["attention_mask"].to(flair.device)
-            
-            if self.fine_tune:
-                hidden_states = self.model(**encoding).hidden_states
-            else:
-                with torch.no_grad():
-                    hidden_states = self.model(**encoding).hidden_states
+    def _build_context_sequence(self, run: List[Sentence]) -> Tuple[List[Token], int, int]:
+        left_context: List[Token] = []
+        right_context: List[Token] = []
 
-            offset = 0
+        # if context_dropout is set, randomly deactivate left and right context during training
+        if not self.training or random.random() >= self.context_dropout:
+            left_context = run[0].left_context(self.context_length, self.respect_document_boundaries)
 
-            for token in sentence.tokens:
-                token_length = len(self.tokenizer([token.text], padding="longest", return_tensors="pt")["input_ids"][0]) - 1
+        if not self.training or random.random() >= self.context_dropout:
+            right_context = run[-1].right_context(self.context_length, self.respect_document_boundaries)
 
-                token_embeddings: List[torch.FloatTensor] = []
+        run_tokens = [token for run_sentence in run for token in run_sentence.tokens]
+        return left_context + run_tokens + right_context, len(left_context), len(left_context) + len(run_tokens)
 
-                for layer_index in self.layer_indexes:
-                    current_character_embeddings = hidden_states[layer_index][0][offset: offset + token_length]
+    def _sliding_windows(self, sequence_length: int) -> List[Tuple[int, int, int, int]]:
+        # Returns (start, end, keep_start, keep_end) of all windows for a sequence. Overlapping positions
+        # are taken from the window in which they are more central, so kept ranges tile the whole sequence
+        if not self.allow_long_sentences or sequence_length <= self.window_size:
+            return [(0, sequence_length, 0, sequence_length)]
 
-                    if self.subtoken_pooling == "first":
-                        final_character_embedding = current_character_embeddings[0]
+        step = self.window_size - self.stride
+        starts = [*range(0, sequence_length - self.window_size, step), sequence_length - self.window_size]
+        ends = [start + self.window_size for start in starts]
 
-                    if self.subtoken_pooling == "last":
-                        final_character_embedding = current_character_embeddings[-1]
+        boundaries = [(start + previous_end) // 2 for start, previous_end in zip(starts[1:], ends[:-1])]
+        keep_starts = [0, *boundaries]
+        keep_ends = [*boundaries, sequence_length]
 
-                    if self.subtoken_pooling == "first_last":
-                        final_character_embedding = torch.cat([current_character_embeddings[0],
-                                                               current_character_embeddings[-1]])
+        return list(zip(starts, ends, keep_starts, keep_ends))
 
-                    if self.subtoken_pooling == "mean":
-                        all_embeddings: List[torch.FloatTensor] = [
-                            embedding.unsqueeze(0) for embedding in current_character_embeddings
-                        ]
-                        final_character_embedding = torch.mean(torch.cat(all_embeddings, dim=0), dim=0)
+    def _pack_windows(self, window_lengths: List[int]) -> Tuple[List[Tuple[int, int]], int]:
+        # Returns the (row, offset) of every window and the row length. Windows are packed first-fit decreasing
+        # into rows of `window_size` bytes (or of the longest window, if sentences are not split into windows)
+        row_length = max(self.window_size, *window_lengths)
+        row_fill: List[int] = []
+        window_positions: List[Tuple[int, int]] = [(0, 0)] * len(window_lengths)
 
-                    token_embeddings.append(final_character_embedding)
+        for window_index in sorted(range(len(window_lengths)), key=lambda index: -window_lengths[index]):
+            window_length = window_lengths[window_index]
+            row = next((row for row, fill in enumerate(row_fill) if fill + window_length <= row_length), len(row_fill))
 
-                if self.layer_mean:
-                    mean_token_embeddings = torch.mean(torch.stack(token_embeddings, dim=1), dim=1)
-                    token_embeddings = [mean_token_embeddings]
+            if row == len(row_fill):
+                row_fill.append(0)
 
-                token.set_embedding(self.name, torch.cat(token_embeddings))
+            window_positions[window_index] = (row, row_fill[row])
+            row_fill[row] += window_length
+
+        # Rows are padded to the longest packed row only
+        return window_positions, max(row_fill)
+
+    def _add_embeddings_internal(self, sentences: List[Sentence]) -> List[Sentence]:
+        self._embed_with_cache(sentences, self._embed_sentences)
+        return sentences
+
+    def enable_inference_mode(self, bf16: bool = False, int8: bool = False) -> "ByT5Embeddings":
+        """Optimizes the embeddings for prediction.
+
+        In eval mode, the encoder then runs under ``torch.inference_mode``, optionally with bf16 autocast. With int8,
+        all linear layers of the encoder are dynamically quantized, which is irreversible and only supported on CPU,
+        so this should only be used for models that are no longer trained.
+        """
+        if bf16 and int8:
+            raise ValueError("bf16 autocast cannot be combined with dynamic int8 quantization")
+
+        if int8 and torch.device(flair.device).type != "cpu":
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+
+        if int8 and not self.inference_int8:
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        self.use_inference_mode = True
+        self.inference_bf16 = bf16
+        self.inference_int8 = self.inference_int8 or int8
+        self.eval()
+
+        return self
+
+    def _forward_context(self) -> contextlib.AbstractContextManager:
+        if self.use_inference_mode and not self.training:
+            forward_context = contextlib.ExitStack()
+            forward_context.enter_context(torch.inference_mode())
+
+            if self.inference_bf16:
+                forward_context.enter_context(
+                    torch.autocast(device_type=torch.device(flair.device).type, dtype=torch.bfloat16)
+                )
+
+            return forward_context
+
+        return contextlib.nullcontext() if self.fine_tune else torch.no_grad()
+
+    def _run_encoder(
+        self, encoding: Dict[str, torch.Tensor], attention_bias: Optional[torch.Tensor] = None
+    ) -> Dict[int, torch.Tensor]:
+        # Runs the encoder only up to the deepest requested layer and keeps only the requested hidden states.
+        # Hidden state i (i < number of layers) is the input of encoder block i, so it is captured when block i is
+        # called, and the encoder is stopped right there if no deeper layer is needed. The last hidden state is the
+        # (final layer normed) encoder output. An additive attention bias of shape [batch, 1, length, length]
+        # replaces the padding mask of the attention mask.
+        number_of_layers = self.model.config.num_layers
+        requested_layers = sorted({layer_index % (number_of_layers + 1) for layer_index in self.layer_indexes})
+        deepest_layer = requested_layers[-1]
+
+        hidden_states: Dict[int, torch.Tensor] = {}
+        capturing = True
+
+        def capture_forward(block_index: int, block_forward):
+            def forward(*args, **kwargs):
+                if capturing:
+                    hidden_states[block_index] = args[0] if args else kwargs["hidden_states"]
+
+                    if block_index == deepest_layer:
+                        raise _StopEncoder()
+
+                return block_forward(*args, **kwargs)
+
+            return forward
+
+        blocks = {
+            block_index: self.model.encoder.block[block_index]
+            for block_index in requested_layers
+            if block_index < number_of_layers
+        }
+
+        # Patch the forward of the blocks on instance level, as it is also called directly for gradient checkpointing
+        patched_forwards = {block_index: block.__dict__.get("forward") for block_index, block in blocks.items()}
+        for block_index, block in blocks.items():
+            block.forward = capture_forward(block_index, block.forward)
+
+        first_block = self.model.encoder.block[0]
+        if attention_bias is not None:
+            self.model.encoder.block[0] = _BlockAttentionBias(first_block, attention_bias)
+
+        try:
+            output = self.model(**encoding, output_hidden_states=False)
+            hidden_states[number_of_layers] = output.last_hidden_state
+        except _StopEncoder:
+            pass
+        finally:
+            capturing = False
+            self.model.encoder.block[0] = first_block
+
+            for block_index, block in blocks.items():
+                if patched_forwards[block_index] is None:
+                    del block.forward
+                else:
+                    block.forward = patched_forwards[block_index]
+
+        return hidden_states
+
+    def _embed_sentences(self, sentences: List[Sentence]):
+        with self._forward_context():
+            self._embed_sequences(self._build_sequences(sentences))
+
+    def _embed_sequences(self, sequences: List[Tuple[List[Token], int, int]]):
+        sequence_input_ids = self.tokenizer(
+            [" ".join(token.text for token in tokens) for tokens, _, _ in sequences]
+        )["input_ids"]
+
+        # Every sequence is encoded in one or more windows, each window is one row of the padded batch
+        window_input_ids: List[torch.Tensor] = []
+        window_keep_ranges: List[Tuple[int, int]] = []
+
+        for input_ids in sequence_input_ids:
+            for start, end, keep_start, keep_end in self._sliding_windows(len(input_ids)):
+                window_input_ids.append(torch.tensor(input_ids[start:end], dtype=torch.long))
+                window_keep_ranges.append((keep_start - start, keep_end - start))
+
+        attention_bias: Optional[torch.Tensor] = None
+
+        if self.pack_sequences:
+            # Several windows share one row, each window is a block that only attends to itself. As T5 only uses
+            # relative positions, a window encodes exactly as if it was the only one in its row
+            window_positions, row_length = self._pack_windows([len(input_ids) for input_ids in window_input_ids])
+            number_of_rows = max(row for row, _ in window_positions) + 1
+
+            input_ids = torch.full((number_of_rows, row_length), self.tokenizer.pad_token_id, dtype=torch.long)
+            # Block 0 is padding, window i is block i + 1
+            block_ids = torch.zeros((number_of_rows, row_length), dtype=torch.long)
+
+            for window_index, ((row, offset), window_ids) in enumerate(zip(window_positions, window_input_ids)):
+                input_ids[row, offset : offset + len(window_ids)] = window_ids
+                block_ids[row, offset : offset + len(window_ids)] = window_index + 1
+
+            attention_mask = (block_ids > 0).long()
+
+            block_ids = block_ids.to(flair.device)
+            same_block = block_ids.unsqueeze(2) == block_ids.unsqueeze(1)
+            attention_bias = torch.zeros(same_block.shape, device=flair.device, dtype=self.model.dtype)
+            attention_bias = attention_bias.masked_fill(~same_block, torch.finfo(self.model.dtype).min).unsqueeze(1)
+        else:
+            # Pad all windows of the mini-batch into one tensor, so that only one forward pass is needed
+            window_lengths = torch.tensor([len(input_ids) for input_ids in window_input_ids])
+            input_ids = torch.nn.utils.rnn.pad_sequence(
+                window_input_ids, batch_first=True, padding_value=self.tokenizer.pad_token_id
+            )
+            attention_mask = (torch.arange(input_ids.size(1)).unsqueeze(0) < window_lengths.unsqueeze(1)).long()
+            window_positions = [(window_index, 0) for window_index in range(len(window_input_ids))]
+
+        # Pass to model
+        encoding = {"input_ids": input_ids.to(flair.device), "attention_mask": attention_mask.to(flair.device)}
+
+        hidden_states = self._run_encoder(encoding, attention_bias)
+
+        # Maps every byte position of the concatenated sequences to its position in the flattened
+        # [rows * length] batch, which merges the windows of long sentences and un-packs packed windows
+        row_length = input_ids.size(1)
+        position_index = torch.cat(
+            [
+                torch.arange(row * row_length + offset + keep_start, row * row_length + offset + keep_end)
+                for (row, offset), (keep_start, keep_end) in zip(window_positions, window_keep_ranges)
+            ]
+        )
+
+        # Flat offset index of all tokens in the mini-batch, pointing into the concatenated sequences.
+        # Context tokens are encoded, but not embedded
+        all_tokens: List[Token] = []
+        token_offsets: List[int] = []
+        token_lengths: List[int] = []
+        sequence_offset = 0
+
+        for (tokens, target_start, target_end), input_ids in zip(sequences, sequence_input_ids):
+            sequence_token_offsets, sequence_token_lengths = self._token_byte_offsets(tokens)
+
+            all_tokens.extend(tokens[target_start:target_end])
+            token_offsets.extend(sequence_offset + offset for offset in sequence_token_offsets[target_start:target_end])
+            token_lengths.extend(sequence_token_lengths[target_start:target_end])
+            sequence_offset += len(input_ids)
+
+        # Stacked hidden states of all requested layers: [layers, rows * length, hidden]
+        number_of_hidden_states = self.model.config.num_layers + 1
+        layer_hidden_states = torch.stack(
+            [hidden_states[layer_index % number_of_hidden_states] for layer_index in self.layer_indexes]
+        )
+        layer_hidden_states = layer_hidden_states.flatten(1, 2)
+
+        token_embeddings = self._pool_subtokens(
+            layer_hidden_states,
+            position_index.to(layer_hidden_states.device),
+            torch.tensor(token_offsets, dtype=torch.long, device=layer_hidden_states.device),
+            torch.tensor(token_lengths, dtype=torch.long, device=layer_hidden_states.device).clamp(min=1),
+        )
+
+        if self.layer_mean:
+            token_embeddings = token_embeddings.mean(dim=0)
+        else:
+            # Concatenate layers per token: [tokens, layers * hidden]
+            token_embeddings = token_embeddings.permute(1, 0, 2).flatten(1)
+
+        # Hidden states might be in reduced precision (e.g. with bf16 autocast)
+        token_embeddings = token_embeddings.to(dtype=torch.float32)
+
+        for token, token_embedding in zip(all_tokens, token_embeddings.unbind(0)):
+            token.set_embedding(self.name, token_embedding)
+
+    def _pool_subtokens(
+        self,
+        hidden_states: torch.Tensor,
+        position_index: torch.Tensor,
+        token_offsets: torch.Tensor,
+        token_lengths: torch.Tensor,
+    ) -> torch.Tensor:
+        # Pools the byte embeddings of all tokens and layers at once: [layers, positions, hidden] -> [layers, tokens, hidden]
+        # Token offsets are given in byte positions, which are mapped to hidden state positions by the position index
+        first_positions = position_index[token_offsets]
+        last_positions = position_index[token_offsets + token_lengths - 1]
+
+        if self.subtoken_pooling == "first":
+            return hidden_states.index_select(1, first_positions)
+
+        if self.subtoken_pooling == "last":
+            return hidden_states.index_select(1, last_positions)
+
+        if self.subtoken_pooling == "first_last":
+            return torch.cat(
+                [hidden_states.index_select(1, first_positions), hidden_states.index_select(1, last_positions)],
+                dim=-1,
+            )
+
+        # Mean pooling as segment reduction: scatter every byte onto the token it belongs to
+        segment_ids = torch.arange(len(token_lengths), device=token_lengths.device).repeat_interleave(token_lengths)
+        segment_starts = torch.cumsum(token_lengths, dim=0) - token_lengths
+        byte_positions = position_index[
+            token_offsets.repeat_interleave(token_lengths)
+            + torch.arange(len(segment_ids), device=token_lengths.device)
+            - segment_starts.repeat_interleave(token_lengths)
+        ]
+
+        token_sums = hidden_states.new_zeros(hidden_states.size(0), len(token_lengths), hidden_states.size(-1))
+        token_sums = token_sums.index_add(1, segment_ids, hidden_states.index_select(1, byte_positions))
+        return token_sums / token_lengths.unsqueeze(0).unsqueeze(-1)
 
-                offset += token_length + 1
-                
     def _forward_tensors(self, tensors) -> Dict[str, torch.Tensor]:
         return self.forward(**tensors)
 
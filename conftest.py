@@ -0,0 +1,68 @@
+import importlib
+
+import flair
+import pytest
+import torch
+
+from flair.data import Corpus
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+byt5_benchmark = importlib.import_module("byt5-benchmark")
+
+
+@pytest.fixture(autouse=True)
+def cpu_device():
+    # Tests are small, they always run on CPU
+    flair.device = torch.device("cpu")
+
+
+@pytest.fixture(scope="session")
+def fine_tuner():
+    return importlib.import_module("flair-fine-tuner")
+
+
+@pytest.fixture(scope="session")
+def tiny_bert(tmp_path_factory) -> str:
+    """Saves a tiny randomly initialized BERT model, whose vocabulary covers the synthetic sentences."""
+    model_path = tmp_path_factory.mktemp("models") / "tiny-bert"
+    model_path.mkdir()
+
+    characters = sorted({character for word in byt5_benchmark.SYNTHETIC_WORDS for character in word})
+    vocab = list(dict.fromkeys(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *byt5_benchmark.SYNTHETIC_WORDS,
+                                *characters]))
+    (model_path / "vocab.txt").write_text("\n".join(vocab) + "\n")
+
+    config = BertConfig(
+        vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64
+    )
+
+    BertTokenizerFast(model_path / "vocab.txt", do_lower_case=False).save_pretrained(model_path)
+    BertModel(config).save_pretrained(model_path)
+
+    return str(model_path)
+
+
+def make_synthetic_corpus(number_of_sentences: int = 40, seed: int = 42) -> Corpus:
+    sentences = byt5_benchmark.synthetic_sentences(number_of_sentences, seed=seed)
+    number_of_train_sentences = number_of_sentences // 2
+
+    return Corpus(
+        sentences[:number_of_train_sentences],
+        sentences[number_of_train_sentences: number_of_train_sentences * 3 // 2],
+        sentences[number_of_train_sentences * 3 // 2:],
+        sample_missing_splits=False,
+    )
+
+
+@pytest.fixture
+def synthetic_corpus() -> Corpus:
+    return make_synthetic_corpus()
+
+
+@pytest.fixture(scope="session")
+def tiny_byt5(tmp_path_factory) -> str:
+    """Saves a tiny randomly initialized ByT5 encoder, "byt5" in its name selects ByT5Embeddings."""
+    model_path = tmp_path_factory.mktemp("models") / "tiny-byt5"
+    byt5_benchmark.tiny_byt5_embeddings().model.save_pretrained(model_path)
+
+    return str(model_path)
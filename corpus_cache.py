@@ -0,0 +1,203 @@
+import fcntl
+import gc
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import time
+
+import flair
+
+from flair.data import Corpus, Relation, Span
+from flair.datasets import ColumnDataset
+from torch.utils.data import ConcatDataset, Dataset
+
+from pathlib import Path
+
+from typing import Callable, Dict, List, Optional, Union
+
+import utils
+
+logger = logging.getLogger("flair")
+
+# Increase, whenever the format of cached corpora changes
+CORPUS_CACHE_VERSION = 1
+
+
+def hash_file(path: Path) -> str:
+    sha1 = hashlib.sha1()
+
+    with open(path, "rb") as f_p:
+        for chunk in iter(lambda: f_p.read(2**20), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def preprocessing_code_hash() -> str:
+    # Preprocessing stages are implemented in utils.py, column parsing is done by Flair
+    code = Path(utils.__file__).read_bytes() + flair.__version__.encode("utf-8")
+    return hashlib.sha1(code).hexdigest()
+
+
+def _corpus_datasets(corpus: Corpus) -> List[Dataset]:
+    # Splits of multi-file corpora are concatenations of one dataset per file
+    datasets = [dataset for dataset in [corpus.train, corpus.dev, corpus.test] if dataset is not None]
+
+    while any(isinstance(dataset, ConcatDataset) for dataset in datasets):
+        datasets = [
+            sub_dataset
+            for dataset in datasets
+            for sub_dataset in (dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset])
+        ]
+
+    return datasets
+
+
+def _is_cacheable(corpus: Corpus) -> bool:
+    return all(isinstance(dataset, ColumnDataset) and dataset.in_memory for dataset in _corpus_datasets(corpus))
+
+
+def _unlink_sentences(corpus: Corpus):
+    # Sentences of a dataset are linked to their neighbours for FLERT context. This chain is too deep to be pickled
+    for dataset in _corpus_datasets(corpus):
+        for sentence in dataset.sentences:
+            sentence._previous_sentence = None
+            sentence._next_sentence = None
+
+
+def _link_sentences(corpus: Corpus):
+    # Same links as set by ColumnDataset, which links every sentence to the one read before
+    for dataset in _corpus_datasets(corpus):
+        previous_sentence = None
+
+        for sentence in dataset.sentences:
+            sentence._previous_sentence = previous_sentence
+            sentence._next_sentence = None
+
+            if previous_sentence is not None:
+                previous_sentence._next_sentence = sentence
+
+            previous_sentence = sentence
+
+
+class _CorpusPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # Spans and relations have a custom __new__ that needs their tokens, so they are created without it and
+        # restored from their state
+        if isinstance(obj, (Span, Relation)):
+            return object.__new__, (type(obj),), obj.__dict__
+
+        return NotImplemented
+
+
+def serialize_corpus(corpus: Corpus) -> bytes:
+    buffer = io.BytesIO()
+
+    _unlink_sentences(corpus)
+    try:
+        _CorpusPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(corpus)
+    finally:
+        _link_sentences(corpus)
+
+    return buffer.getvalue()
+
+
+def deserialize_corpus(data: bytes) -> Corpus:
+    # Unpickling creates millions of small objects, that would trigger the cyclic garbage collector over and over
+    gc.disable()
+    try:
+        corpus = pickle.loads(data)
+    finally:
+        gc.enable()
+
+    _link_sentences(corpus)
+    return corpus
+
+
+class CorpusCache:
+    """Content-addressed cache of parsed corpora.
+
+    A corpus is stored as pickle under the hash of its key, the content of all raw data files and the preprocessing
+    code, so a changed raw file or preprocessor automatically leads to a new entry. Cache entries are written atomically,
+    so several runs can share the same cache directory.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path]):
+        self.path = Path(cache_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _cache_file(self, key: Dict, raw_data_folder: Path) -> Optional[Path]:
+        raw_files = sorted(path for path in raw_data_folder.glob("*") if path.is_file())
+
+        if not raw_files:
+            # Raw data is not downloaded yet
+            return None
+
+        content_key = {
+            **key,
+            "cache_version": CORPUS_CACHE_VERSION,
+            "preprocessing_code": preprocessing_code_hash(),
+            "raw_files": {path.name: hash_file(path) for path in raw_files},
+        }
+        digest = hashlib.sha1(json.dumps(content_key, sort_keys=True).encode("utf-8")).hexdigest()
+
+        return self.path / f"{digest}.pkl"
+
+    def _load(self, cache_file: Path) -> Corpus:
+        return deserialize_corpus(cache_file.read_bytes())
+
+    def _store(self, corpus: Corpus, cache_file: Path):
+        temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        temp_file.write_bytes(serialize_corpus(corpus))
+        os.replace(temp_file, cache_file)
+
+    def load(
+        self,
+        key: Dict,
+        raw_data_folder: Path,
+        load_fn: Callable[[], Corpus],
+        preprocessed_files: Optional[List[Path]] = None,
+    ) -> Corpus:
+        """Returns the cached corpus for the given key, or loads it with `load_fn` and caches it.
+
+        Flair only preprocesses a dataset if its preprocessed split files are missing. These `preprocessed_files` are
+        deleted before `load_fn` is called on a cache miss, so that they are never outdated.
+        """
+        start_time = time.perf_counter()
+
+        cache_file = self._cache_file(key, raw_data_folder)
+
+        if cache_file is not None and cache_file.exists():
+            corpus = self._load(cache_file)
+            logger.info(f"Corpus {key} loaded from cache in {time.perf_counter() - start_time:.2f}s")
+            return corpus
+
+        # Runs that need the same dataset wait for each other, instead of preprocessing it at the same time
+        lock_name = hashlib.sha1(str(raw_data_folder).encode("utf-8")).hexdigest()
+
+        with open(self.path / f"{lock_name}.lock", "w") as lock_f_p:
+            fcntl.flock(lock_f_p, fcntl.LOCK_EX)
+            try:
+                cache_file = self._cache_file(key, raw_data_folder)
+
+                if cache_file is not None and cache_file.exists():
+                    return self._load(cache_file)
+
+                for preprocessed_file in preprocessed_files or []:
+                    preprocessed_file.unlink(missing_ok=True)
+
+                corpus = load_fn()
+
+                # Raw data might have been downloaded by load_fn
+                cache_file = self._cache_file(key, raw_data_folder)
+
+                if cache_file is not None and _is_cacheable(corpus):
+                    self._store(corpus, cache_file)
+            finally:
+                fcntl.flock(lock_f_p, fcntl.LOCK_UN)
+
+        logger.info(f"Corpus {key} loaded and cached in {time.perf_counter() - start_time:.2f}s")
+        return corpus
@@ -0,0 +1,246 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import struct
+
+import flair
+import numpy as np
+import torch
+
+from flair.data import Sentence
+from flair.embeddings import TransformerWordEmbeddings
+from flair.embeddings.base import register_embeddings
+
+from pathlib import Path
+
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger("flair")
+
+# Index record: sha1 digest of the sentence key, first row and number of rows (= tokens) in the embedding file
+INDEX_RECORD = struct.Struct("<20sQI")
+
+# Attributes of an embedding that change the produced token embeddings
+CACHE_KEY_ATTRIBUTES = [
+    "base_model_name",
+    "layer_indexes",
+    "layer_mean",
+    "subtoken_pooling",
+    "context_length",
+    "respect_document_boundaries",
+    "use_context_separator",
+    "allow_long_sentences",
+    "window_size",
+    "stride",
+    "embedding_length",
+]
+
+# Reduced precision of the execution state, that also changes the produced token embeddings: inference mode of
+# ByT5Embeddings (see `enable_inference_mode`). They are only part of the key, when set
+CACHE_KEY_STATE_ATTRIBUTES = ["inference_bf16", "inference_int8"]
+
+
+class HiddenStateCache:
+    """Persistent cache of pooled token embeddings.
+
+    Embeddings of all sentences are appended to one float16 file, that is memory-mapped for reading: `get` returns a
+    view of the mapping, without copying. A compact binary index maps the hash of a sentence to its rows. Files are only appended to (under a file lock), so several runs can
+    share the same cache directory.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], key: Dict, embedding_length: int):
+        serialized_key = json.dumps(key, sort_keys=True)
+        self.key = key
+
+        self.path = Path(cache_dir) / hashlib.sha1(serialized_key.encode("utf-8")).hexdigest()[:16]
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        key_file = self.path / "key.json"
+        if not key_file.exists():
+            key_file.write_text(serialized_key)
+
+        self.embedding_length = embedding_length
+        self.embeddings_file = self.path / "embeddings.f16"
+        self.index_file = self.path / "index.bin"
+        self.embeddings_file.touch()
+        self.index_file.touch()
+
+        self.index: Dict[bytes, Tuple[int, int]] = {}
+        self._index_position = 0
+        self._embeddings: Optional[np.memmap] = None
+        self._read_index()
+
+        logger.info(f"Embedding cache: {self.path} ({len(self.index)} sentences)")
+
+    @staticmethod
+    def hash(text: str) -> bytes:
+        return hashlib.sha1(text.encode("utf-8")).digest()
+
+    def _read_index(self):
+        # Only read records, that were appended since the last read (e.g. by another run)
+        with open(self.index_file, "rb") as f_p:
+            f_p.seek(self._index_position)
+            data = f_p.read()
+
+        data = data[: len(data) - len(data) % INDEX_RECORD.size]
+
+        for digest, row, count in INDEX_RECORD.iter_unpack(data):
+            self.index[digest] = (row, count)
+
+        self._index_position += len(data)
+
+    def _map_embeddings(self):
+        rows = os.path.getsize(self.embeddings_file) // (self.embedding_length * 2)
+
+        # Copy-on-write mapping gives writable arrays, so they can be wrapped as tensors without copying
+        self._embeddings = np.memmap(
+            self.embeddings_file, dtype=np.float16, mode="c", shape=(rows, self.embedding_length)
+        )
+
+    def get(self, digest: bytes) -> Optional[np.ndarray]:
+        if digest not in self.index and os.path.getsize(self.index_file) > self._index_position:
+            self._read_index()
+
+        if digest not in self.index:
+            return None
+
+        row, count = self.index[digest]
+
+        if self._embeddings is None or row + count > len(self._embeddings):
+            self._map_embeddings()
+
+        return self._embeddings[row : row + count]
+
+    def put(self, digest: bytes, embeddings: np.ndarray):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float16)
+
+        with open(self.index_file, "ab") as index_f_p, open(self.embeddings_file, "ab") as embeddings_f_p:
+            fcntl.flock(index_f_p, fcntl.LOCK_EX)
+            try:
+                row = embeddings_f_p.seek(0, os.SEEK_END) // (self.embedding_length * 2)
+                embeddings_f_p.write(embeddings.tobytes())
+                embeddings_f_p.flush()
+
+                index_f_p.write(INDEX_RECORD.pack(digest, row, len(embeddings)))
+                index_f_p.flush()
+            finally:
+                fcntl.flock(index_f_p, fcntl.LOCK_UN)
+
+        self.index[digest] = (row, len(embeddings))
+
+
+class HiddenStateCacheMixin:
+    """Adds an opt-in on-disk cache of pooled token embeddings to frozen (``fine_tune=False``) token embeddings."""
+
+    hidden_state_cache: Optional[HiddenStateCache] = None
+    hidden_state_cache_dir: Optional[Union[str, Path]] = None
+
+    def _init_hidden_state_cache(self, cache_dir: Optional[Union[str, Path]]):
+        if cache_dir is None or self.fine_tune:
+            self.hidden_state_cache = None
+            return
+
+        self.hidden_state_cache_dir = cache_dir
+        self.hidden_state_cache = HiddenStateCache(cache_dir, self._hidden_state_cache_key(), self.embedding_length)
+
+    def _hidden_state_cache_key(self) -> Dict:
+        key = {attribute: getattr(self, attribute, None) for attribute in CACHE_KEY_ATTRIBUTES}
+        key["class"] = type(self).__name__
+
+        # Keys of full precision embeddings stay the same as before, so that existing caches are still used
+        for attribute in CACHE_KEY_STATE_ATTRIBUTES:
+            if getattr(self, attribute, False):
+                key[attribute] = True
+
+        # Autocast of mixed-precision training (see execution_modes.py)
+        device_type = torch.device(flair.device).type
+        if torch.is_autocast_enabled(device_type):
+            key["autocast"] = str(torch.get_autocast_dtype(device_type))
+
+        return key
+
+    def _update_hidden_state_cache(self):
+        # The execution state might have changed since the cache was opened (e.g. by `enable_inference_mode`):
+        # embeddings of another precision are kept in another cache
+        key = self._hidden_state_cache_key()
+
+        if key != self.hidden_state_cache.key:
+            self.hidden_state_cache = HiddenStateCache(self.hidden_state_cache_dir, key, self.embedding_length)
+
+    def _sentence_cache_key(self, sentence: Sentence) -> bytes:
+        text = sentence.to_tokenized_string()
+
+        # With context, the embedding of a sentence also depends on its neighbours
+        if self.context_length > 0:
+            left_context = sentence.left_context(self.context_length, self.respect_document_boundaries)
+            right_context = sentence.right_context(self.context_length, self.respect_document_boundaries)
+            text = "\n".join(
+                [" ".join(token.text for token in left_context), text, " ".join(token.text for token in right_context)]
+            )
+
+        return HiddenStateCache.hash(text)
+
+    def _embed_with_cache(self, sentences: List[Sentence], embed_fn: Callable[[List[Sentence]], None]):
+        if self.hidden_state_cache is None or self.fine_tune:
+            embed_fn(sentences)
+            return
+
+        self._update_hidden_state_cache()
+
+        cached_sentences: List[Tuple[Sentence, np.ndarray]] = []
+        missing_sentences: List[Tuple[Sentence, bytes]] = []
+
+        for sentence in sentences:
+            digest = self._sentence_cache_key(sentence)
+            cached_embeddings = self.hidden_state_cache.get(digest)
+
+            if cached_embeddings is None or len(cached_embeddings) != len(sentence):
+                missing_sentences.append((sentence, digest))
+            else:
+                cached_sentences.append((sentence, cached_embeddings))
+
+        if cached_sentences:
+            # Cached rows stay float16 views of the mapping, they are moved and converted to float32 once per batch.
+            # Token embeddings are views of the batch tensor
+            batch_embeddings = torch.cat(
+                [torch.from_numpy(cached_embeddings) for _, cached_embeddings in cached_sentences]
+            ).to(flair.device, dtype=torch.float32)
+            sentence_lengths = [len(sentence) for sentence, _ in cached_sentences]
+
+            for (sentence, _), token_embeddings in zip(cached_sentences, batch_embeddings.split(sentence_lengths)):
+                for token, token_embedding in zip(sentence.tokens, token_embeddings.unbind(0)):
+                    token.set_embedding(self.name, token_embedding)
+
+        if not missing_sentences:
+            return
+
+        # Cached embeddings are computed without dropout (and context dropout), so that they are deterministic
+        was_training = self.training
+        self.eval()
+        try:
+            embed_fn([sentence for sentence, _ in missing_sentences])
+        finally:
+            self.train(was_training)
+
+        for sentence, digest in missing_sentences:
+            token_embeddings = torch.stack([token.get_embedding([self.name]) for token in sentence.tokens])
+            token_embeddings = token_embeddings.detach().to(dtype=torch.float16)
+
+            self.hidden_state_cache.put(digest, token_embeddings.cpu().numpy())
+
+            # Use the stored precision right away, so every epoch sees exactly the same embeddings
+            token_embeddings = token_embeddings.to(dtype=torch.float32)
+            for token, token_embedding in zip(sentence.tokens, token_embeddings.unbind(0)):
+                token.set_embedding(self.name, token_embedding)
+
+
+@register_embeddings
+class CachedTransformerWordEmbeddings(HiddenStateCacheMixin, TransformerWordEmbeddings):
+    def __init__(self, *args, cache_dir: Optional[Union[str, Path]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._init_hidden_state_cache(cache_dir)
+
+    def _add_embeddings_internal(self, sentences: List[Sentence]):
+        self._embed_with_cache(sentences, super()._add_embeddings_internal)
@@ -0,0 +1,195 @@
+# Benchmark of execution modes (autocast and torch.compile) per model family
+#
+# Usage:
+# $ python3 execution-mode-benchmark.py [--families hmbert hmteams hmbyt5 --modes fp32 amp compile amp+compile]
+# $ python3 execution-mode-benchmark.py --model hmbert=dbmdz/bert-base-historic-multilingual-cased --dataset newseye/fi
+#
+# Every family and mode trains a tagger in a fresh process, as run_experiment does, and reports step time (after the
+# first epoch, which includes compilation), speedup over fp32 and test F1. Without --model, tiny randomly initialized
+# models of every family are used, so the benchmark also runs offline. torch.compile is only used on CUDA devices
+# (--device cuda), on CPU the compile modes fall back to eager mode, as in run_experiment.
+import argparse
+import importlib
+import multiprocessing
+import tempfile
+import flair
+import torch
+
+from flair.data import Corpus
+from flair.trainers import ModelTrainer
+from pathlib import Path
+from tabulate import tabulate
+from transformers import BertConfig, BertModel, BertTokenizerFast, ElectraConfig, ElectraModel, ElectraTokenizerFast
+
+from typing import Dict, Optional
+
+from execution_modes import compile_tagger, resolve_compile_mode, resolve_precision
+from trainer_plugins import ExecutionModePlugin, ProfilingPlugin
+
+byt5_benchmark = importlib.import_module("byt5-benchmark")
+
+MODEL_FAMILIES = ["hmbert", "hmteams", "hmbyt5"]
+
+# Precision and compile mode of every benchmarked mode
+EXECUTION_MODES = {
+    "fp32": ("fp32", "none"),
+    "amp": ("auto", "none"),
+    "compile": ("fp32", "backbone"),
+    "amp+compile": ("auto", "backbone"),
+    "amp+compile-all": ("auto", "all"),
+}
+
+TRAINING_PHASES = ["data", "embeddings", "tagger", "backward", "optimizer"]
+
+
+def save_tiny_model(family: str, path: Path) -> str:
+    """Saves a tiny randomly initialized model (and tokenizer) of the family and returns its name for `hf_model`."""
+    if family == "hmbyt5":
+        # "byt5" in the model name selects ByT5Embeddings
+        model_path = path / "tiny-byt5"
+        byt5_benchmark.tiny_byt5_embeddings().model.save_pretrained(model_path)
+        return str(model_path)
+
+    model_path = path / f"tiny-{family}"
+    model_path.mkdir(parents=True)
+
+    # Word piece vocabulary of the synthetic sentences, with single characters for everything else
+    characters = sorted({character for word in byt5_benchmark.SYNTHETIC_WORDS for character in word})
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *byt5_benchmark.SYNTHETIC_WORDS, *characters]
+    (model_path / "vocab.txt").write_text("\n".join(dict.fromkeys(vocab)) + "\n")
+
+    config_options = dict(
+        vocab_size=len(vocab), hidden_size=64, num_hidden_layers=4, num_attention_heads=4, intermediate_size=128
+    )
+
+    if family == "hmbert":
+        BertTokenizerFast(model_path / "vocab.txt", do_lower_case=False).save_pretrained(model_path)
+        BertModel(BertConfig(**config_options)).save_pretrained(model_path)
+    else:
+        # hmTEAMS models are ELECTRA discriminators
+        ElectraTokenizerFast(model_path / "vocab.txt", do_lower_case=False).save_pretrained(model_path)
+        ElectraModel(ElectraConfig(embedding_size=64, **config_options)).save_pretrained(model_path)
+
+    return str(model_path)
+
+
+def load_benchmark_corpus(args) -> Corpus:
+    if args.dataset is not None:
+        fine_tuner = importlib.import_module("flair-fine-tuner")
+        return fine_tuner.load_corpus(args.dataset)
+
+    sentences = byt5_benchmark.synthetic_sentences(args.sentences, seed=args.seed)
+    number_of_train_sentences = int(len(sentences) * 0.8)
+    number_of_dev_sentences = int(len(sentences) * 0.1)
+
+    return Corpus(
+        sentences[:number_of_train_sentences],
+        sentences[number_of_train_sentences: number_of_train_sentences + number_of_dev_sentences],
+        sentences[number_of_train_sentences + number_of_dev_sentences:],
+        sample_missing_splits=False,
+    )
+
+
+def measure_mode(args, hf_model: str, mode: str) -> Dict[str, Optional[float]]:
+    # Runs in a fresh process: compiled code and autocast settings of one mode must not leak into another
+    fine_tuner = importlib.import_module("flair-fine-tuner")
+
+    torch.set_num_threads(args.threads)
+    flair.device = torch.device(args.device)
+    flair.set_seed(args.seed)
+
+    corpus = load_benchmark_corpus(args)
+    label_dictionary = corpus.make_label_dictionary("ner")
+
+    # Same model as created by run_experiment
+    tagger = fine_tuner.create_tagger("first", label_dictionary, {"hf_model": hf_model, "context_size": 0})
+
+    precision, compile_mode = EXECUTION_MODES[mode]
+    precision = resolve_precision(precision, flair.device)
+    compile_mode = resolve_compile_mode(compile_mode, flair.device)
+    compile_tagger(tagger, compile_mode)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        profiler = ProfilingPlugin(temp_dir)
+
+        result = ModelTrainer(tagger, corpus).fine_tune(
+            temp_dir,
+            learning_rate=args.learning_rate,
+            mini_batch_size=args.batch_size,
+            max_epochs=args.epochs,
+            embeddings_storage_mode="none",
+            use_final_model_for_eval=False,
+            use_amp=precision != "fp32",
+            plugins=[ExecutionModePlugin(precision, compile_mode), profiler],
+        )
+
+    # The first epoch includes compilation, it is only used, if there is no other epoch
+    epochs = profiler.epochs[1:] or profiler.epochs
+    number_of_batches = len([batch for batch in profiler.batches if batch["epoch"] in {e["epoch"] for e in epochs}])
+    training_time = sum(epoch[phase] for epoch in epochs for phase in TRAINING_PHASES)
+
+    return {
+        "precision": precision,
+        "compile": compile_mode,
+        "first_epoch": sum(profiler.epochs[0][phase] for phase in TRAINING_PHASES),
+        "step_time": 1000 * training_time / number_of_batches,
+        "tokens_per_second": sum(epoch["tokens"] for epoch in epochs) / training_time,
+        "test_f1": result["test_score"],
+    }
+
+
+def benchmark_execution_modes(args):
+    models = dict(model.split("=", 1) for model in args.model)
+    table = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for family in args.families:
+            hf_model = models[family] if family in models else save_tiny_model(family, Path(temp_dir))
+
+            fp32_step_time = None
+
+            for mode in args.modes:
+                with multiprocessing.get_context("spawn").Pool(1) as pool:
+                    result = pool.apply(measure_mode, (args, hf_model, mode))
+
+                if mode == "fp32":
+                    fp32_step_time = result["step_time"]
+
+                table.append(
+                    [
+                        family,
+                        mode,
+                        result["precision"],
+                        result["compile"],
+                        round(result["first_epoch"], 2),
+                        round(result["step_time"], 2),
+                        round(fp32_step_time / result["step_time"], 2) if fp32_step_time else "-",
+                        round(result["tokens_per_second"], 1),
+                        round(result["test_f1"], 4),
+                    ]
+                )
+
+    header = [
+        "Family", "Mode", "Precision", "Compile", "First epoch (s)", "Step time (ms)", "Speedup", "Tokens/s", "Test F1",
+    ]
+    print(tabulate(table, headers=header, tablefmt="github"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Step time and F1 of execution modes per model family")
+    parser.add_argument("--families", nargs="+", default=MODEL_FAMILIES, choices=MODEL_FAMILIES)
+    parser.add_argument("--modes", nargs="+", default=["fp32", "amp", "compile", "amp+compile"],
+                        choices=list(EXECUTION_MODES))
+    parser.add_argument("--model", nargs="+", default=[], help="Model per family, e.g. hmbert=dbmdz/bert-base-...")
+    parser.add_argument("--dataset", type=str, default=None, help="Train on e.g. newseye/fi instead of synthetic data")
+    parser.add_argument("--sentences", type=int, default=400, help="Number of synthetic sentences")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--learning-rate", type=float, default=5e-4)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=42)
+
+    args = parser.parse_args()
+
+    benchmark_execution_modes(args)
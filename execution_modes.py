@@ -0,0 +1,126 @@
+import contextlib
+import functools
+import logging
+
+import torch
+
+from flair.models import SequenceTagger
+
+from typing import Callable
+
+logger = logging.getLogger("flair")
+
+PRECISIONS = ["fp32", "bf16", "fp16", "auto"]
+COMPILE_MODES = ["none", "backbone", "all"]
+
+AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def resolve_precision(precision: str, device: torch.device) -> str:
+    """Returns the precision, that is actually used on the device: "fp32", "bf16" or "fp16"."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+
+    if precision == "fp32":
+        return precision
+
+    if device.type == "cuda":
+        if precision in ["auto", "bf16"] and torch.cuda.is_bf16_supported():
+            return "bf16"
+
+        if precision == "bf16":
+            logger.warning(f"bf16 is not supported by {device}, falling back to fp16")
+        return "fp16"
+
+    if device.type == "cpu":
+        # Autocast on CPU is only fast with bf16
+        if precision == "fp16":
+            logger.warning("fp16 autocast is slow on CPU, falling back to bf16")
+        return "bf16"
+
+    logger.warning(f"Autocast is not supported on {device}, falling back to fp32")
+    return "fp32"
+
+
+@contextlib.contextmanager
+def autocast_dtype(device: torch.device, precision: str):
+    # Flair's trainer enables autocast (`use_amp`) with the default dtype of the device, which is replaced here
+    if precision not in AUTOCAST_DTYPES:
+        yield
+        return
+
+    original_dtype = torch.get_autocast_dtype(device.type)
+    torch.set_autocast_dtype(device.type, AUTOCAST_DTYPES[precision])
+    try:
+        yield
+    finally:
+        torch.set_autocast_dtype(device.type, original_dtype)
+
+
+def resolve_compile_mode(compile_mode: str, device: torch.device) -> str:
+    """Returns the compile mode, that is actually used on the device: "none", "backbone" or "all".
+
+    torch.compile is only used on CUDA devices. On CPU, compiled training steps were slower than eager mode (e.g. about
+    half the speed for hmByT5, see execution-mode-benchmark.py), so it falls back to eager mode.
+    """
+    if compile_mode not in COMPILE_MODES:
+        raise ValueError(f"Unknown compile mode {compile_mode}, expected one of {COMPILE_MODES}")
+
+    if compile_mode == "none":
+        return compile_mode
+
+    if device.type != "cuda":
+        logger.warning(f"torch.compile is only used on CUDA devices, falling back to eager mode on {device}")
+        return "none"
+
+    try:
+        import torch._dynamo  # noqa: F401
+    except ImportError:
+        logger.warning("torch.compile is not available, falling back to eager mode")
+        return "none"
+
+    return compile_mode
+
+
+def _compile_with_fallback(forward_fn: Callable, name: str) -> Callable:
+    # Compilation happens lazily in the first calls. If it fails, the forward pass falls back to eager mode for the
+    # rest of the run, instead of failing it. All other errors (e.g. out of memory, or _StopEncoder of ByT5Embeddings,
+    # that stops the encoder after the last requested layer) are raised as in eager mode and keep the compiled forward
+    import torch._dynamo
+
+    compile_errors = (torch._dynamo.exc.TorchDynamoException, torch._dynamo.exc.TritonUnavailableError)
+    compiled_forward_fn = torch.compile(forward_fn, dynamic=True)
+    use_compiled = True
+
+    @functools.wraps(forward_fn)
+    def forward(*args, **kwargs):
+        nonlocal use_compiled
+
+        if use_compiled:
+            try:
+                return compiled_forward_fn(*args, **kwargs)
+            except compile_errors as e:
+                logger.warning(f"torch.compile of {name} failed, falling back to eager mode: {e!r}")
+                use_compiled = False
+
+        return forward_fn(*args, **kwargs)
+
+    return forward
+
+
+def compile_tagger(tagger: SequenceTagger, compile_mode: str):
+    """Compiles the transformer of the embeddings ("backbone") and also the tagger's forward pass ("all").
+
+    `compile_mode` has to be resolved by `resolve_compile_mode`. Forward passes are replaced on the instances, so that
+    parameter names (and saved models) do not change. Sentence lengths and batch sizes vary, so dynamic shapes are used
+    to avoid a recompilation for every new shape.
+    """
+    if compile_mode == "none":
+        return
+
+    backbone = tagger.embeddings.model
+    backbone.forward = _compile_with_fallback(backbone.forward, "backbone")
+
+    if compile_mode == "all":
+        # forward_loss calls forward directly, not via __call__ of the module
+        tagger.forward = _compile_with_fallback(tagger.forward, "tagger")
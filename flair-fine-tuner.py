@@ -1,94 +1,369 @@
+import contextlib
+import copy
+import functools
 import json
 import logging
+import multiprocessing
 import sys
+import time
 import flair
+import torch
 
 from flair import set_seed
 
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple, Union
 
-from flair.data import MultiCorpus
+from flair.data import Corpus, Dictionary, MultiCorpus
 from flair.datasets import NER_HIPE_2022, NER_ICDAR_EUROPEANA
 from flair.embeddings import TransformerWordEmbeddings
 from flair.models import SequenceTagger
 from flair.trainers import ModelTrainer
 from flair.trainers.plugins.loggers.tensorboard import TensorboardLogger
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from tabulate import tabulate
 
+from backbone_cache import BACKBONE_CACHE
+from batching import TokenBudgetBatching
 from byt5_embeddings import ByT5Embeddings
+from corpus_cache import CorpusCache, deserialize_corpus, preprocessing_code_hash, serialize_corpus
+from embedding_cache import CachedTransformerWordEmbeddings
+from execution_modes import compile_tagger, resolve_compile_mode, resolve_precision
+from grid_estimator import (
+    calibrate, compute_corpus_statistics, estimate_run, get_subword_counter, load_corpus_statistics, log_grid_estimate
+)
+from grid_scheduler import GridJob, GridManifest, WorkerSlot, make_worker_slots, run_grid, run_successive_halving
+from trainer_plugins import EpochCheckpointPlugin, ExecutionModePlugin, ProfilingPlugin, TrainingPaused
 
-from utils import prepare_ajmc_corpus, prepare_clef_2020_corpus, prepare_newseye_fi_sv_corpus, prepare_newseye_de_fr_corpus
+from utils import get_preproc_fn
 
 logger = logging.getLogger("flair")
 logger.setLevel(level="INFO")
 
+HIPE_2022_VERSION = "v2.1"
 
-def run_experiment(seed: int, batch_size: int, epoch: int, learning_rate: float, subword_pooling: str,
-                   hipe_datasets: List[str], json_config: dict):
+
+def load_corpus(
+    dataset: str, label_name_map: Optional[dict] = None, cache_dir: Optional[Union[str, Path]] = None
+) -> Corpus:
+    dataset_name, language = dataset.split("/")
+
+    if dataset_name == "icdar":
+        load_fn = functools.partial(NER_ICDAR_EUROPEANA, language=language)
+
+        key = {"dataset": dataset}
+        raw_data_folder = flair.cache_root / "datasets" / "ner_icdar_europeana" / language
+        preprocessed_files = []
+    else:
+        # Preprocessing stages are selected per dataset and language, see PREPROCESSING_STAGES in utils.py
+        preproc_fn = get_preproc_fn(dataset_name, language)
+
+        load_fn = functools.partial(NER_HIPE_2022, dataset_name=dataset_name, language=language,
+                                    version=HIPE_2022_VERSION, preproc_fn=preproc_fn, label_name_map=label_name_map,
+                                    add_document_separator=True)
+
+        key = {
+            "dataset": dataset,
+            "version": HIPE_2022_VERSION,
+            "preprocessing": preproc_fn.keywords if preproc_fn else None,
+            "label_name_map": label_name_map,
+            "add_document_separator": True,
+        }
+
+        data_folder = flair.cache_root / "datasets" / "ner_hipe_2022" / HIPE_2022_VERSION / dataset_name / language
+        raw_data_folder = data_folder / "original"
+        preprocessed_files = list((data_folder / "with_doc_seperator").glob("*.txt"))
+
+    if cache_dir is None:
+        return load_fn()
+
+    return CorpusCache(cache_dir).load(key, raw_data_folder, load_fn, preprocessed_files)
+
+
+def _load_serialized_corpus(
+    dataset: str, label_name_map: Optional[dict], cache_dir: Optional[Union[str, Path]]
+) -> Tuple[bytes, float]:
+    # Runs in a worker process: corpora are sent back in the (fast) serialization format of the corpus cache
+    start_time = time.perf_counter()
+    corpus = load_corpus(dataset, label_name_map, cache_dir)
+    return serialize_corpus(corpus), time.perf_counter() - start_time
+
+
+def load_corpora(
+    datasets: List[str],
+    label_name_map: Optional[dict] = None,
+    cache_dir: Optional[Union[str, Path]] = None,
+    num_workers: int = 1,
+) -> List[Corpus]:
+    start_time = time.perf_counter()
+
+    corpora: List[Corpus] = []
+    load_times: List[float] = []
+
+    if num_workers > 1 and len(datasets) > 1:
+        # Corpora are loaded independently in worker processes and merged in the original order. Forked workers
+        # share the already imported modules, they only parse data and never use CUDA
+        context = multiprocessing.get_context("fork")
+
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(datasets)), mp_context=context) as executor:
+            futures = [
+                executor.submit(_load_serialized_corpus, dataset, label_name_map, cache_dir) for dataset in datasets
+            ]
+
+            for future in futures:
+                serialized_corpus, load_time = future.result()
+                corpora.append(deserialize_corpus(serialized_corpus))
+                load_times.append(load_time)
+    else:
+        for dataset in datasets:
+            dataset_start_time = time.perf_counter()
+            corpora.append(load_corpus(dataset, label_name_map, cache_dir))
+            load_times.append(time.perf_counter() - dataset_start_time)
+
+    table = [
+        [dataset, len(corpus.train or []), len(corpus.dev or []), len(corpus.test or []), round(load_time, 2)]
+        for dataset, corpus, load_time in zip(datasets, corpora, load_times)
+    ]
+    header = ["Dataset", "Train", "Dev", "Test", "Load time (s)"]
+
+    logger.info("Corpus loading:\n" + tabulate(table, headers=header, tablefmt="github"))
+    logger.info(
+        "Loaded {} corpora in {:.2f}s with {} worker(s) (sum of load times: {:.2f}s)".format(
+            len(datasets), time.perf_counter() - start_time, num_workers, sum(load_times)
+        )
+    )
+
+    return corpora
+
+
+class _SharedCorpora:
+    def __init__(self, corpora: MultiCorpus, label_dictionary: Dictionary):
+        self.corpora = corpora
+        self.label_dictionary = label_dictionary
+
+        # Label types read from the corpus files, all others were added by a run (e.g. predictions)
+        self.gold_label_types: Set[str] = {
+            label_type for sentence in self.sentences() for label_type in sentence.annotation_layers
+        }
+
+    def sentences(self):
+        for split in [self.corpora.train, self.corpora.dev, self.corpora.test]:
+            if split is not None:
+                yield from split
+
+    def reset(self):
+        for sentence in self.sentences():
+            sentence.clear_embeddings()
+
+            for label_type in [label_type for label_type in sentence.annotation_layers
+                               if label_type not in self.gold_label_types]:
+                sentence.remove_labels(label_type)
+
+
+# Corpora of the current process: all runs of a grid use the same datasets, so they are only loaded once
+_shared_corpora: Dict[str, _SharedCorpora] = {}
+
+
+def get_corpora(hipe_datasets: List[str], label_name_map: Optional[dict] = None,
+                corpus_cache_dir: Optional[Union[str, Path]] = None,
+                corpus_workers: int = 1) -> Tuple[MultiCorpus, Dictionary]:
+    key = json.dumps([hipe_datasets, label_name_map], sort_keys=True)
+
+    if key not in _shared_corpora:
+        corpus_list = load_corpora(hipe_datasets, label_name_map, corpus_cache_dir, corpus_workers)
+
+        corpora: MultiCorpus = MultiCorpus(corpora=corpus_list, sample_missing_splits=False)
+        label_dictionary = corpora.make_label_dictionary(label_type="ner")
+
+        _shared_corpora[key] = _SharedCorpora(corpora, label_dictionary)
+    else:
+        logger.info("Reusing corpora of previous run")
+
+    shared_corpora = _shared_corpora[key]
+
+    # Embeddings and predictions of a previous run must not leak into this run
+    shared_corpora.reset()
+
+    # The label dictionary is modified by the tagger (e.g. start/stop tags for the CRF)
+    return shared_corpora.corpora, copy.deepcopy(shared_corpora.label_dictionary)
+
+
+def get_execution_mode(json_config: dict, device: torch.device) -> Tuple[str, str]:
+    # Precision and compile mode, that are actually used on the device (with fallbacks, e.g. fp16 -> bf16 on CPU)
+    precision = json_config["precision"] if "precision" in json_config else "fp32"
+    compile_mode = json_config["torch_compile"] if "torch_compile" in json_config else "none"
+
+    return resolve_precision(precision, device), resolve_compile_mode(compile_mode, device)
+
+
+def get_execution_mode_suffix(execution_mode: Tuple[str, str]) -> str:
+    # Only other execution modes than the default are appended, so that names of existing runs are unchanged
+    precision, compile_mode = execution_mode
+    suffix = ""
+
+    if precision != "fp32":
+        suffix += f"-precision{precision}"
+    if compile_mode != "none":
+        suffix += f"-compile{compile_mode}"
+
+    return suffix
+
+
+# Options of create_tagger, that change the trained model: their defaults and names in output paths
+MODEL_OPTIONS = {
+    "fine_tune": (True, "finetune"),
+    "allow_long_sentences": (False, "longsentences"),
+    "window_size": (1024, "window"),
+    "stride": (None, "stride"),
+    "pack_sequences": (False, "packing"),
+    "respect_document_boundaries": (False, "docboundaries"),
+    "byt5_context_and_pooling": (False, "byt5context"),
+}
+
+
+def get_model_options_suffix(json_config: dict) -> str:
+    # E.g. a frozen backbone must not share the output path of fine-tuning with the same hyper-parameters
+    suffix = ""
+
+    for option, (default, name) in MODEL_OPTIONS.items():
+        value = json_config[option] if option in json_config else default
+
+        if value != default:
+            suffix += f"-{name}{value}"
+
+    return suffix
+
+
+def get_batching_suffix(batch_size: int, json_config: dict) -> str:
+    # With token or byte batching, the batch size is a budget: runs must not share the output path of sentence batching
+    batching = json_config["batching"] if "batching" in json_config else "sentences"
+    batching_pool_size = json_config["batching_pool_size"] if "batching_pool_size" in json_config else 1000
+
+    if batching == "sentences":
+        return ""
+
+    suffix = f"-batching{batching}{batch_size}"
+
+    # The pool size changes, which sentences are batched together
+    if batching_pool_size != 1000:
+        suffix += f"-pool{batching_pool_size}"
+
+    return suffix
+
+
+def get_run_suffix(batch_size: int, json_config: dict, execution_mode: Tuple[str, str]) -> str:
+    # Appended to output paths and repo names of runs, only for other settings than the defaults
+    return get_model_options_suffix(json_config) + get_batching_suffix(batch_size, json_config) + \
+        get_execution_mode_suffix(execution_mode)
+
+
+def get_grid_execution_mode(json_config: dict) -> Tuple[str, str]:
+    # All worker slots of a grid are expected to support the same execution mode, it is resolved for the first one
+    return get_execution_mode(json_config, torch.device(get_worker_slots(json_config)[0].device))
+
+
+def get_output_path(seed: int, batch_size: int, epoch: int, learning_rate: float, subword_pooling: str,
+                    hipe_datasets: List[str], json_config: dict, execution_mode: Tuple[str, str]) -> str:
     hf_model = json_config["hf_model"]
     context_size = json_config["context_size"]
     layers = json_config["layers"] if "layers" in json_config else "-1"
     use_crf = json_config["use_crf"] if "use_crf" in json_config else False
-    label_name_map = json_config["label_name_map"] if "label_name_map" in json_config else None
-    use_tensorboard_logger = json_config["use_tensorboard_logger"] if "use_tensorboard_logger" in json_config else False
 
-    # Set seed for reproducibility
-    set_seed(seed)
+    if context_size == 0:
+        context_size = False
 
-    corpus_list = []
+    dataset_identifier = hipe_datasets[0] if len(hipe_datasets) == 1 else "mhmner"
 
-    # Dataset-related
-    for dataset in hipe_datasets:
-        dataset_name, language = dataset.split("/")
-
-        # E.g. topres19th needs no special preprocessing
-        preproc_fn = None
-
-        if dataset_name == "ajmc":
-            preproc_fn = prepare_ajmc_corpus
-        elif dataset_name == "hipe2020":
-            preproc_fn = prepare_clef_2020_corpus
-        elif dataset_name == "newseye" and language in ["fi", "sv"]:
-            preproc_fn = prepare_newseye_fi_sv_corpus
-        elif dataset_name == "newseye" and language in ["de", "fr"]:
-            preproc_fn = prepare_newseye_de_fr_corpus
-
-        if dataset_name == "icdar":
-            corpus_list.append(NER_ICDAR_EUROPEANA(language=language))
-        else:
-            corpus_list.append(NER_HIPE_2022(dataset_name=dataset_name, language=language, preproc_fn=preproc_fn,
-                                             label_name_map=label_name_map, add_document_separator=True))
+    output_path = f"hmbench-{dataset_identifier}-{hf_model}-bs{batch_size}-ws{context_size}-e{epoch}-lr{learning_rate}-pooling{subword_pooling}-layers{layers}-crf{use_crf}-{seed}"
+
+    return output_path + get_run_suffix(batch_size, json_config, execution_mode)
+
+
+def create_tagger(subword_pooling: str, label_dictionary: Dictionary, json_config: dict) -> SequenceTagger:
+    hf_model = json_config["hf_model"]
+    context_size = json_config["context_size"]
+    layers = json_config["layers"] if "layers" in json_config else "-1"
+    use_crf = json_config["use_crf"] if "use_crf" in json_config else False
+    allow_long_sentences = json_config["allow_long_sentences"] if "allow_long_sentences" in json_config else False
+    window_size = json_config["window_size"] if "window_size" in json_config else 1024
+    stride = json_config["stride"] if "stride" in json_config else None
+    pack_sequences = json_config["pack_sequences"] if "pack_sequences" in json_config else False
+    fine_tune = json_config["fine_tune"] if "fine_tune" in json_config else True
+    embedding_cache_dir = json_config["embedding_cache_dir"] if "embedding_cache_dir" in json_config else None
+    gradient_checkpointing = json_config["gradient_checkpointing"] if "gradient_checkpointing" in json_config else False
+    use_backbone_cache = json_config["backbone_cache"] if "backbone_cache" in json_config else False
+    byt5_context_and_pooling = json_config["byt5_context_and_pooling"] \
+        if "byt5_context_and_pooling" in json_config else False
+    respect_document_boundaries = json_config["respect_document_boundaries"] \
+        if "respect_document_boundaries" in json_config else False
 
     if context_size == 0:
         context_size = False
 
+    byt5_subword_pooling = subword_pooling
+    byt5_context_size = context_size
+
+    # ByT5 runs originally always used "first" subword pooling and no context, whatever the grid said. The subword
+    # pooling and context size of the grid are only used with "byt5_context_and_pooling", so that results of existing
+    # configs do not change
+    if "byt5" in hf_model and not byt5_context_and_pooling:
+        if subword_pooling != "first" or context_size:
+            logger.warning("ByT5 uses first subword pooling and no context, set byt5_context_and_pooling to use "
+                           "subword pooling {} and context {}".format(subword_pooling, context_size))
+
+        byt5_subword_pooling = "first"
+        byt5_context_size = False
+
     logger.info("FLERT Context: {}".format(context_size))
     logger.info("Layers: {}".format(layers))
     logger.info("Use CRF: {}".format(use_crf))
 
-    corpora: MultiCorpus = MultiCorpus(corpora=corpus_list, sample_missing_splits=False)
-    label_dictionary = corpora.make_label_dictionary(label_type="ner")
     logger.info("Label Dictionary: {}".format(label_dictionary.get_items()))
 
     embeddings = None
 
-    if "byt5" in hf_model:
-        logger.info("Using own implementation of ByT5Embeddings")
-        embeddings = ByT5Embeddings(
-            model=hf_model,
-            layers=layers,
-            subword_pooling=subword_pooling,
-            fine_tune=True,
-        )
-    else:
-        embeddings = TransformerWordEmbeddings(
-            model=hf_model,
-            layers=layers,
-            subtoken_pooling=subword_pooling,
-            fine_tune=True,
-            use_context=context_size,
-        )
+    # Runs of a grid can share the pristine pretrained backbone, instead of loading it again
+    if use_backbone_cache:
+        logger.info("Using backbone cache")
+
+    with BACKBONE_CACHE.patch() if use_backbone_cache else contextlib.nullcontext():
+        if "byt5" in hf_model:
+            logger.info("Using own implementation of ByT5Embeddings")
+            logger.info("Gradient checkpointing: {}".format(gradient_checkpointing))
+            logger.info("Sequence packing: {}".format(pack_sequences))
+            embeddings = ByT5Embeddings(
+                model=hf_model,
+                layers=layers,
+                subtoken_pooling=byt5_subword_pooling,
+                fine_tune=fine_tune,
+                use_context=byt5_context_size,
+                respect_document_boundaries=respect_document_boundaries,
+                allow_long_sentences=allow_long_sentences,
+                window_size=window_size,
+                stride=stride,
+                pack_sequences=pack_sequences,
+                cache_dir=embedding_cache_dir,
+                gradient_checkpointing=gradient_checkpointing,
+            )
+        elif embedding_cache_dir and not fine_tune:
+            logger.info("Using embedding cache in {}".format(embedding_cache_dir))
+            embeddings = CachedTransformerWordEmbeddings(
+                model=hf_model,
+                layers=layers,
+                subtoken_pooling=subword_pooling,
+                fine_tune=fine_tune,
+                use_context=context_size,
+                cache_dir=embedding_cache_dir,
+            )
+        else:
+            embeddings = TransformerWordEmbeddings(
+                model=hf_model,
+                layers=layers,
+                subtoken_pooling=subword_pooling,
+                fine_tune=fine_tune,
+                use_context=context_size,
+            )
 
     tagger: SequenceTagger = SequenceTagger(
         hidden_size=256,
@@ -100,12 +375,50 @@ def run_experiment(seed: int, batch_size: int, epoch: int, learning_rate: float,
         reproject_embeddings=False,
     )
 
+    return tagger
+
+
+def get_token_budget_batching(batch_size: int, json_config: dict) -> Optional[TokenBudgetBatching]:
+    # With "batching": "tokens" or "bytes", batch sizes of the grid are budgets (padded length of a mini-batch)
+    batching = json_config["batching"] if "batching" in json_config else "sentences"
+    eval_budget_factor = json_config["eval_budget_factor"] if "eval_budget_factor" in json_config else 4
+    batching_pool_size = json_config["batching_pool_size"] if "batching_pool_size" in json_config else 1000
+
+    if batching == "sentences":
+        return None
+
+    logger.info("Batching: at most {} {} per mini-batch ({} for evaluation)".format(
+        batch_size, batching, batch_size * eval_budget_factor))
+
+    return TokenBudgetBatching(batching, batch_size, batch_size * eval_budget_factor, batching_pool_size)
+
+
+def run_experiment(seed: int, batch_size: int, epoch: int, learning_rate: float, subword_pooling: str,
+                   hipe_datasets: List[str], json_config: dict, pause_after_epoch: Optional[int] = None):
+    label_name_map = json_config["label_name_map"] if "label_name_map" in json_config else None
+    use_tensorboard_logger = json_config["use_tensorboard_logger"] if "use_tensorboard_logger" in json_config else False
+    corpus_cache_dir = json_config["corpus_cache_dir"] if "corpus_cache_dir" in json_config else None
+    corpus_workers = json_config["corpus_workers"] if "corpus_workers" in json_config else 1
+    checkpoint_every_k_epochs = json_config["checkpoint_every_k_epochs"] if "checkpoint_every_k_epochs" in json_config else 0
+    profile_training = json_config["profile_training"] if "profile_training" in json_config else False
+
+    # Set seed for reproducibility
+    set_seed(seed)
+
+    # Dataset-related
+    corpora, label_dictionary = get_corpora(hipe_datasets, label_name_map, corpus_cache_dir, corpus_workers)
+
+    tagger = create_tagger(subword_pooling, label_dictionary, json_config)
+
+    # Autocast and torch.compile, with fallbacks for devices that do not support them
+    precision, compile_mode = get_execution_mode(json_config, flair.device)
+    compile_tagger(tagger, compile_mode)
+
     # Trainer
     trainer: ModelTrainer = ModelTrainer(tagger, corpora)
 
-    dataset_identifier = hipe_datasets[0] if len(hipe_datasets) == 1 else "mhmner"
-
-    output_path = f"hmbench-{dataset_identifier}-{hf_model}-bs{batch_size}-ws{context_size}-e{epoch}-lr{learning_rate}-pooling{subword_pooling}-layers{layers}-crf{use_crf}-{seed}"
+    output_path = get_output_path(seed, batch_size, epoch, learning_rate, subword_pooling, hipe_datasets, json_config,
+                                  (precision, compile_mode))
 
     plugins = []
 
@@ -117,42 +430,183 @@ def run_experiment(seed: int, batch_size: int, epoch: int, learning_rate: float,
 
         plugins.append(TensorboardLogger(log_dir=str(tb_path), comment=output_path))
 
-    trainer.fine_tune(
-        output_path,
-        learning_rate=learning_rate,
-        mini_batch_size=batch_size,
-        max_epochs=epoch,
-        shuffle=True,
-        embeddings_storage_mode='none',
-        weight_decay=0.,
-        use_final_model_for_eval=False,
-        plugins=plugins,
-    )
+    plugins.append(ExecutionModePlugin(precision, compile_mode))
+
+    # Interrupted runs are resumed from their last checkpoint
+    start_epoch = 0
+    checkpoint_plugin = None
+
+    # Successive halving pauses runs at a rung, they are continued from the checkpoint of that epoch. A run, that was
+    # paused or interrupted, is always resumed from its checkpoint, also without periodic checkpoints
+    checkpoint_file = Path(output_path) / EpochCheckpointPlugin.checkpoint_name
+
+    if checkpoint_every_k_epochs > 0 or pause_after_epoch is not None or checkpoint_file.exists():
+        checkpoint_plugin = EpochCheckpointPlugin(output_path, checkpoint_every_k_epochs, pause_after_epoch)
+        start_epoch = checkpoint_plugin.load()
+        plugins.append(checkpoint_plugin)
+
+    # After the checkpoint plugin, so that writing checkpoints is not measured as a training phase
+    if profile_training:
+        logger.info("Profiling of training steps is enabled")
+        plugins.append(ProfilingPlugin(output_path))
+
+    if pause_after_epoch is not None and start_epoch >= pause_after_epoch:
+        logger.info("Run is already trained until epoch {}".format(pause_after_epoch))
+        return
+
+    token_budget_batching = get_token_budget_batching(batch_size, json_config)
+    mini_batch_size = batch_size
+
+    if token_budget_batching is not None:
+        mini_batch_size = token_budget_batching.mini_batch_size(corpora.train)
+        logger.info("Average mini-batch size: {} sentences".format(mini_batch_size))
+
+    try:
+        with token_budget_batching.patch() if token_budget_batching else contextlib.nullcontext():
+            trainer.fine_tune(
+                output_path,
+                epoch=start_epoch,
+                learning_rate=learning_rate,
+                mini_batch_size=mini_batch_size,
+                max_epochs=epoch,
+                shuffle=True,
+                embeddings_storage_mode='none',
+                weight_decay=0.,
+                use_final_model_for_eval=False,
+                use_amp=precision != "fp32",
+                plugins=plugins,
+            )
+    except TrainingPaused as e:
+        logger.info(str(e))
+        return
+
+    if checkpoint_plugin is not None:
+        checkpoint_plugin.remove()
 
     # Finally, print model card for information
     tagger.print_model_card()
 
 
+def expand_grid(hipe_datasets: List[str], json_config: dict) -> List[GridJob]:
+    execution_mode = get_grid_execution_mode(json_config)
+
+    # Same order as the former nested loops: seeds, batch sizes, epochs, learning rates and subword poolings
+    return [
+        GridJob(seed, batch_size, epoch, learning_rate, subword_pooling,
+                get_output_path(seed, batch_size, epoch, learning_rate, subword_pooling, hipe_datasets, json_config,
+                                execution_mode))
+        for seed in json_config["seeds"]
+        for batch_size in json_config["batch_sizes"]
+        for epoch in json_config["epochs"]
+        for learning_rate in json_config["learning_rates"]
+        for subword_pooling in json_config["subword_poolings"]
+    ]
+
+
+def get_worker_slots(json_config: dict) -> List[WorkerSlot]:
+    # Without "devices", all runs use the single "cuda" device, one after another
+    devices = json_config["devices"] if "devices" in json_config else [f'cuda:{json_config["cuda"]}']
+    threads_per_worker = json_config["threads_per_worker"] if "threads_per_worker" in json_config else None
+    cpu_affinity = json_config["cpu_affinity"] if "cpu_affinity" in json_config else True
+
+    return make_worker_slots(devices, threads_per_worker, cpu_affinity)
+
+
+def get_grid_manifest(json_config: dict) -> GridManifest:
+    return GridManifest(json_config["grid_manifest"] if "grid_manifest" in json_config else "grid-manifest.json")
+
+
+def run_job(job: GridJob, hipe_datasets: List[str], json_config: dict):
+    run_experiment(job.seed, job.batch_size, job.epoch, job.learning_rate, job.subword_pooling, hipe_datasets,
+                   json_config, job.pause_after_epoch)  # pylint: disable=no-value-for-parameter
+
+
+def run_hyperparameter_search(hipe_datasets: List[str], json_config: dict, on_job_done=None):
+    jobs = expand_grid(hipe_datasets, json_config)
+    run_fn = functools.partial(run_job, hipe_datasets=hipe_datasets, json_config=json_config)
+
+    slots = get_worker_slots(json_config)
+    manifest = get_grid_manifest(json_config)
+    skip_completed = json_config["skip_completed_runs"] if "skip_completed_runs" in json_config else True
+
+    # With rungs (epochs, e.g. [2, 4]), configurations with a low dev score are stopped early
+    rungs = json_config["successive_halving_rungs"] if "successive_halving_rungs" in json_config else []
+    reduction_factor = json_config["successive_halving_reduction_factor"] \
+        if "successive_halving_reduction_factor" in json_config else 2
+
+    if rungs:
+        logger.info("Successive halving at epochs {} with reduction factor {}".format(rungs, reduction_factor))
+        run_successive_halving(jobs, run_fn, slots, rungs, reduction_factor, on_job_done=on_job_done,
+                               manifest=manifest, skip_completed=skip_completed)
+    else:
+        run_grid(jobs, run_fn, slots, on_job_done=on_job_done, manifest=manifest, skip_completed=skip_completed)
+
+
+def estimate_grid_cost(hipe_datasets: List[str], json_config: dict):
+    # Dry run: projects time and memory of every run from corpus statistics and a few timed training steps
+    hf_model = json_config["hf_model"]
+    label_name_map = json_config["label_name_map"] if "label_name_map" in json_config else None
+    corpus_cache_dir = json_config["corpus_cache_dir"] if "corpus_cache_dir" in json_config else None
+    corpus_workers = json_config["corpus_workers"] if "corpus_workers" in json_config else 1
+    calibration_steps = json_config["calibration_steps"] if "calibration_steps" in json_config else 5
+
+    jobs = expand_grid(hipe_datasets, json_config)
+    slots = get_worker_slots(json_config)
+
+    # Calibration runs on the device of the first worker
+    flair.device = torch.device(slots[0].device)
+
+    corpora, label_dictionary = get_corpora(hipe_datasets, label_name_map, corpus_cache_dir, corpus_workers)
+
+    statistics_key = {
+        "datasets": hipe_datasets,
+        "version": HIPE_2022_VERSION,
+        "label_name_map": label_name_map,
+        "hf_model": hf_model,
+        "preprocessing": preprocessing_code_hash(),
+    }
+    statistics = load_corpus_statistics(
+        corpus_cache_dir, statistics_key,
+        lambda: compute_corpus_statistics(corpora, get_subword_counter(hf_model)),
+    )
+
+    # torch.compile is not calibrated: its compilation would dominate the few timed steps
+    precision, _ = get_execution_mode(json_config, flair.device)
+
+    # Time per token mainly depends on the batch size, subword pooling and learning rate hardly matter
+    calibrations = {}
+    for batch_size in json_config["batch_sizes"]:
+        set_seed(json_config["seeds"][0])
+        tagger = create_tagger(json_config["subword_poolings"][0], copy.deepcopy(label_dictionary), json_config)
+
+        token_budget_batching = get_token_budget_batching(batch_size, json_config)
+        make_batches = token_budget_batching.train_batches if token_budget_batching else None
+
+        calibrations[batch_size] = calibrate(tagger, list(corpora.train), batch_size, calibration_steps,
+                                             make_batches=make_batches, precision=precision)
+        logger.info("Calibration: {}".format(calibrations[batch_size]))
+
+        del tagger
+        if flair.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    estimates = [estimate_run(job, statistics, calibrations[job.batch_size]) for job in jobs]
+
+    if "successive_halving_rungs" in json_config:
+        logger.info("Successive halving is enabled: projections assume, that no run is pruned")
+
+    log_grid_estimate(statistics, estimates, len(slots))
+
+
 if __name__ == "__main__":
     filename = sys.argv[1]
     with open(filename, "rt") as f_p:
         json_config = json.load(f_p)
 
-    seeds = json_config["seeds"]
-    batch_sizes = json_config["batch_sizes"]
-    epochs = json_config["epochs"]
-    learning_rates = json_config["learning_rates"]
-    subword_poolings = json_config["subword_poolings"]
-
     hipe_datasets = json_config["hipe_datasets"]  # Do not iterate over them
 
-    cuda = json_config["cuda"]
-    flair.device = f'cuda:{cuda}'
-
-    for seed in seeds:
-        for batch_size in batch_sizes:
-            for epoch in epochs:
-                for learning_rate in learning_rates:
-                    for subword_pooling in subword_poolings:
-                        run_experiment(seed, batch_size, epoch, learning_rate, subword_pooling, hipe_datasets,
-                                       json_config)  # pylint: disable=no-value-for-parameter
+    # python3 flair-fine-tuner.py config.json --dry-run: only estimate the cost of the grid
+    if "--dry-run" in sys.argv[2:]:
+        estimate_grid_cost(hipe_datasets, json_config)
+    else:
+        run_hyperparameter_search(hipe_datasets, json_config)
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import math
+import random
+import resource
+import time
+import flair
+import torch
+
+from flair.data import Corpus, Sentence
+from flair.models import SequenceTagger
+from pathlib import Path
+from tabulate import tabulate
+from transformers import AutoTokenizer
+
+from typing import Callable, List, NamedTuple, Optional, Union
+
+from execution_modes import autocast_dtype
+from grid_scheduler import GridJob, is_run_completed
+
+logger = logging.getLogger("flair")
+
+SPLITS = ["train", "dev", "test"]
+
+
+def compute_corpus_statistics(corpus: Corpus, count_subwords: Optional[Callable[[Sentence], int]] = None) -> dict:
+    """Returns number of sentences, tokens, UTF-8 bytes and subwords (or bytes for ByT5) per split."""
+    statistics = {}
+
+    for split in SPLITS:
+        sentences = getattr(corpus, split) or []
+
+        statistics[split] = {
+            "sentences": len(sentences),
+            "tokens": sum(len(sentence) for sentence in sentences),
+            "bytes": sum(len(sentence.to_original_text().encode("utf-8")) for sentence in sentences),
+            "subwords": sum(count_subwords(sentence) for sentence in sentences) if count_subwords else None,
+        }
+
+    return statistics
+
+
+def get_subword_counter(hf_model: str) -> Callable[[Sentence], int]:
+    if "byt5" in hf_model:
+        # ByT5 works on the UTF-8 bytes of the text
+        return lambda sentence: len(sentence.to_original_text().encode("utf-8"))
+
+    tokenizer = AutoTokenizer.from_pretrained(hf_model)
+    return lambda sentence: len(tokenizer.tokenize(sentence.to_tokenized_string()))
+
+
+def load_corpus_statistics(
+    cache_dir: Optional[Union[str, Path]], key: dict, compute_fn: Callable[[], dict]
+) -> dict:
+    # Statistics are cached next to the corpus cache (if enabled), computing subword lengths of large corpora takes a
+    # while
+    if cache_dir is None:
+        return compute_fn()
+
+    key_hash = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+    cache_file = Path(cache_dir) / "statistics" / f"{key_hash}.json"
+
+    if cache_file.exists():
+        logger.info(f"Loading corpus statistics from {cache_file}")
+        return json.loads(cache_file.read_text())["statistics"]
+
+    statistics = compute_fn()
+
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = cache_file.with_suffix(".tmp")
+    temp_file.write_text(json.dumps({"key": key, "statistics": statistics}, indent=2, sort_keys=True) + "\n")
+    temp_file.replace(cache_file)
+
+    return statistics
+
+
+class Calibration(NamedTuple):
+    batch_size: int
+    # Measured on a few mini-batches of training data
+    seconds_per_train_token: float
+    seconds_per_eval_token: float
+    peak_memory_mb: float
+
+
+def _peak_memory_mb() -> float:
+    if flair.device.type == "cuda":
+        return torch.cuda.max_memory_allocated(flair.device) / 2**20
+
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _now() -> float:
+    if flair.device.type == "cuda":
+        torch.cuda.synchronize(flair.device)
+    return time.perf_counter()
+
+
+def calibrate(
+    tagger: SequenceTagger,
+    sentences: List[Sentence],
+    batch_size: int,
+    steps: int = 5,
+    seed: int = 42,
+    make_batches: Optional[Callable[[List[Sentence]], List[List[Sentence]]]] = None,
+    precision: str = "fp32",
+) -> Calibration:
+    """Times `steps` training steps (forward, backward and optimizer step) and the prediction of the same batches.
+
+    One additional step is done before, so that lazy initialization (e.g. of CUDA kernels) is not measured. Batches
+    are random samples of `batch_size` sentences, or the first batches of `make_batches` (e.g. token budget batches).
+    If `make_batches` returns a single batch only (small corpora or large budgets), that step is measured as well.
+    With a `precision` of "bf16" or "fp16", the forward pass runs with autocast, as in training.
+    """
+    if make_batches is not None:
+        batches = make_batches(sentences)[: steps + 1]
+    else:
+        generator = random.Random(seed)
+        batches = [generator.sample(sentences, min(batch_size, len(sentences))) for _ in range(steps + 1)]
+
+    if flair.device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(flair.device)
+
+    tagger.to(flair.device)
+    tagger.train()
+
+    # Same optimizer as used by fine_tune
+    optimizer = torch.optim.AdamW(tagger.parameters(), lr=5e-5, weight_decay=0.0)
+
+    if not batches or not any(batches):
+        raise ValueError("Calibration needs at least one non-empty batch of training sentences")
+
+    # Steps, that are measured
+    measured_steps = range(1, len(batches)) if len(batches) > 1 else range(len(batches))
+
+    train_time = 0.0
+    train_tokens = 0
+
+    for step, batch in enumerate(batches):
+        start_time = _now()
+
+        tagger.zero_grad()
+        with autocast_dtype(flair.device, precision), torch.autocast(flair.device.type, enabled=precision != "fp32"):
+            loss, number_of_labels = tagger.forward_loss(batch)
+        loss.backward()
+        optimizer.step()
+
+        elapsed = _now() - start_time
+
+        for sentence in batch:
+            sentence.clear_embeddings()
+
+        if step in measured_steps:
+            train_time += elapsed
+            train_tokens += sum(len(sentence) for sentence in batch)
+
+    tagger.eval()
+
+    eval_time = 0.0
+    for batch in [batches[step] for step in measured_steps]:
+        start_time = _now()
+        tagger.predict(batch, mini_batch_size=len(batch), label_name="calibration", embedding_storage_mode="none")
+        eval_time += _now() - start_time
+
+        for sentence in batch:
+            sentence.remove_labels("calibration")
+
+    return Calibration(batch_size, train_time / train_tokens, eval_time / train_tokens, _peak_memory_mb())
+
+
+class RunEstimate(NamedTuple):
+    job: GridJob
+    train_tokens: int
+    seconds: float
+    tokens_per_second: float
+    peak_memory_mb: float
+    completed: bool
+
+
+def estimate_run(job: GridJob, statistics: dict, calibration: Calibration) -> RunEstimate:
+    train_tokens = statistics["train"]["tokens"] * job.epoch
+
+    # Dev set is evaluated after every epoch, test set once at the end
+    eval_tokens = statistics["dev"]["tokens"] * job.epoch + statistics["test"]["tokens"]
+
+    seconds = train_tokens * calibration.seconds_per_train_token + eval_tokens * calibration.seconds_per_eval_token
+
+    return RunEstimate(
+        job=job,
+        train_tokens=train_tokens,
+        seconds=seconds,
+        tokens_per_second=1 / calibration.seconds_per_train_token,
+        peak_memory_mb=calibration.peak_memory_mb,
+        completed=is_run_completed(job.output_path),
+    )
+
+
+def format_duration(seconds: float) -> str:
+    hours, seconds = divmod(int(math.ceil(seconds)), 3600)
+    return f"{hours}h {seconds // 60:02d}m {seconds % 60:02d}s"
+
+
+def log_grid_estimate(statistics: dict, estimates: List[RunEstimate], number_of_workers: int):
+    table = [
+        [split, *[statistics[split][name] for name in ["sentences", "tokens", "bytes", "subwords"]]]
+        for split in SPLITS
+    ]
+    header = ["Split", "Sentences", "Tokens", "Bytes", "Subwords"]
+    logger.info("Corpus statistics:\n" + tabulate(table, headers=header, tablefmt="github"))
+
+    table = [
+        [
+            estimate.job.output_path,
+            estimate.train_tokens,
+            round(estimate.tokens_per_second, 1),
+            round(estimate.peak_memory_mb, 1),
+            "completed" if estimate.completed else format_duration(estimate.seconds),
+        ]
+        for estimate in estimates
+    ]
+    header = ["Output path", "Training tokens", "Tokens/s", "Peak memory (MB)", "Projected time"]
+    logger.info("Projected runs:\n" + tabulate(table, headers=header, tablefmt="github"))
+
+    pending_estimates = [estimate for estimate in estimates if not estimate.completed]
+    total_seconds = sum(estimate.seconds for estimate in pending_estimates)
+
+    # Assumes that runs keep all workers busy, and that workers do not slow each other down
+    logger.info(
+        "Grid: {} of {} runs to do, {} training tokens, {} of compute, about {} wall time on {} worker(s), "
+        "peak memory per worker {:.1f} MB".format(
+            len(pending_estimates),
+            len(estimates),
+            sum(estimate.train_tokens for estimate in pending_estimates),
+            format_duration(total_seconds),
+            format_duration(total_seconds / number_of_workers),
+            number_of_workers,
+            max((estimate.peak_memory_mb for estimate in estimates), default=0.0),
+        )
+    )
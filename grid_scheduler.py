@@ -0,0 +1,384 @@
+import contextlib
+import fcntl
+import json
+import logging
+import math
+import multiprocessing
+import os
+import time
+import flair
+import torch
+
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from tabulate import tabulate
+
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from trainer_plugins import EpochCheckpointPlugin
+
+logger = logging.getLogger("flair")
+
+# Console output of a job, that runs in a worker, is written to this file in its output path
+JOB_LOG_NAME = "job.log"
+
+
+class GridJob(NamedTuple):
+    seed: int
+    batch_size: int
+    epoch: int
+    learning_rate: float
+    subword_pooling: str
+    output_path: str
+    # Training stops after this epoch and is continued by a later job (successive halving)
+    pause_after_epoch: Optional[int] = None
+
+    @property
+    def configuration(self) -> Tuple[int, int, float, str]:
+        # All seeds of a configuration are kept or pruned together
+        return self.batch_size, self.epoch, self.learning_rate, self.subword_pooling
+
+
+def is_run_completed(output_path: Union[str, Path]) -> bool:
+    # A finished run has a model and the final test score in its training.log
+    output_path = Path(output_path)
+    training_log = output_path / "training.log"
+
+    if not (output_path / "best-model.pt").exists() and not (output_path / "final-model.pt").exists():
+        return False
+
+    return training_log.exists() and "F-score (micro" in training_log.read_text(encoding="utf-8", errors="replace")
+
+
+def read_dev_scores(output_path: Union[str, Path]) -> List[float]:
+    # Dev micro-F1 of every epoch so far, as logged by the trainer, e.g. "DEV : loss 0.42 - f1-score (micro avg)  0.81"
+    training_log = Path(output_path) / "training.log"
+
+    if not training_log.exists():
+        return []
+
+    with open(training_log, "rt", encoding="utf-8", errors="replace") as f_p:
+        return [float(line.rstrip().split(" ")[-1]) for line in f_p if "f1-score (micro avg)" in line]
+
+
+class GridManifest:
+    """JSON file, that records the state of every grid point ("done", "running" or "failed") by its output path.
+
+    Finished runs, that were passed to `on_job_done` of the grid (e.g. uploaded), are marked as "reported". Updates
+    are done under a file lock and written atomically, so that workers and several grids can share one manifest.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def read(self) -> Dict[str, dict]:
+        if not self.path.exists():
+            return {}
+
+        return json.loads(self.path.read_text())
+
+    @contextlib.contextmanager
+    def _locked_entries(self):
+        with open(self.path.with_name(self.path.name + ".lock"), "w") as lock_f_p:
+            fcntl.flock(lock_f_p, fcntl.LOCK_EX)
+            try:
+                entries = self.read()
+                yield entries
+
+                temp_file = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+                temp_file.write_text(json.dumps(entries, indent=2, sort_keys=True) + "\n")
+                os.replace(temp_file, self.path)
+            finally:
+                fcntl.flock(lock_f_p, fcntl.LOCK_UN)
+
+    def update(self, output_path: str, status: str, **info):
+        with self._locked_entries() as entries:
+            entries[output_path] = {"status": status, "time": time.strftime("%Y-%m-%d %H:%M:%S"), **info}
+
+    def mark(self, output_path: str, **info):
+        # Adds to the entry of a run, without changing its state
+        with self._locked_entries() as entries:
+            entries.setdefault(output_path, {}).update(info)
+
+    def is_reported(self, output_path: str) -> bool:
+        entries = self.read()
+        return output_path in entries and entries[output_path].get("reported", False)
+
+
+class WorkerSlot(NamedTuple):
+    device: str
+    # Number of PyTorch threads and the cores, that the worker is pinned to (empty: no pinning)
+    threads: int
+    cpus: Tuple[int, ...] = ()
+
+
+def make_worker_slots(
+    devices: Sequence[str], threads_per_worker: Optional[int] = None, cpu_affinity: bool = True
+) -> List[WorkerSlot]:
+    """Returns one worker slot per device entry, e.g. ["cuda:0", "cuda:1"] or ["cpu", "cpu", "cpu", "cpu"].
+
+    Available cores are split evenly between the slots, so that concurrent workers do not oversubscribe them.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+
+    if threads_per_worker is None:
+        threads_per_worker = max(len(cores) // len(devices), 1)
+
+    slots = []
+    for slot_index, device in enumerate(devices):
+        cpus: Tuple[int, ...] = ()
+
+        if cpu_affinity:
+            first_core = slot_index * threads_per_worker
+            cpus = tuple(sorted({cores[(first_core + index) % len(cores)] for index in range(threads_per_worker)}))
+
+        slots.append(WorkerSlot(device, threads_per_worker, cpus))
+
+    return slots
+
+
+# Slot of the current worker process
+_worker_slot: Optional[WorkerSlot] = None
+
+
+def _init_worker(slot_queue: multiprocessing.Queue):
+    global _worker_slot
+
+    # Every worker takes exactly one slot
+    _worker_slot = slot_queue.get()
+
+    if _worker_slot.cpus:
+        os.sched_setaffinity(0, _worker_slot.cpus)
+
+    torch.set_num_threads(_worker_slot.threads)
+    flair.device = torch.device(_worker_slot.device)
+
+
+@contextlib.contextmanager
+def _job_logging(log_file: Path):
+    # Flair's console handler keeps a reference to the original stdout, so its stream is replaced as well
+    console_handlers = [
+        handler
+        for handler in logger.handlers
+        if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler)
+    ]
+
+    with open(log_file, "at") as f_p:
+        original_streams = [handler.setStream(f_p) for handler in console_handlers]
+        try:
+            with contextlib.redirect_stdout(f_p), contextlib.redirect_stderr(f_p):
+                yield
+        finally:
+            for handler, stream in zip(console_handlers, original_streams):
+                handler.setStream(stream)
+
+
+def _run_job(
+    run_fn: Callable[[GridJob], None], job: GridJob, manifest: Optional[GridManifest], redirect_logs: bool = True
+) -> Tuple[WorkerSlot, float]:
+    start_time = time.perf_counter()
+    device = str(flair.device)
+
+    Path(job.output_path).mkdir(parents=True, exist_ok=True)
+
+    if manifest is not None:
+        manifest.update(job.output_path, "running", device=device, pid=os.getpid())
+
+    job_logging = _job_logging(Path(job.output_path) / JOB_LOG_NAME) if redirect_logs else contextlib.nullcontext()
+
+    with job_logging:
+        try:
+            run_fn(job)
+        except Exception as e:
+            logger.exception(f"Job {job.output_path} failed")
+
+            if manifest is not None:
+                manifest.update(job.output_path, "failed", device=device, error=repr(e))
+            raise
+
+    elapsed = time.perf_counter() - start_time
+
+    if manifest is not None:
+        status = "done" if job.pause_after_epoch is None else "paused"
+        manifest.update(job.output_path, status, device=device, time_in_seconds=round(elapsed, 1))
+
+    return _worker_slot, elapsed
+
+
+def _report_job(job: GridJob, on_job_done: Optional[Callable[[GridJob], None]], manifest: Optional[GridManifest]):
+    if on_job_done is None:
+        return
+
+    on_job_done(job)
+
+    if manifest is not None:
+        manifest.mark(job.output_path, reported=True)
+
+
+def run_grid(
+    jobs: List[GridJob],
+    run_fn: Callable[[GridJob], None],
+    slots: List[WorkerSlot],
+    on_job_done: Optional[Callable[[GridJob], None]] = None,
+    manifest: Optional[GridManifest] = None,
+    skip_completed: bool = True,
+):
+    """Runs all jobs of a hyper-parameter grid, concurrently on the given worker slots.
+
+    With a single slot, jobs run one after another in the current process (as before). Otherwise every slot is a
+    worker process, that is pinned to its device and cores. `run_fn` must be picklable, `on_job_done` is called in the
+    current process, whenever a job has finished.
+
+    Jobs, whose output path already holds a completed run, are skipped. The state of every job is recorded in the
+    optional manifest. `on_job_done` is also called for skipped runs, that are not marked as reported in the manifest,
+    e.g. when the process died after training, before the run was uploaded. Without a manifest, it is called for all
+    skipped runs.
+    """
+    if skip_completed:
+        completed_jobs = [job for job in jobs if is_run_completed(job.output_path)]
+
+        for job in completed_jobs:
+            logger.info(f"Skipping completed run {job.output_path}")
+
+            reported = manifest is not None and manifest.is_reported(job.output_path)
+
+            if manifest is not None:
+                manifest.update(job.output_path, "done", skipped=True, reported=reported)
+
+            if not reported:
+                _report_job(job, on_job_done, manifest)
+
+        jobs = [job for job in jobs if job not in completed_jobs]
+
+    if len(slots) == 1:
+        flair.device = torch.device(slots[0].device)
+
+        for job in jobs:
+            _run_job(run_fn, job, manifest, redirect_logs=False)
+            _report_job(job, on_job_done, manifest)
+
+        return
+
+    logger.info(f"Running {len(jobs)} jobs on {len(slots)} workers:")
+    for slot in slots:
+        logger.info(f"  {slot.device} with {slot.threads} thread(s) on cores {list(slot.cpus) or 'all'}")
+
+    # CUDA cannot be used in forked processes
+    context = multiprocessing.get_context("spawn")
+
+    slot_queue = context.Queue()
+    for slot in slots:
+        slot_queue.put(slot)
+
+    start_time = time.perf_counter()
+    table = []
+    failed_jobs: Dict[str, BaseException] = {}
+
+    with ProcessPoolExecutor(
+        max_workers=len(slots), mp_context=context, initializer=_init_worker, initargs=(slot_queue,)
+    ) as executor:
+        futures: Dict[Future, GridJob] = {executor.submit(_run_job, run_fn, job, manifest): job for job in jobs}
+        pending = set(futures)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                job = futures[future]
+
+                try:
+                    slot, elapsed = future.result()
+                except Exception as e:
+                    # Other jobs of the grid are still run
+                    logger.error(f"Job {job.output_path} failed: {e!r}, see {Path(job.output_path) / JOB_LOG_NAME}")
+                    failed_jobs[job.output_path] = e
+                    table.append([job.output_path, "-", "failed"])
+                    continue
+
+                logger.info(f"Job {job.output_path} finished on {slot.device} in {elapsed:.1f}s")
+                table.append([job.output_path, slot.device, round(elapsed, 1)])
+
+                _report_job(job, on_job_done, manifest)
+
+    logger.info("Grid jobs:\n" + tabulate(table, headers=["Output path", "Device", "Time (s)"], tablefmt="github"))
+    logger.info(f"Finished {len(jobs)} jobs in {time.perf_counter() - start_time:.1f}s")
+
+    if failed_jobs:
+        raise RuntimeError(f"{len(failed_jobs)} of {len(jobs)} jobs failed: {', '.join(failed_jobs)}")
+
+
+def run_successive_halving(
+    jobs: List[GridJob],
+    run_fn: Callable[[GridJob], None],
+    slots: List[WorkerSlot],
+    rungs: Sequence[int],
+    reduction_factor: int = 2,
+    on_job_done: Optional[Callable[[GridJob], None]] = None,
+    manifest: Optional[GridManifest] = None,
+    skip_completed: bool = True,
+):
+    """Runs a hyper-parameter grid with successive halving: configurations, that are hopeless, are stopped early.
+
+    All runs are trained until the first rung (epoch) and paused there. Configurations are ranked by the best dev
+    micro-F1 so far, averaged over their seeds, and only the best 1 / `reduction_factor` of them are continued to the
+    next rung. The remaining configurations are trained until their last epoch, so all of their seeds finish and are
+    reported as before. A configuration only takes part in the rungs before its last epoch.
+
+    `run_fn` has to stop training after `job.pause_after_epoch` and continue a paused run (see `EpochCheckpointPlugin`).
+    `on_job_done` is only called for finished runs.
+    """
+    surviving_jobs = list(jobs)
+
+    for rung in sorted(rungs):
+        rung_jobs = [job for job in surviving_jobs if job.epoch > rung]
+
+        if not rung_jobs:
+            continue
+
+        # Runs, that already reached the rung (e.g. in an interrupted grid), are not trained again
+        pending_jobs = [
+            job._replace(pause_after_epoch=rung)
+            for job in rung_jobs
+            if not skip_completed or len(read_dev_scores(job.output_path)) < rung
+        ]
+
+        logger.info(f"Successive halving: training {len(pending_jobs)} of {len(rung_jobs)} runs until epoch {rung}")
+        run_grid(pending_jobs, run_fn, slots, manifest=manifest, skip_completed=skip_completed)
+
+        configuration_scores: Dict[tuple, List[float]] = {}
+        for job in rung_jobs:
+            dev_scores = read_dev_scores(job.output_path)[:rung]
+            configuration_scores.setdefault(job.configuration, []).append(max(dev_scores) if dev_scores else 0.0)
+
+        mean_scores = {
+            configuration: sum(scores) / len(scores) for configuration, scores in configuration_scores.items()
+        }
+
+        # Ties keep the order of the grid
+        ranking = sorted(mean_scores, key=lambda configuration: mean_scores[configuration], reverse=True)
+        kept_configurations = set(ranking[: max(math.ceil(len(ranking) / reduction_factor), 1)])
+
+        table = [
+            [*configuration, round(mean_scores[configuration] * 100, 2),
+             "kept" if configuration in kept_configurations else "pruned"]
+            for configuration in ranking
+        ]
+        header = ["Batch size", "Epochs", "Learning rate", "Subword pooling", f"Dev F1 until epoch {rung}", "Status"]
+        logger.info(f"Successive halving at epoch {rung}:\n" + tabulate(table, headers=header, tablefmt="github"))
+
+        for job in rung_jobs:
+            if job.configuration in kept_configurations:
+                continue
+
+            # Pruned runs are not continued, their checkpoint is no longer needed
+            (Path(job.output_path) / EpochCheckpointPlugin.checkpoint_name).unlink(missing_ok=True)
+
+            if manifest is not None:
+                manifest.update(job.output_path, "pruned", epoch=rung, dev_score=mean_scores[job.configuration])
+
+        surviving_jobs = [
+            job for job in surviving_jobs if job.epoch <= rung or job.configuration in kept_configurations
+        ]
+
+    logger.info(f"Successive halving: finishing {len(surviving_jobs)} of {len(jobs)} runs")
+    run_grid(surviving_jobs, run_fn, slots, on_job_done=on_job_done, manifest=manifest, skip_completed=skip_completed)
@@ -0,0 +1,280 @@
+# Benchmarks for the HIPE-2022 preprocessing in utils.py, on synthetic HIPE-2022 files
+#
+# Usage:
+# $ python3 preprocessing-benchmark.py generate --dataset newseye/fi --documents 1000 --output newseye-fi.tsv
+# $ python3 preprocessing-benchmark.py speed [--documents 20000 --datasets hipe2020/fr newseye/de]
+# $ python3 preprocessing-benchmark.py golden [--update]
+#
+# The golden check compares the preprocessed outputs of fixed synthetic files with the digests stored in
+# preprocessing-golden.json. These digests were produced by the original prepare_* functions, so a changed digest means
+# that a preprocessing change also changed the produced corpora.
+import argparse
+import hashlib
+import json
+import multiprocessing
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from pathlib import Path
+from tabulate import tabulate
+
+from typing import Dict, List, Optional
+
+from utils import get_preproc_fn, get_preprocessing_stages
+
+HIPE_2022_HEADER = [
+    "TOKEN", "NE-COARSE-LIT", "NE-COARSE-METO", "NE-FINE-LIT", "NE-FINE-METO", "NE-FINE-COMP", "NE-NESTED",
+    "NEL-LIT", "NEL-METO", "MISC",
+]
+
+# Same markers as used by Flair's NER_HIPE_2022 dataset
+EOS_MARKER = "EndOfSentence"
+
+SYNTHETIC_ENTITY_TYPES = ["pers", "loc", "org", "work", "scope"]
+
+SYNTHETIC_WORDS = [
+    "Der", "die", "das", "und", "Stadt", "Regierung", "Zeitung", "ſeine", "Majeſtät", "König", "Berlin", "Paris",
+    "Helsingfors", "Stockholm", "Versammlung", "geſtern", "Uhr", "1848", "Mr.", "Herrn", "Départements",
+    "l'Assemblée", "öffentlichen", "Hülfe", "ja", "och", "että", "ὁ", "καὶ", "Sophocles", "v.", ",", ".", ";",
+]
+
+# One dataset per preprocessor
+BENCHMARK_DATASETS = ["ajmc/de", "hipe2020/fr", "newseye/fi", "newseye/sv", "newseye/de", "newseye/fr"]
+
+GOLDEN_FILE = Path(__file__).parent / "preprocessing-golden.json"
+
+# Synthetic files of the golden check: dataset, seed and number of documents
+GOLDEN_CORPORA = [(dataset, seed, 50) for dataset in BENCHMARK_DATASETS for seed in range(3)]
+
+
+def document_separator(dataset: str) -> str:
+    return "# hipe2022:original_source" if dataset.startswith("ajmc") else "# hipe2022:document_id"
+
+
+def hyphenated_rows(dataset: str, generator: random.Random, token_row) -> List[str]:
+    # Hyphenation as it appears in the different datasets, including cases that must not be de-hyphenated
+    word = generator.choice(["Regierung", "Helsingfors", "Versammlung", "Vereinigten", "Majeſtät"])
+    split = generator.randint(1, len(word) - 1)
+    prefix, suffix = word[:split], word[split:]
+
+    if dataset in ["hipe2020/de", "hipe2020/en", "hipe2020/fr"]:
+        # Standalone "¬" row
+        return [
+            token_row(prefix),
+            token_row("¬", generator.choice(["_", "EndOfLine"])),
+            token_row(generator.choice([suffix, suffix, "¬"]), generator.choice(["_", "EndOfLine"])),
+        ]
+
+    if dataset in ["newseye/fi", "newseye/sv"]:
+        # Standalone "-" row, that is only a hyphenation with "NoSpaceAfter" before it
+        return [
+            token_row(prefix, generator.choice(["NoSpaceAfter", "NoSpaceAfter", "_"])),
+            token_row("-", generator.choice(["NoSpaceAfter", "_", "NoSpaceAfter|EndOfLine"])),
+            token_row(generator.choice([suffix, suffix, "-"])),
+        ]
+
+    if dataset in ["newseye/de", "newseye/fr"]:
+        # Trailing "¬"
+        return [
+            token_row(prefix + "¬", "EndOfLine"),
+            token_row(generator.choice([suffix, suffix, suffix + "¬", "¬"]), "SpaceAfter"),
+        ]
+
+    # Line breaks without hyphenation
+    return [token_row(prefix, "NoSpaceAfter|EndOfLine"), token_row(suffix)]
+
+
+def synthetic_sentence_rows(dataset: str, generator: random.Random, token_row) -> List[str]:
+    sentence_length = min(int(generator.expovariate(1 / 20)) + 1, 120)
+    rows = []
+
+    # Stray markers only follow real tokens, as in the real data
+    previous_is_token = False
+
+    for _ in range(sentence_length):
+        choice = generator.random()
+
+        if choice < 0.08:
+            rows.extend(hyphenated_rows(dataset, generator, token_row))
+        elif choice < 0.10 and previous_is_token:
+            rows.append(token_row(generator.choice(["¬", "-"]), generator.choice(["_", "NoSpaceAfter"])))
+        elif choice < 0.11:
+            # Rows with an empty token
+            rows.append(" \t" + token_row("x")[2:])
+        elif choice < 0.2:
+            entity = generator.choice(SYNTHETIC_ENTITY_TYPES)
+            rows.append(token_row(generator.choice(SYNTHETIC_WORDS), entity=entity))
+        else:
+            misc = generator.choice(["_", "_", "_", "NoSpaceAfter", "EndOfLine", "NoSpaceAfter|EndOfLine"])
+            rows.append(token_row(generator.choice(SYNTHETIC_WORDS), misc))
+
+        previous_is_token = choice >= 0.11 or choice < 0.08
+
+    rows.append(token_row(".", generator.choice([EOS_MARKER, f"{EOS_MARKER}|EndOfLine"])))
+
+    return rows
+
+
+def generate_hipe_corpus(path: Path, dataset: str, number_of_documents: int, seed: int = 42) -> int:
+    """Writes a synthetic HIPE-2022 file and returns its number of lines."""
+    generator = random.Random(seed)
+    dataset_name, language = dataset.split("/")
+
+    def token_row(token: str, misc: str = "_", entity: Optional[str] = None) -> str:
+        coarse = f"B-{entity}" if entity else "O"
+        nel = f"Q{generator.randint(1, 10**6)}" if entity else "_"
+        return "\t".join([token, coarse, "O", coarse, "O", "O", "O", nel, "_", misc])
+
+    number_of_lines = 1
+
+    with open(path, "wt") as f_out:
+        f_out.write("\t".join(HIPE_2022_HEADER) + "\n")
+
+        # Lines are written per document, so that large files can be generated
+        for document_index in range(number_of_documents):
+            lines = [
+                f"{document_separator(dataset)} = {dataset_name}-{language}-{seed}-{document_index}",
+                f"# hipe2022:language = {language}",
+                f"# hipe2022:date = {generator.randint(1790, 1950)}-01-01",
+                "# hipe2022:document_type = newspaper",
+            ]
+
+            for _ in range(generator.randint(1, 8)):
+                lines.extend(synthetic_sentence_rows(dataset, generator, token_row))
+
+            f_out.write("".join(line + "\n" for line in lines))
+            number_of_lines += len(lines)
+
+    return number_of_lines
+
+
+def preprocess(dataset: str, file_in: Path, file_out: Path, add_document_separator: bool = True):
+    dataset_name, language = dataset.split("/")
+    preproc_fn = get_preproc_fn(dataset_name, language)
+    preproc_fn(file_in, file_out, EOS_MARKER, document_separator(dataset), add_document_separator)
+
+
+def describe_stages(dataset: str) -> str:
+    stages = get_preprocessing_stages(*dataset.split("/"))
+    return ", ".join([*stages.normalizers, *filter(None, [stages.dehyphenation]), *stages.postprocessors])
+
+
+def measure_preprocessing(dataset: str, file_in: Path, file_out: Path) -> Dict[str, float]:
+    # Runs in a fresh process, so that the peak memory of one preprocessor does not hide the one of another
+    start_time = time.perf_counter()
+    preprocess(dataset, file_in, file_out)
+    elapsed = time.perf_counter() - start_time
+
+    # ru_maxrss is given in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # Second run for the peak of Python allocations, as tracing slows down preprocessing
+    tracemalloc.start()
+    preprocess(dataset, file_in, file_out)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"elapsed": elapsed, "peak_rss": peak_rss, "peak_traced": peak_traced / 2**20}
+
+
+def benchmark_speed(args):
+    table = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for dataset in args.datasets:
+            file_in = Path(temp_dir) / "input.tsv"
+            file_out = Path(temp_dir) / "output.txt"
+
+            number_of_lines = generate_hipe_corpus(file_in, dataset, args.documents, seed=args.seed)
+            number_of_bytes = file_in.stat().st_size
+
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                result = pool.apply(measure_preprocessing, (dataset, file_in, file_out))
+
+            table.append(
+                [
+                    dataset,
+                    describe_stages(dataset),
+                    number_of_lines,
+                    round(result["elapsed"], 2),
+                    round(number_of_lines / result["elapsed"], 1),
+                    round(number_of_bytes / 2**20 / result["elapsed"], 2),
+                    round(result["peak_rss"], 1),
+                    round(result["peak_traced"], 2),
+                ]
+            )
+
+    header = ["Dataset", "Stages", "Lines", "Time (s)", "Lines/s", "MB/s", "Peak RSS (MB)", "Peak Python heap (MB)"]
+    print(tabulate(table, headers=header, tablefmt="github"))
+
+
+def golden_digests() -> Dict[str, str]:
+    digests = {}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_in = Path(temp_dir) / "input.tsv"
+        file_out = Path(temp_dir) / "output.txt"
+
+        for dataset, seed, number_of_documents in GOLDEN_CORPORA:
+            generate_hipe_corpus(file_in, dataset, number_of_documents, seed=seed)
+
+            for add_document_separator in [True, False]:
+                preprocess(dataset, file_in, file_out, add_document_separator)
+
+                key = f"{dataset}/seed-{seed}/{'with' if add_document_separator else 'without'}_doc_separator"
+                digests[key] = hashlib.sha1(file_out.read_bytes()).hexdigest()
+
+    return digests
+
+
+def check_golden(args):
+    digests = golden_digests()
+
+    if args.update:
+        GOLDEN_FILE.write_text(json.dumps(digests, indent=2, sort_keys=True) + "\n")
+        print(f"Updated {len(digests)} golden digests in {GOLDEN_FILE}")
+        return
+
+    expected_digests = json.loads(GOLDEN_FILE.read_text())
+
+    mismatches = sorted(key for key in expected_digests if digests.get(key) != expected_digests[key])
+
+    for key in mismatches:
+        print(f"Mismatch: {key}")
+
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)} of {len(expected_digests)} preprocessed corpora differ from golden outputs")
+
+    print(f"All {len(expected_digests)} preprocessed corpora match golden outputs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the HIPE-2022 preprocessing")
+    parser.add_argument("--seed", type=int, default=42)
+
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Write a synthetic HIPE-2022 file")
+    generate_parser.add_argument("--dataset", type=str, required=True, help="Hyphenation patterns of e.g. newseye/fi")
+    generate_parser.add_argument("--documents", type=int, default=1000)
+    generate_parser.add_argument("--output", type=Path, required=True)
+
+    speed_parser = subparsers.add_parser("speed", help="Lines/s and peak memory of every preprocessor")
+    speed_parser.add_argument("--datasets", nargs="+", default=BENCHMARK_DATASETS)
+    speed_parser.add_argument("--documents", type=int, default=20000)
+
+    golden_parser = subparsers.add_parser("golden", help="Compare preprocessed outputs with golden outputs")
+    golden_parser.add_argument("--update", action="store_true", help="Store the current outputs as golden outputs")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "generate":
+        number_of_lines = generate_hipe_corpus(args.output, args.dataset, args.documents, seed=args.seed)
+        print(f"Wrote {number_of_lines} lines to {args.output}")
+    elif args.benchmark == "speed":
+        benchmark_speed(args)
+    elif args.benchmark == "golden":
+        check_golden(args)
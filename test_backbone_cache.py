@@ -0,0 +1,60 @@
+import flair
+import torch
+
+from transformers import AutoModel, BertConfig, BertModel
+
+from backbone_cache import BackboneCache
+
+
+def test_backbone_cache_returns_fresh_copies(tiny_bert):
+    cache = BackboneCache()
+    original_from_pretrained = AutoModel.from_pretrained
+
+    with cache.patch():
+        first_model = AutoModel.from_pretrained(tiny_bert)
+        misses = cache.misses
+
+        second_model = AutoModel.from_pretrained(tiny_bert)
+
+    # The second model (and its config) is copied from the cache
+    assert cache.misses == misses
+    assert cache.hits == 1
+    assert AutoModel.from_pretrained == original_from_pretrained
+
+    # Every run trains its own weights
+    assert first_model is not second_model
+    for first_parameter, second_parameter in zip(first_model.parameters(), second_model.parameters()):
+        assert torch.equal(first_parameter, second_parameter)
+        assert first_parameter.data_ptr() != second_parameter.data_ptr()
+
+
+def test_seeded_runs_do_not_depend_on_backbone_cache(tmp_path):
+    # The pooler is not in the checkpoint, it is newly initialized with random numbers
+    config = BertConfig(vocab_size=50, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    BertModel(config, add_pooling_layer=False).save_pretrained(tmp_path)
+
+    seeds = [1, 1, 2, 1]
+
+    def seeded_runs():
+        runs = []
+
+        for seed in seeds:
+            flair.set_seed(seed)
+            model = AutoModel.from_pretrained(tmp_path)
+            # E.g. the tagger head, that is initialized after the backbone
+            runs.append((model.pooler.dense.weight, torch.rand(4)))
+
+        return runs
+
+    expected_runs = seeded_runs()
+
+    cache = BackboneCache()
+    with cache.patch():
+        cached_runs = seeded_runs()
+
+    for (expected_pooler, expected_head), (pooler, head) in zip(expected_runs, cached_runs):
+        assert torch.equal(pooler, expected_pooler)
+        assert torch.equal(head, expected_head)
+
+    # Only the second run has the random state of the cached model
+    assert cache.hits == 1
@@ -0,0 +1,89 @@
+import torch
+
+from flair.data import Sentence
+
+from batching import TokenBudgetBatchSampler, TokenBudgetBatching, get_length_fn, make_budget_batches
+
+
+def test_make_budget_batches():
+    lengths = [3, 4, 2, 10, 1]
+
+    batches = make_budget_batches([0, 1, 2, 3, 4], lengths, budget=8)
+
+    assert batches == [[0, 1], [2], [3], [4]]
+    # Padded size stays within the budget, unless a sentence exceeds it on its own
+    assert all(len(batch) * max(lengths[index] for index in batch) <= 8 or len(batch) == 1 for batch in batches)
+
+
+def test_batch_sampler_covers_every_sentence_once():
+    lengths = [int(length) for length in torch.randint(1, 40, (200,))]
+    sampler = TokenBudgetBatchSampler(lengths, budget=64, shuffle=True, pool_size=50)
+
+    def epoch_batches():
+        # As the trainer: the number of batches is requested first, then the batches are iterated
+        number_of_batches = len(sampler)
+        batches = [batch for batch in sampler]
+
+        assert len(batches) == number_of_batches
+        return batches
+
+    torch.manual_seed(1)
+    batches = epoch_batches()
+
+    assert sorted(index for batch in batches for index in batch) == list(range(200))
+    assert all(len(batch) * max(lengths[index] for index in batch) <= 64 for batch in batches)
+
+    # Every epoch is shuffled again, reproducibly with the seed
+    assert epoch_batches() != batches
+
+    torch.manual_seed(1)
+    assert epoch_batches() == batches
+
+
+def test_byte_lengths():
+    assert get_length_fn("bytes")(Sentence("ſeine Majeſtät")) == len("ſeine Majeſtät".encode("utf-8"))
+    assert get_length_fn("tokens")(Sentence("ſeine Majeſtät")) == 2
+
+
+def test_patch_restores_data_loaders(synthetic_corpus):
+    import flair.trainers.trainer
+
+    original_data_loader = flair.trainers.trainer.DataLoader
+    batching = TokenBudgetBatching("tokens", train_budget=64, eval_budget=256)
+
+    with batching.patch():
+        data_loader = flair.trainers.trainer.DataLoader(synthetic_corpus.train, batch_size=8, shuffle=True)
+        batches = list(data_loader)
+
+    assert flair.trainers.trainer.DataLoader is original_data_loader
+    assert sum(len(batch) for batch in batches) == len(synthetic_corpus.train)
+    assert all(len(batch) * max(len(sentence) for sentence in batch) <= 64 or len(batch) == 1 for batch in batches)
+
+
+def test_output_path_records_batching(fine_tuner):
+    json_config = {
+        "hf_model": "dbmdz/bert-tiny-historic-multilingual-cased",
+        "context_size": 0,
+        "seeds": [1],
+        "batch_sizes": [4096],
+        "epochs": [10],
+        "learning_rates": [5e-5],
+        "subword_poolings": ["first"],
+        "devices": ["cpu"],
+    }
+
+    [sentence_job] = fine_tuner.expand_grid(["newseye/fi"], json_config)
+    assert sentence_job.output_path.endswith("-bs4096-wsFalse-e10-lr5e-05-poolingfirst-layers-1-crfFalse-1")
+
+    # A token budget of 4096 is not a batch size of 4096 sentences
+    json_config["batching"] = "tokens"
+    [token_job] = fine_tuner.expand_grid(["newseye/fi"], json_config)
+    assert token_job.output_path == sentence_job.output_path + "-batchingtokens4096"
+
+    json_config["batching_pool_size"] = 100
+    [pool_job] = fine_tuner.expand_grid(["newseye/fi"], json_config)
+    assert pool_job.output_path == sentence_job.output_path + "-batchingtokens4096-pool100"
+
+    json_config["precision"] = "bf16"
+    [bf16_job] = fine_tuner.expand_grid(["newseye/fi"], json_config)
+    assert bf16_job.output_path == pool_job.output_path + "-precisionbf16"
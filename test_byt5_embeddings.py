@@ -0,0 +1,211 @@
+import torch
+
+from flair.data import Sentence
+
+from byt5_embeddings import ByT5Embeddings
+
+from conftest import byt5_benchmark
+
+
+def token_embeddings(embeddings: ByT5Embeddings, sentences):
+    for sentence in sentences:
+        sentence.clear_embeddings()
+
+    embeddings.embed(sentences)
+    return [torch.stack([token.get_embedding() for token in sentence]) for sentence in sentences]
+
+
+def test_create_tagger_keeps_original_byt5_options(fine_tuner, tiny_byt5, synthetic_corpus):
+    label_dictionary = synthetic_corpus.make_label_dictionary("ner")
+    json_config = {"hf_model": tiny_byt5, "context_size": 64}
+
+    embeddings = fine_tuner.create_tagger("mean", label_dictionary, json_config).embeddings
+
+    assert isinstance(embeddings, ByT5Embeddings)
+    assert embeddings.subtoken_pooling == "first"
+    assert embeddings.context_length == 0
+    assert not embeddings.respect_document_boundaries
+
+    json_config.update({"byt5_context_and_pooling": True, "respect_document_boundaries": True})
+    embeddings = fine_tuner.create_tagger("mean", label_dictionary, json_config).embeddings
+
+    assert embeddings.subtoken_pooling == "mean"
+    assert embeddings.context_length == 64
+    assert embeddings.respect_document_boundaries
+
+
+def test_context_runs_respect_document_boundaries(tiny_byt5):
+    sentences = [Sentence("Der König"), Sentence("-DOCSTART-"), Sentence("in Paris"), Sentence("und Berlin")]
+    for previous_sentence, sentence in zip(sentences, sentences[1:]):
+        sentence._previous_sentence = previous_sentence
+        previous_sentence._next_sentence = sentence
+    sentences[1].is_document_boundary = True
+
+    def number_of_sequences(respect_document_boundaries: bool) -> int:
+        embeddings = ByT5Embeddings(tiny_byt5, use_context=8, respect_document_boundaries=respect_document_boundaries)
+        return len(embeddings._build_sequences(sentences))
+
+    # All sentences form one run, or the run is split at the document separator
+    assert number_of_sequences(False) == 1
+    assert number_of_sequences(True) == 3
+
+
+def test_token_byte_offsets_count_utf8_bytes():
+    tokens = Sentence("ſeine Majeſtät , 1848").tokens
+
+    token_offsets, token_lengths = ByT5Embeddings._token_byte_offsets(tokens)
+
+    assert token_lengths == [6, 10, 1, 4]
+    assert token_offsets == [0, 7, 18, 20]
+
+    # Offsets point to the first byte of every token in the UTF-8 encoded tokenized string
+    text = " ".join(token.text for token in tokens).encode("utf-8")
+    assert [text[offset: offset + length].decode("utf-8") for offset, length in zip(token_offsets, token_lengths)] == [
+        token.text for token in tokens
+    ]
+
+
+def test_batch_is_encoded_like_single_sentences(tiny_byt5):
+    embeddings = ByT5Embeddings(tiny_byt5, layers="-1,-2", layer_mean=False)
+    sentences = byt5_benchmark.synthetic_sentences(6, seed=1)
+
+    batch_embeddings = token_embeddings(embeddings, sentences)
+
+    # Padding of the mini-batch does not change the embeddings of a sentence
+    for sentence, sentence_embeddings in zip(sentences, batch_embeddings):
+        assert torch.allclose(token_embeddings(embeddings, [sentence])[0], sentence_embeddings, atol=1e-5)
+
+
+def test_subtoken_pooling_matches_per_token_loop(tiny_byt5):
+    sentence = Sentence("ſeine Majeſtät in Helsingfors , 1848")
+
+    embeddings = ByT5Embeddings(tiny_byt5, subtoken_pooling="first")
+    input_ids = torch.tensor([embeddings.tokenizer(sentence.to_tokenized_string())["input_ids"]])
+    with torch.no_grad():
+        hidden_states = embeddings.model(input_ids=input_ids).last_hidden_state[0]
+
+    token_offsets, token_lengths = ByT5Embeddings._token_byte_offsets(sentence.tokens)
+    expected_embeddings = {
+        "first": [hidden_states[offset] for offset in token_offsets],
+        "last": [hidden_states[offset + length - 1] for offset, length in zip(token_offsets, token_lengths)],
+        "mean": [
+            hidden_states[offset: offset + length].mean(0) for offset, length in zip(token_offsets, token_lengths)
+        ],
+    }
+    expected_embeddings["first_last"] = [
+        torch.cat([first, last]) for first, last in zip(expected_embeddings["first"], expected_embeddings["last"])
+    ]
+
+    for subtoken_pooling, expected in expected_embeddings.items():
+        embeddings.subtoken_pooling = subtoken_pooling
+
+        assert torch.allclose(token_embeddings(embeddings, [sentence])[0], torch.stack(expected), atol=1e-5)
+
+
+def test_sliding_windows_tile_long_sequences(tiny_byt5):
+    embeddings = ByT5Embeddings(tiny_byt5, allow_long_sentences=True, window_size=32, stride=8)
+
+    for sequence_length in [1, 32, 33, 100, 257]:
+        windows = embeddings._sliding_windows(sequence_length)
+
+        assert all(0 <= start and end <= sequence_length and end - start <= 32 for start, end, _, _ in windows)
+        # Kept ranges cover every position exactly once, and lie within their window
+        assert [position for _, _, keep_start, keep_end in windows for position in range(keep_start, keep_end)] == list(
+            range(sequence_length)
+        )
+        assert all(start <= keep_start and keep_end <= end for start, end, keep_start, keep_end in windows)
+
+
+def test_long_sentences_are_encoded_in_windows(tiny_byt5):
+    sentence = Sentence(" ".join(byt5_benchmark.SYNTHETIC_WORDS * 3))
+
+    windowed_embeddings = ByT5Embeddings(tiny_byt5, allow_long_sentences=True, window_size=64, stride=16)
+    [sentence_embeddings] = token_embeddings(windowed_embeddings, [sentence])
+
+    assert sentence_embeddings.shape == (len(sentence), windowed_embeddings.embedding_length)
+
+    # A window, that is longer than the sentence, encodes it in one pass
+    windowed_embeddings.window_size = 4096
+    unwindowed_embeddings = ByT5Embeddings(tiny_byt5)
+    assert torch.allclose(
+        token_embeddings(windowed_embeddings, [sentence])[0], token_embeddings(unwindowed_embeddings, [sentence])[0]
+    )
+
+
+def test_inference_mode_matches_eval_mode(tiny_byt5):
+    sentences = byt5_benchmark.synthetic_sentences(4, seed=2)
+    embeddings = ByT5Embeddings(tiny_byt5, fine_tune=False)
+    expected_embeddings = token_embeddings(embeddings, sentences)
+
+    embeddings.enable_inference_mode()
+    for sentence_embeddings, expected in zip(token_embeddings(embeddings, sentences), expected_embeddings):
+        assert torch.allclose(sentence_embeddings, expected)
+
+    # Reduced precision only changes the embeddings slightly
+    embeddings.enable_inference_mode(int8=True)
+    for sentence_embeddings, expected in zip(token_embeddings(embeddings, sentences), expected_embeddings):
+        assert sentence_embeddings.dtype == torch.float32
+        assert torch.nn.functional.cosine_similarity(sentence_embeddings, expected).min() > 0.9
+
+
+def test_encoder_stops_at_deepest_requested_layer(tiny_byt5):
+    sentence = Sentence("Der König in Paris")
+    embeddings = ByT5Embeddings(tiny_byt5, layers="0,2", layer_mean=False, subtoken_pooling="first")
+
+    input_ids = torch.tensor([embeddings.tokenizer(sentence.to_tokenized_string())["input_ids"]])
+    with torch.no_grad():
+        hidden_states = embeddings.model(input_ids=input_ids, output_hidden_states=True).hidden_states
+
+    token_offsets, _ = ByT5Embeddings._token_byte_offsets(sentence.tokens)
+    expected = torch.cat([hidden_states[0][0, token_offsets], hidden_states[2][0, token_offsets]], dim=-1)
+
+    assert torch.allclose(token_embeddings(embeddings, [sentence])[0], expected, atol=1e-5)
+
+
+def test_gradient_checkpointing_keeps_gradients(tiny_byt5):
+    sentences = byt5_benchmark.synthetic_sentences(4, seed=3)
+
+    def gradients(gradient_checkpointing: bool):
+        embeddings = ByT5Embeddings(tiny_byt5, layers="-1,-2", gradient_checkpointing=gradient_checkpointing)
+        embeddings.train()
+        # Without dropout (of the layers and of the attention weights), both runs compute exactly the same
+        for module in embeddings.model.modules():
+            if isinstance(module, torch.nn.Dropout):
+                module.p = 0.0
+            elif isinstance(getattr(module, "dropout", None), float):
+                module.dropout = 0.0
+
+        torch.cat(token_embeddings(embeddings, sentences)).sum().backward()
+        return [parameter.grad for parameter in embeddings.model.parameters() if parameter.grad is not None]
+
+    checkpointed_gradients = gradients(True)
+    expected_gradients = gradients(False)
+
+    assert len(checkpointed_gradients) == len(expected_gradients) > 0
+    for gradient, expected in zip(checkpointed_gradients, expected_gradients):
+        assert torch.allclose(gradient, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_packed_sequences_are_encoded_like_padded_ones(tiny_byt5):
+    sentences = byt5_benchmark.synthetic_sentences(12, seed=4)
+
+    padded_embeddings = token_embeddings(ByT5Embeddings(tiny_byt5), sentences)
+
+    packed = ByT5Embeddings(tiny_byt5, pack_sequences=True, window_size=256)
+    window_positions, _ = packed._pack_windows([len(sentence.to_tokenized_string().encode("utf-8")) + 1
+                                                for sentence in sentences])
+    # Several sentences share a row, otherwise packing is not tested
+    assert len({row for row, _ in window_positions}) < len(sentences)
+
+    # Every sentence only attends to itself in its packed row
+    for sentence_embeddings, expected in zip(token_embeddings(packed, sentences), padded_embeddings):
+        assert torch.allclose(sentence_embeddings, expected, atol=1e-5)
+
+
+def test_pack_windows_first_fit_decreasing(tiny_byt5):
+    embeddings = ByT5Embeddings(tiny_byt5, pack_sequences=True, window_size=10)
+
+    window_positions, row_length = embeddings._pack_windows([6, 4, 5, 3, 2])
+
+    assert window_positions == [(0, 0), (0, 6), (1, 0), (1, 5), (1, 8)]
+    assert row_length == 10
@@ -0,0 +1,36 @@
+from flair.datasets import ColumnCorpus
+
+from corpus_cache import CorpusCache
+
+
+def write_column_corpus(data_folder, text: str):
+    data_folder.mkdir(parents=True, exist_ok=True)
+    for split in ["train", "dev", "test"]:
+        (data_folder / f"{split}.txt").write_text(text)
+
+
+def test_corpus_cache(tmp_path):
+    data_folder = tmp_path / "data"
+    write_column_corpus(data_folder, "König B-PER\nin O\nParis B-LOC\n\nBerlin B-LOC\n")
+
+    loaded = []
+
+    def load_fn():
+        loaded.append(True)
+        return ColumnCorpus(data_folder, {0: "text", 1: "ner"}, in_memory=True)
+
+    cache = CorpusCache(tmp_path / "cache")
+    corpus = cache.load({"dataset": "test"}, data_folder, load_fn)
+    cached_corpus = cache.load({"dataset": "test"}, data_folder, load_fn)
+
+    assert len(loaded) == 1
+    assert [sentence.to_tagged_string() for sentence in cached_corpus.train] == [
+        sentence.to_tagged_string() for sentence in corpus.train
+    ]
+    # Neighbour links for FLERT context are restored
+    assert cached_corpus.train[1].previous_sentence() is cached_corpus.train[0]
+
+    # Changed raw data is parsed again
+    write_column_corpus(data_folder, "Paris B-LOC\n")
+    assert len(cache.load({"dataset": "test"}, data_folder, load_fn).train) == 1
+    assert len(loaded) == 2
@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+
+from flair.data import Sentence
+
+from byt5_embeddings import ByT5Embeddings
+from embedding_cache import HiddenStateCache
+
+
+def test_hidden_state_cache_is_shared_between_instances(tmp_path):
+    key = {"base_model_name": "tiny"}
+    embeddings = np.arange(12, dtype=np.float16).reshape(3, 4)
+
+    HiddenStateCache(tmp_path, key, embedding_length=4).put(HiddenStateCache.hash("a b c"), embeddings)
+
+    cache = HiddenStateCache(tmp_path, key, embedding_length=4)
+    assert np.array_equal(cache.get(HiddenStateCache.hash("a b c")), embeddings)
+    assert cache.get(HiddenStateCache.hash("a b")) is None
+
+
+def test_cache_key_includes_reduced_precision(tmp_path, tiny_byt5):
+    embeddings = ByT5Embeddings(tiny_byt5, fine_tune=False, cache_dir=tmp_path)
+    full_precision_path = embeddings.hidden_state_cache.path
+
+    embeddings.embed(Sentence("Der König in Paris"))
+    embeddings.enable_inference_mode(bf16=True)
+
+    sentence = Sentence("Der König in Paris")
+    embeddings.embed(sentence)
+
+    # bf16 embeddings are computed again and stored in their own cache
+    assert embeddings.hidden_state_cache.path != full_precision_path
+    assert len(embeddings.hidden_state_cache.index) == 1
+
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        embeddings.embed(Sentence("Der König in Paris"))
+
+    assert "autocast" in embeddings.hidden_state_cache.key
+
+    # Back in full precision, the first cache is used again
+    embeddings.inference_bf16 = False
+    embeddings.embed(Sentence("Der König in Paris"))
+
+    assert embeddings.hidden_state_cache.path == full_precision_path
+
+
+def test_output_path_records_model_options(fine_tuner):
+    json_config = {"hf_model": "hmbyt5/byt5-small-historic-multilingual", "context_size": 0}
+
+    def output_path(**options):
+        return fine_tuner.get_output_path(1, 8, 10, 5e-5, "first", ["newseye/fi"], {**json_config, **options},
+                                          ("fp32", "none"))
+
+    # Default values keep the names of existing runs
+    assert output_path().endswith("-crfFalse-1")
+    assert output_path(fine_tune=True, pack_sequences=False) == output_path()
+
+    # A frozen backbone with the embedding cache is another run than fine-tuning
+    assert output_path(fine_tune=False, embedding_cache_dir="cache") == output_path() + "-finetuneFalse"
+    assert output_path(window_size=512, pack_sequences=True) == output_path() + "-window512-packingTrue"
+
+
+def test_cached_embeddings_are_converted_once_per_batch(tmp_path, tiny_byt5):
+    embeddings = ByT5Embeddings(tiny_byt5, fine_tune=False, cache_dir=tmp_path)
+
+    texts = ["Der König in Paris", "Die Zeitung von gestern"]
+    stored_sentences = [Sentence(text) for text in texts]
+    embeddings.embed(stored_sentences)
+
+    sentences = [Sentence(text) for text in texts]
+    embeddings.embed(sentences)
+
+    token_embeddings = [token._embeddings[embeddings.name] for sentence in sentences for token in sentence]
+
+    # All tokens of the batch share one float32 tensor
+    assert all(embedding.dtype == torch.float32 for embedding in token_embeddings)
+    assert len({embedding.untyped_storage().data_ptr() for embedding in token_embeddings}) == 1
+
+    for stored_sentence, sentence in zip(stored_sentences, sentences):
+        for stored_token, token in zip(stored_sentence, sentence):
+            assert torch.equal(token.get_embedding(), stored_token.get_embedding())
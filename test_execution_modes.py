@@ -0,0 +1,130 @@
+import logging
+import pytest
+import torch
+import torch._dynamo
+
+from flair.models import SequenceTagger
+
+from execution_modes import autocast_dtype, compile_tagger, resolve_compile_mode, resolve_precision
+
+
+def test_resolve_precision_on_cpu():
+    cpu = torch.device("cpu")
+
+    assert resolve_precision("fp32", cpu) == "fp32"
+    assert resolve_precision("auto", cpu) == "bf16"
+    assert resolve_precision("bf16", cpu) == "bf16"
+    # fp16 autocast falls back to bf16 on CPU
+    assert resolve_precision("fp16", cpu) == "bf16"
+
+    with pytest.raises(ValueError):
+        resolve_precision("fp8", cpu)
+
+
+def test_resolve_compile_mode_falls_back_on_cpu():
+    cpu = torch.device("cpu")
+
+    assert resolve_compile_mode("none", cpu) == "none"
+    assert resolve_compile_mode("backbone", cpu) == "none"
+    assert resolve_compile_mode("all", cpu) == "none"
+    assert resolve_compile_mode("all", torch.device("cuda")) == "all"
+
+    with pytest.raises(ValueError):
+        resolve_compile_mode("max-autotune", cpu)
+
+
+def test_autocast_dtype_is_restored():
+    cpu = torch.device("cpu")
+    original_dtype = torch.get_autocast_dtype("cpu")
+
+    with autocast_dtype(cpu, "fp16"):
+        assert torch.get_autocast_dtype("cpu") == torch.float16
+
+    assert torch.get_autocast_dtype("cpu") == original_dtype
+
+
+def test_compile_tagger_keeps_parameter_names(fine_tuner, tiny_bert, synthetic_corpus):
+    tagger: SequenceTagger = fine_tuner.create_tagger(
+        "first", synthetic_corpus.make_label_dictionary("ner"), {"hf_model": tiny_bert, "context_size": 0}
+    )
+    parameter_names = list(tagger.state_dict())
+
+    compile_tagger(tagger, "all")
+
+    assert list(tagger.state_dict()) == parameter_names
+
+
+def test_compile_falls_back_to_eager_mode(monkeypatch, fine_tuner, tiny_bert, synthetic_corpus):
+    def failing_compile(fn, **kwargs):
+        def compiled_fn(*args, **kwargs):
+            raise torch._dynamo.exc.TorchRuntimeError("compilation failed")
+
+        return compiled_fn
+
+    monkeypatch.setattr(torch, "compile", failing_compile)
+
+    tagger: SequenceTagger = fine_tuner.create_tagger(
+        "first", synthetic_corpus.make_label_dictionary("ner"), {"hf_model": tiny_bert, "context_size": 0}
+    )
+    compile_tagger(tagger, "all")
+
+    loss, number_of_labels = tagger.forward_loss(list(synthetic_corpus.train)[:4])
+    assert number_of_labels > 0
+
+
+def test_output_path_records_resolved_execution_mode(fine_tuner):
+    json_config = {
+        "hf_model": "dbmdz/bert-tiny-historic-multilingual-cased",
+        "context_size": 0,
+        "seeds": [1],
+        "batch_sizes": [8],
+        "epochs": [10],
+        "learning_rates": [5e-5],
+        "subword_poolings": ["first"],
+        "devices": ["cpu"],
+        "precision": "fp16",
+        "torch_compile": "backbone",
+    }
+
+    [job] = fine_tuner.expand_grid(["newseye/fi"], json_config)
+
+    # fp16 and torch.compile both fall back on CPU
+    assert job.output_path.endswith("-1-precisionbf16")
+
+    json_config["precision"] = "fp32"
+    [job] = fine_tuner.expand_grid(["newseye/fi"], json_config)
+
+    assert job.output_path.endswith("-crfFalse-1")
+
+
+def test_early_layer_stop_keeps_compiled_backbone(monkeypatch, caplog, fine_tuner, tiny_byt5, synthetic_corpus):
+    # The eager backend traces with dynamo like inductor, but does not need a compiler for the generated code
+    original_compile = torch.compile
+    compiled_calls = []
+
+    def eager_compile(fn, **kwargs):
+        compiled_fn = original_compile(fn, backend="eager", **kwargs)
+
+        def counted_fn(*args, **kwargs):
+            compiled_calls.append(fn)
+            return compiled_fn(*args, **kwargs)
+
+        return counted_fn
+
+    monkeypatch.setattr(torch, "compile", eager_compile)
+
+    # The encoder is stopped after the first layer by raising _StopEncoder
+    json_config = {"hf_model": tiny_byt5, "context_size": 0, "layers": "0"}
+    label_dictionary = synthetic_corpus.make_label_dictionary("ner")
+    tagger: SequenceTagger = fine_tuner.create_tagger("first", label_dictionary, json_config)
+    compile_tagger(tagger, "backbone")
+
+    sentences = list(synthetic_corpus.train)[:4]
+
+    with caplog.at_level(logging.WARNING, logger="flair"):
+        for _ in range(2):
+            loss, number_of_labels = tagger.forward_loss(sentences)
+            assert number_of_labels > 0
+
+    assert "falling back to eager mode" not in caplog.text
+    assert len(compiled_calls) == 2
@@ -0,0 +1,67 @@
+import torch
+
+from flair.datasets import ColumnCorpus
+
+from conftest import byt5_benchmark
+
+
+def write_column_corpus(data_folder, seed: int):
+    data_folder.mkdir(parents=True)
+
+    for split in ["train", "dev", "test"]:
+        lines = []
+        for sentence in byt5_benchmark.synthetic_sentences(10, seed=seed):
+            lines.extend(f"{token.text} {token.get_label('ner').value}" for token in sentence)
+            lines.append("")
+        (data_folder / f"{split}.txt").write_text("\n".join(lines) + "\n")
+
+
+def test_load_corpora_in_parallel_keeps_dataset_order(tmp_path, monkeypatch, fine_tuner):
+    # Every dataset gets its own corpus, so that the order can be checked
+    datasets = ["newseye/de", "newseye/fi", "ajmc/en"]
+    for seed, dataset in enumerate(datasets):
+        write_column_corpus(tmp_path / dataset, seed)
+
+    def load_corpus(dataset, *args):
+        return ColumnCorpus(tmp_path / dataset, {0: "text", 1: "ner"}, in_memory=True)
+
+    monkeypatch.setattr(fine_tuner, "load_corpus", load_corpus)
+
+    sequential_corpora = fine_tuner.load_corpora(datasets, num_workers=1)
+    parallel_corpora = fine_tuner.load_corpora(datasets, num_workers=2)
+
+    for sequential_corpus, parallel_corpus in zip(sequential_corpora, parallel_corpora):
+        assert [sentence.to_tagged_string() for sentence in parallel_corpus.train] == [
+            sentence.to_tagged_string() for sentence in sequential_corpus.train
+        ]
+
+    # Neighbour links for FLERT context survive the transfer from the worker
+    train_sentences = list(parallel_corpora[0].train)
+    assert train_sentences[1].previous_sentence() is train_sentences[0]
+
+
+def test_corpora_are_shared_between_runs(monkeypatch, fine_tuner, synthetic_corpus):
+    loaded = []
+
+    def load_corpora(*args, **kwargs):
+        loaded.append(args)
+        return [synthetic_corpus]
+
+    monkeypatch.setattr(fine_tuner, "load_corpora", load_corpora)
+    monkeypatch.setattr(fine_tuner, "_shared_corpora", {})
+
+    corpora, label_dictionary = fine_tuner.get_corpora(["newseye/de"])
+
+    # A run adds predictions and embeddings, and modifies its label dictionary
+    sentence = corpora.train[0]
+    sentence.add_label("predicted", "PER")
+    sentence[0].set_embedding("test", torch.zeros(2))
+    label_dictionary.add_item("<START>")
+
+    shared_corpora, shared_label_dictionary = fine_tuner.get_corpora(["newseye/de"])
+
+    assert len(loaded) == 1
+    assert shared_corpora.train[0] is sentence
+    assert not sentence.get_labels("predicted") and sentence.get_labels("ner")
+    assert not sentence[0].get_embedding().numel()
+    assert "<START>" not in shared_label_dictionary.get_items()
@@ -0,0 +1,70 @@
+from flair.data import Sentence
+
+from grid_estimator import (
+    Calibration,
+    calibrate,
+    compute_corpus_statistics,
+    estimate_run,
+    format_duration,
+    load_corpus_statistics,
+)
+from grid_scheduler import GridJob
+
+
+def test_compute_corpus_statistics(synthetic_corpus):
+    statistics = compute_corpus_statistics(synthetic_corpus, count_subwords=lambda sentence: 2 * len(sentence))
+
+    assert statistics["train"]["sentences"] == len(synthetic_corpus.train)
+    assert statistics["train"]["tokens"] == sum(len(sentence) for sentence in synthetic_corpus.train)
+    assert statistics["train"]["subwords"] == 2 * statistics["train"]["tokens"]
+    assert statistics["test"]["bytes"] == sum(
+        len(sentence.to_original_text().encode("utf-8")) for sentence in synthetic_corpus.test
+    )
+
+
+def test_corpus_statistics_are_cached(tmp_path):
+    computed = []
+
+    def compute_fn():
+        computed.append(True)
+        return {"train": {"tokens": 42}}
+
+    for _ in range(2):
+        assert load_corpus_statistics(tmp_path, {"dataset": "newseye/fi"}, compute_fn) == {"train": {"tokens": 42}}
+
+    assert len(computed) == 1
+
+
+def test_estimate_run(tmp_path):
+    statistics = {"train": {"tokens": 1000}, "dev": {"tokens": 100}, "test": {"tokens": 200}}
+    calibration = Calibration(8, seconds_per_train_token=0.01, seconds_per_eval_token=0.001, peak_memory_mb=100.0)
+    job = GridJob(1, 8, 3, 5e-5, "first", str(tmp_path / "run"))
+
+    estimate = estimate_run(job, statistics, calibration)
+
+    assert estimate.train_tokens == 3000
+    # 3 epochs of training and dev evaluation, one test evaluation
+    assert abs(estimate.seconds - (3000 * 0.01 + 500 * 0.001)) < 1e-9
+    assert not estimate.completed
+
+
+def test_format_duration():
+    assert format_duration(3725.2) == "1h 02m 06s"
+
+
+def test_calibrate_with_a_single_batch(fine_tuner, tiny_bert, synthetic_corpus):
+    tagger = fine_tuner.create_tagger(
+        "first", synthetic_corpus.make_label_dictionary("ner"), {"hf_model": tiny_bert, "context_size": 0}
+    )
+    sentences = [Sentence("Der König in Paris"), Sentence("und Berlin")]
+
+    calibration = calibrate(tagger, sentences, batch_size=8, steps=5, make_batches=lambda sentences: [sentences])
+
+    assert calibration.seconds_per_train_token > 0
+    assert calibration.seconds_per_eval_token > 0
+
+
+def test_corpus_statistics_without_cache_dir():
+    assert load_corpus_statistics(None, {"dataset": "newseye/fi"}, lambda: {"train": {"tokens": 1}}) == {
+        "train": {"tokens": 1}
+    }
@@ -0,0 +1,202 @@
+import functools
+import pytest
+import torch
+
+from pathlib import Path
+
+from grid_scheduler import (
+    GridJob, GridManifest, is_run_completed, make_worker_slots, run_grid, run_successive_halving
+)
+from trainer_plugins import EpochCheckpointPlugin
+
+
+def write_dev_scores(output_path: str, scores):
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+
+    with open(Path(output_path) / "training.log", "at") as f_p:
+        for score in scores:
+            f_p.write(f"DEV : loss 0.1 - f1-score (micro avg)  {score}\n")
+
+
+def fake_run(job: GridJob, final_scores: dict, calls: list):
+    # Dev score of every epoch is the final score of the configuration, pausing stops after `pause_after_epoch`
+    calls.append(job)
+
+    trained_epochs = len(Path(job.output_path, "training.log").read_text().splitlines()) \
+        if Path(job.output_path, "training.log").exists() else 0
+    last_epoch = job.pause_after_epoch if job.pause_after_epoch is not None else job.epoch
+
+    write_dev_scores(job.output_path, [final_scores[job.learning_rate]] * (last_epoch - trained_epochs))
+
+    if job.pause_after_epoch is not None:
+        Path(job.output_path, EpochCheckpointPlugin.checkpoint_name).write_text("checkpoint")
+    else:
+        Path(job.output_path, "final-model.pt").write_text("model")
+        with open(Path(job.output_path) / "training.log", "at") as f_p:
+            f_p.write("F-score (micro) 0.5\n")
+
+
+def make_jobs(tmp_path, learning_rates, seeds=(1, 2), epoch=4):
+    return [
+        GridJob(seed, 8, epoch, learning_rate, "first", str(tmp_path / f"lr{learning_rate}-{seed}"))
+        for seed in seeds
+        for learning_rate in learning_rates
+    ]
+
+
+def test_run_grid_skips_completed_runs(tmp_path):
+    jobs = make_jobs(tmp_path, [0.1, 0.2], seeds=[1])
+    calls = []
+    run_fn = functools.partial(fake_run, final_scores={0.1: 0.5, 0.2: 0.6}, calls=calls)
+    manifest = GridManifest(tmp_path / "manifest.json")
+
+    run_grid(jobs, run_fn, make_worker_slots(["cpu"]), manifest=manifest)
+    assert len(calls) == 2
+    assert {entry["status"] for entry in manifest.read().values()} == {"done"}
+
+    run_grid(jobs, run_fn, make_worker_slots(["cpu"]), manifest=manifest)
+    assert len(calls) == 2
+    assert all(entry["skipped"] for entry in manifest.read().values())
+
+
+def test_run_grid_reports_completed_runs_once(tmp_path):
+    jobs = make_jobs(tmp_path, [0.1, 0.2], seeds=[1])
+    run_fn = functools.partial(fake_run, final_scores={0.1: 0.5, 0.2: 0.6}, calls=[])
+    manifest = GridManifest(tmp_path / "manifest.json")
+
+    def failing_upload(job):
+        raise RuntimeError("process died before the upload")
+
+    with pytest.raises(RuntimeError):
+        run_grid(jobs, run_fn, make_worker_slots(["cpu"]), on_job_done=failing_upload, manifest=manifest)
+
+    assert is_run_completed(jobs[0].output_path)
+    assert not manifest.is_reported(jobs[0].output_path)
+
+    # The completed run is skipped, but still uploaded
+    uploaded_jobs = []
+    run_grid(jobs, run_fn, make_worker_slots(["cpu"]), on_job_done=uploaded_jobs.append, manifest=manifest)
+
+    assert sorted(uploaded_jobs) == sorted(jobs)
+    assert all(manifest.is_reported(job.output_path) for job in jobs)
+
+    run_grid(jobs, run_fn, make_worker_slots(["cpu"]), on_job_done=uploaded_jobs.append, manifest=manifest)
+    assert len(uploaded_jobs) == 2
+
+
+def test_successive_halving_prunes_configurations(tmp_path):
+    jobs = make_jobs(tmp_path, [0.1, 0.2, 0.3, 0.4])
+    calls = []
+    done_jobs = []
+    run_fn = functools.partial(fake_run, final_scores={0.1: 0.4, 0.2: 0.8, 0.3: 0.6, 0.4: 0.2}, calls=calls)
+    manifest = GridManifest(tmp_path / "manifest.json")
+
+    run_successive_halving(jobs, run_fn, make_worker_slots(["cpu"]), rungs=[1, 2], on_job_done=done_jobs.append,
+                           manifest=manifest)
+
+    entries = manifest.read()
+
+    # Rung 1 keeps learning rates 0.2 and 0.3, rung 2 only 0.2
+    assert {job.learning_rate for job in done_jobs} == {0.2}
+    assert len(done_jobs) == 2
+    assert {entries[job.output_path]["status"] for job in jobs if job.learning_rate == 0.2} == {"done"}
+    assert {entries[job.output_path]["status"] for job in jobs if job.learning_rate != 0.2} == {"pruned"}
+
+    # Pruned runs do not keep their checkpoints
+    for job in jobs:
+        if job.learning_rate != 0.2:
+            assert not Path(job.output_path, EpochCheckpointPlugin.checkpoint_name).exists()
+
+    # 8 runs until epoch 1, 4 runs until epoch 2, 2 runs until the end
+    assert len(calls) == 14
+
+    # Restarting the finished grid does not train again
+    run_successive_halving(jobs, run_fn, make_worker_slots(["cpu"]), rungs=[1, 2], manifest=manifest)
+    assert len(calls) == 14
+
+
+def test_successive_halving_resumes_surviving_runs(tmp_path, monkeypatch, fine_tuner, tiny_bert, synthetic_corpus):
+    # Real training with a tiny model: survivors continue from the checkpoint of the rung
+    label_dictionary = synthetic_corpus.make_label_dictionary("ner")
+    monkeypatch.setattr(fine_tuner, "get_corpora", lambda *args, **kwargs: (synthetic_corpus, label_dictionary))
+    monkeypatch.chdir(tmp_path)
+
+    json_config = {
+        "hf_model": tiny_bert,
+        "context_size": 0,
+        "seeds": [1],
+        "batch_sizes": [8],
+        "epochs": [3],
+        "learning_rates": [5e-3, 1e-9],
+        "subword_poolings": ["first"],
+        "devices": ["cpu"],
+        "cpu_affinity": False,
+    }
+    hipe_datasets = ["synthetic/de"]
+
+    jobs = fine_tuner.expand_grid(hipe_datasets, json_config)
+    run_fn = functools.partial(fine_tuner.run_job, hipe_datasets=hipe_datasets, json_config=json_config)
+    done_jobs = []
+
+    run_successive_halving(jobs, run_fn, fine_tuner.get_worker_slots(json_config), rungs=[1],
+                           on_job_done=done_jobs.append)
+
+    assert len(done_jobs) == 1
+
+    output_path = Path(done_jobs[0].output_path)
+    training_log = (output_path / "training.log").read_text()
+
+    assert "Resuming from epoch 1" in training_log
+    # Epoch 1 is not trained again
+    assert training_log.count("EPOCH 1 done") == 1
+    assert training_log.count("EPOCH 3 done") == 1
+    assert (output_path / "final-model.pt").exists() or (output_path / "best-model.pt").exists()
+    assert not (output_path / EpochCheckpointPlugin.checkpoint_name).exists()
+
+
+def test_paused_run_continues_like_an_uninterrupted_run(tmp_path, monkeypatch, fine_tuner, tiny_bert,
+                                                         synthetic_corpus):
+    label_dictionary = synthetic_corpus.make_label_dictionary("ner")
+    monkeypatch.setattr(fine_tuner, "get_corpora", lambda *args, **kwargs: (synthetic_corpus, label_dictionary))
+
+    json_config = {"hf_model": tiny_bert, "context_size": 0}
+
+    def final_model_state(pause_after_epochs):
+        monkeypatch.chdir(tmp_path / f"paused-{len(pause_after_epochs)}")
+
+        for pause_after_epoch in [*pause_after_epochs, None]:
+            fine_tuner.run_experiment(1, 8, 3, 5e-3, "first", ["synthetic/de"], json_config, pause_after_epoch)
+
+        output_path = Path(fine_tuner.get_output_path(1, 8, 3, 5e-3, "first", ["synthetic/de"], json_config,
+                                                      ("fp32", "none")))
+        assert not (output_path / EpochCheckpointPlugin.checkpoint_name).exists()
+        if pause_after_epochs:
+            assert f"Resuming from epoch {pause_after_epochs[-1]}" in (output_path / "training.log").read_text()
+
+        return torch.load(output_path / "final-model.pt", map_location="cpu", weights_only=False)["state_dict"]
+
+    for number_of_pauses in [0, 2]:
+        (tmp_path / f"paused-{number_of_pauses}").mkdir()
+
+    expected_state = final_model_state([])
+    resumed_state = final_model_state([1, 2])
+
+    assert resumed_state.keys() == expected_state.keys()
+    for name, parameter in expected_state.items():
+        assert torch.equal(resumed_state[name], parameter), name
+
+
+def test_run_grid_on_several_worker_slots(tmp_path):
+    jobs = make_jobs(tmp_path, [0.1, 0.2, 0.3], seeds=[1])
+    manifest = GridManifest(tmp_path / "manifest.json")
+    done_jobs = []
+
+    # Jobs run in spawned worker processes, so calls are only visible in their output paths
+    run_fn = functools.partial(fake_run, final_scores={0.1: 0.5, 0.2: 0.6, 0.3: 0.7}, calls=[])
+    slots = make_worker_slots(["cpu", "cpu"], threads_per_worker=1, cpu_affinity=False)
+
+    run_grid(jobs, run_fn, slots, on_job_done=done_jobs.append, manifest=manifest)
+
+    assert sorted(done_jobs) == sorted(jobs)
+    assert all(Path(job.output_path, "final-model.pt").exists() for job in jobs)
+    assert {entry["status"] for entry in manifest.read().values()} == {"done"}
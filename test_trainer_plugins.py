@@ -0,0 +1,31 @@
+import json
+
+from flair.trainers import ModelTrainer
+
+from trainer_plugins import PROFILING_PHASES, ProfilingPlugin
+
+
+def test_profiling_plugin_writes_profile(tmp_path, fine_tuner, tiny_bert, synthetic_corpus):
+    tagger = fine_tuner.create_tagger(
+        "first", synthetic_corpus.make_label_dictionary("ner"), {"hf_model": tiny_bert, "context_size": 0}
+    )
+    profiler = ProfilingPlugin(tmp_path)
+
+    ModelTrainer(tagger, synthetic_corpus).fine_tune(
+        tmp_path, learning_rate=5e-3, mini_batch_size=8, max_epochs=2, plugins=[profiler]
+    )
+
+    profile = json.loads(profiler.profile_file.read_text())
+
+    # 20 training sentences in batches of 8
+    assert profile["summary"]["epochs"] == 2
+    assert profile["summary"]["batches"] == 6
+    assert set(profile["summary"]["phases"]) == set(PROFILING_PHASES)
+    assert all(elapsed >= 0.0 for batch in profile["batches"] for elapsed in batch.values())
+    assert sum(batch["tokens"] for batch in profile["batches"]) == 2 * sum(
+        len(sentence) for sentence in synthetic_corpus.train
+    )
+
+    # Timing wrappers are removed after training
+    assert "forward_loss" not in tagger.__dict__
+    assert "embed" not in tagger.embeddings.__dict__
@@ -0,0 +1,151 @@
+import importlib
+import json
+
+import utils
+
+preprocessing_benchmark = importlib.import_module("preprocessing-benchmark")
+
+
+def test_preprocessing_matches_original_prepare_functions():
+    # Golden digests were produced by the original prepare_* functions, on synthetic files of every preprocessor
+    expected_digests = json.loads(preprocessing_benchmark.GOLDEN_FILE.read_text())
+
+    assert preprocessing_benchmark.golden_digests() == expected_digests
+
+
+def test_streaming_does_not_depend_on_block_size(tmp_path, monkeypatch):
+    # Hyphenations across block boundaries are de-hyphenated like within a block
+    file_in = tmp_path / "input.tsv"
+
+    for dataset in preprocessing_benchmark.BENCHMARK_DATASETS:
+        preprocessing_benchmark.generate_hipe_corpus(file_in, dataset, 20, seed=1)
+
+        monkeypatch.setattr(utils, "BLOCK_SIZE", 4096)
+        preprocessing_benchmark.preprocess(dataset, file_in, tmp_path / "expected.txt")
+
+        monkeypatch.setattr(utils, "BLOCK_SIZE", 7)
+        preprocessing_benchmark.preprocess(dataset, file_in, tmp_path / "output.txt")
+
+        assert (tmp_path / "output.txt").read_text() == (tmp_path / "expected.txt").read_text(), dataset
+
+
+def hipe_row(token: str, misc: str = "_") -> str:
+    return f"{token}\tO\tO\t{misc}"
+
+
+def dehyphenate(name: str, lines):
+    # All rows at once, and row by row as in blocks of a single line
+    rows = utils.HipeRows.from_lines(lines)
+    utils.DEHYPHENATORS[name].dehyphenate_fn(rows, 0, len(rows))
+
+    streamed_rows = utils.HipeRows()
+    for line in lines:
+        start = len(streamed_rows)
+        streamed_rows.extend([line])
+        utils.DEHYPHENATORS[name].dehyphenate_fn(streamed_rows, start, len(streamed_rows))
+
+    assert streamed_rows.to_lines() == rows.to_lines()
+    return rows.to_lines()
+
+
+def postprocess(name: str, lines):
+    rows = utils.HipeRows.from_lines(lines)
+    utils.POSTPROCESSORS[name](rows, 0, len(rows))
+    return rows.to_lines()
+
+
+def test_replace_long_s():
+    assert utils.NORMALIZERS["replace_long_s"]("Waſſer\tO\t_") == "Wasser\tO\t_"
+
+
+def test_dehyphenate_not_sign_row():
+    lines = [hipe_row("Po"), hipe_row("¬"), hipe_row("len"), hipe_row("kamen")]
+
+    assert dehyphenate("not_sign_row", lines) == [
+        hipe_row("Polen", "_|Dehyphenated-3"), hipe_row("#¬", "_|Commented"), hipe_row("#len", "_|Commented"),
+        hipe_row("kamen"),
+    ]
+
+    # Without a prefix in the first row, or a suffix after the last row, nothing is de-hyphenated
+    assert dehyphenate("not_sign_row", [hipe_row("¬"), hipe_row("len")]) == [hipe_row("¬"), hipe_row("len")]
+    assert dehyphenate("not_sign_row", [hipe_row("Po"), hipe_row("¬")]) == [hipe_row("Po"), hipe_row("¬")]
+
+
+def test_dehyphenate_hyphen_row():
+    lines = [hipe_row("Po"), hipe_row("-", "NoSpaceAfter"), hipe_row("len"), hipe_row("kamen")]
+
+    assert dehyphenate("hyphen_row", lines) == [
+        hipe_row("Polen", "_|Dehyphenated-3"), hipe_row("# -", "NoSpaceAfter|Commented"),
+        hipe_row("# len", "_|Commented"), hipe_row("kamen"),
+    ]
+
+    # A hyphen with a space after it is no hyphenation, neither is a hyphen in the first or last row
+    unchanged_lines = [
+        [hipe_row("Po"), hipe_row("-"), hipe_row("len")],
+        [hipe_row("-", "NoSpaceAfter"), hipe_row("len")],
+        [hipe_row("Po"), hipe_row("-", "NoSpaceAfter")],
+    ]
+    for lines in unchanged_lines:
+        assert dehyphenate("hyphen_row", lines) == lines
+
+
+def test_dehyphenate_trailing_not_sign():
+    lines = [hipe_row("den"), hipe_row("Ver¬"), hipe_row("einigten", "SpaceAfter"), hipe_row("Staaten")]
+
+    assert dehyphenate("trailing_not_sign", lines) == [
+        hipe_row("den"), hipe_row("Vereinigten", "_|Dehyphenated-8"), hipe_row("# einigten", "SpaceAfter|Commented"),
+        hipe_row("Staaten"),
+    ]
+
+    # A trailing "¬" in the last row has no suffix
+    assert dehyphenate("trailing_not_sign", [hipe_row("Ver¬")]) == [hipe_row("Ver¬")]
+    assert dehyphenate("trailing_not_sign", [hipe_row("einigten"), hipe_row("Ver¬")]) == [
+        hipe_row("einigten"), hipe_row("Ver¬")
+    ]
+
+
+def test_postprocessors():
+    assert postprocess("comment_not_sign_rows", [hipe_row("¬"), hipe_row("Polen")]) == [
+        hipe_row("#¬", "_|Commented"), hipe_row("Polen")
+    ]
+    # Single column rows (e.g. "-DOCSTART-") are no hyphen rows
+    assert postprocess("comment_hyphen_rows", ["-", hipe_row("Polen"), hipe_row("-")]) == [
+        "-", hipe_row("Polen"), hipe_row("# -", "_|Commented")
+    ]
+    assert postprocess("beautify_commented", [hipe_row("# -", "_|Commented"), hipe_row("x", "_|Commented")]) == [
+        hipe_row("# -", "Commented"), hipe_row("x", "_|Commented")
+    ]
+
+
+def test_dehyphenation_at_block_boundaries(tmp_path, monkeypatch):
+    header = "TOKEN\tNE-COARSE-LIT\tNE-COARSE-METO\tMISC"
+    cases = {
+        "hipe2020": (
+            [hipe_row("Die"), hipe_row("Po"), hipe_row("¬"), hipe_row("len"), hipe_row("kamen")],
+            [hipe_row("Die"), hipe_row("Polen", "_|Dehyphenated-3"), hipe_row("#¬", "Commented"),
+             hipe_row("#len", "Commented"), hipe_row("kamen")],
+        ),
+        "newseye/fi": (
+            [hipe_row("Die"), hipe_row("Po"), hipe_row("-", "NoSpaceAfter"), hipe_row("len"), hipe_row("kamen")],
+            [hipe_row("Die"), hipe_row("Polen", "_|Dehyphenated-3"), hipe_row("# -", "NoSpaceAfter|Commented"),
+             hipe_row("# len", "Commented"), hipe_row("kamen")],
+        ),
+        "newseye/de": (
+            [hipe_row("den"), hipe_row("Ver¬"), hipe_row("einigten", "SpaceAfter"), hipe_row("Staaten")],
+            [hipe_row("den"), hipe_row("Vereinigten", "_|Dehyphenated-8"),
+             hipe_row("# einigten", "SpaceAfter|Commented"), hipe_row("Staaten")],
+        ),
+    }
+
+    for dataset, (lines, expected_lines) in cases.items():
+        (tmp_path / "input.tsv").write_text("".join(line + "\n" for line in [header, *lines]))
+        stages = utils.PREPROCESSING_STAGES[dataset]
+
+        # Every row is once the last row of a block (the header is the first line of the first block)
+        for block_size in range(1, len(lines) + 2):
+            monkeypatch.setattr(utils, "BLOCK_SIZE", block_size)
+            utils.preprocess_hipe_corpus(tmp_path / "input.tsv", tmp_path / "output.tsv", "EndOfSentence",
+                                         "# hipe2022:document_id", False, stages)
+
+            expected_output = header + "\n\n" + "".join(line + "\n" for line in expected_lines)
+            assert (tmp_path / "output.tsv").read_text() == expected_output, (dataset, block_size)
@@ -0,0 +1,430 @@
+import json
+import logging
+import os
+import random
+import resource
+import time
+import flair
+
+import numpy as np
+import torch
+
+from flair.trainers.plugins.base import TrainerPlugin
+
+from pathlib import Path
+from tabulate import tabulate
+
+from execution_modes import autocast_dtype
+
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger("flair")
+
+
+class TrainingPaused(Exception):
+    """Raised by `EpochCheckpointPlugin`, when training stops at the epoch it should pause after."""
+
+
+class EpochCheckpointPlugin(TrainerPlugin):
+    """Writes a checkpoint every k epochs, from which an interrupted run can be resumed.
+
+    A checkpoint holds model, optimizer, learning rate scheduler and RNG states, the best dev score so far and the
+    size of training.log at that point. To resume, the run is created as before, `load()` returns the epoch that
+    training has to be started from (`epoch` of `fine_tune`) and the states are restored before the next epoch starts.
+
+    With `pause_after_epoch`, training is stopped after that epoch by raising `TrainingPaused`, once its checkpoint is
+    written. The run is continued later, like an interrupted one. With `save_every_k_epochs=0`, only that checkpoint is
+    written.
+    """
+
+    checkpoint_name = "checkpoint.pt"
+
+    def __init__(
+        self, base_path: Union[str, Path], save_every_k_epochs: int = 1, pause_after_epoch: Optional[int] = None
+    ):
+        super().__init__()
+        self.base_path = Path(base_path)
+        self.save_every_k_epochs = save_every_k_epochs
+        self.pause_after_epoch = pause_after_epoch
+
+        self.checkpoint: Optional[dict] = None
+        self.start_epoch = 0
+        self.last_epoch = 0
+        self.best_score: Optional[float] = None
+        self.previous_training_log = ""
+
+    @property
+    def checkpoint_file(self) -> Path:
+        return self.base_path / self.checkpoint_name
+
+    @property
+    def best_model_backup_file(self) -> Path:
+        return self.base_path / "best-model.pt.resumed"
+
+    def load(self) -> int:
+        if not self.checkpoint_file.exists():
+            return 0
+
+        self.checkpoint = torch.load(self.checkpoint_file, map_location="cpu", weights_only=False)
+        self.start_epoch = self.last_epoch = self.checkpoint["epoch"]
+        self.best_score = self.checkpoint["best_score"]
+
+        training_log = self.base_path / "training.log"
+        if training_log.exists():
+            training_log_size = self.checkpoint["training_log_size"]
+            self.previous_training_log = training_log.read_bytes()[:training_log_size].decode("utf-8")
+
+        # Interrupted while a worse model was written as best model
+        self._restore_best_model()
+
+        logger.info(f"Resuming {self.base_path} from checkpoint of epoch {self.start_epoch}")
+        return self.start_epoch
+
+    def remove(self):
+        self.checkpoint_file.unlink(missing_ok=True)
+
+    def _restore_best_model(self):
+        if self.best_model_backup_file.exists():
+            os.replace(self.best_model_backup_file, self.base_path / "best-model.pt")
+
+    def _training_log_handlers(self):
+        training_log = os.path.abspath(self.base_path / "training.log")
+
+        return [
+            handler
+            for handler in logger.handlers
+            if isinstance(handler, logging.FileHandler) and handler.baseFilename == training_log
+        ]
+
+    def _save(self, epoch: int):
+        for handler in self._training_log_handlers():
+            handler.flush()
+
+        training_log = self.base_path / "training.log"
+
+        checkpoint = {
+            "epoch": epoch,
+            "best_score": self.best_score,
+            "model_state": self.model.state_dict(),
+            "optimizer_state": self.trainer.optimizer.state_dict(),
+            "scheduler_states": [
+                plugin.scheduler.state_dict() for plugin in self.trainer.plugins if hasattr(plugin, "scheduler")
+            ],
+            "rng_states": {
+                "python": random.getstate(),
+                "numpy": np.random.get_state(),
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            },
+            "training_log_size": training_log.stat().st_size if training_log.exists() else 0,
+        }
+
+        # Written atomically, an interrupted write must not destroy the previous checkpoint
+        temp_file = self.checkpoint_file.with_suffix(".tmp")
+        torch.save(checkpoint, temp_file)
+        os.replace(temp_file, self.checkpoint_file)
+
+        logger.info(f"Saved checkpoint of epoch {epoch}")
+
+    def _restore(self):
+        checkpoint, self.checkpoint = self.checkpoint, None
+
+        self.model.load_state_dict(checkpoint["model_state"])
+        self.trainer.optimizer.load_state_dict(checkpoint["optimizer_state"])
+
+        schedulers = [plugin.scheduler for plugin in self.trainer.plugins if hasattr(plugin, "scheduler")]
+        for scheduler, scheduler_state in zip(schedulers, checkpoint["scheduler_states"]):
+            scheduler.load_state_dict(scheduler_state)
+
+        rng_states = checkpoint["rng_states"]
+        random.setstate(rng_states["python"])
+        np.random.set_state(rng_states["numpy"])
+        torch.set_rng_state(rng_states["torch"])
+        if rng_states["cuda"] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_states["cuda"])
+
+    @TrainerPlugin.hook
+    def after_setup(self, **kwargs):
+        if self.checkpoint is None:
+            return
+
+        # The trainer has truncated training.log: restore it as it was at the time of the checkpoint, so it contains
+        # the dev scores of all epochs
+        for handler in self._training_log_handlers():
+            handler.stream.write(self.previous_training_log)
+            handler.flush()
+
+        logger.info(f"Resuming from epoch {self.start_epoch}")
+
+    @TrainerPlugin.hook
+    def before_training_epoch(self, epoch: int, **kwargs):
+        # Schedulers are created in their after_setup, so states are restored here
+        if self.checkpoint is not None:
+            self._restore()
+        elif epoch - 1 > self.start_epoch:
+            if epoch - 1 == self.pause_after_epoch:
+                self._save(epoch - 1)
+                raise TrainingPaused(f"Paused after epoch {epoch - 1}")
+
+            if self.save_every_k_epochs > 0 and (epoch - 1) % self.save_every_k_epochs == 0:
+                self._save(epoch - 1)
+
+        self._restore_best_model()
+        self.last_epoch = epoch
+
+    @TrainerPlugin.hook
+    def after_evaluation(self, current_model_is_best: bool, validation_scores: tuple, **kwargs):
+        if not current_model_is_best or not self.corpus.dev:
+            return
+
+        score = validation_scores[0]
+
+        if self.best_score is not None and score <= self.best_score:
+            # The trainer only knows the dev scores since resuming, and would replace the best model of an earlier
+            # epoch. It is restored before the next epoch (or the final evaluation)
+            best_model_file = self.base_path / "best-model.pt"
+            if best_model_file.exists():
+                os.replace(best_model_file, self.best_model_backup_file)
+            return
+
+        self.best_score = score
+
+    @TrainerPlugin.hook
+    def after_training_loop(self, **kwargs):
+        self._restore_best_model()
+
+        # Checkpoint after the last epoch, so an interruption during the final evaluation does not repeat training
+        if self.checkpoint is None and self.last_epoch > self.start_epoch:
+            self._save(self.last_epoch)
+
+    @property
+    def attach_to_all_processes(self) -> bool:
+        return False
+
+    def get_state(self) -> dict:
+        return {
+            **super().get_state(),
+            "base_path": str(self.base_path),
+            "save_every_k_epochs": self.save_every_k_epochs,
+            "pause_after_epoch": self.pause_after_epoch,
+        }
+
+
+# Phases of a training step, that the profiling plugin measures. "data" is the time between two batches: loading and
+# batching of the next mini-batch, but also other plugins (e.g. the learning rate scheduler)
+PROFILING_PHASES = ["data", "embeddings", "tagger", "backward", "optimizer", "evaluation"]
+
+
+class ProfilingPlugin(TrainerPlugin):
+    """Records where the time of a training run goes, per training step.
+
+    Every mini-batch is split into data/batching, embedding forward (`embed` of the tagger's embeddings), the rest of
+    the tagger's forward pass and loss, backward pass and optimizer step. Dev evaluation is measured per epoch. Also
+    recorded are tokens/s and bytes/s (UTF-8 bytes of the sentences, the input size of ByT5), peak RSS and peak CUDA
+    memory.
+
+    Results are written to `profile.json` in the output path, a summary table is logged at the end of training. On
+    CUDA devices, the device is synchronized at every phase boundary, so that phases are not mixed up by asynchronous
+    kernels: this slows down training a bit.
+    """
+
+    profile_name = "profile.json"
+
+    def __init__(self, base_path: Union[str, Path]):
+        super().__init__()
+        self.base_path = Path(base_path)
+
+        self.batches: List[dict] = []
+        self.epochs: List[dict] = []
+
+        self._in_batch = False
+        self._last_time = 0.0
+        self._batch_start_time = 0.0
+        self._optimizer_step_time = 0.0
+        self._forward_time = 0.0
+        self._embeddings_time = 0.0
+        self._epoch: Dict[str, float] = {}
+
+    @property
+    def profile_file(self) -> Path:
+        return self.base_path / self.profile_name
+
+    def _now(self) -> float:
+        if flair.device.type == "cuda":
+            torch.cuda.synchronize(flair.device)
+        return time.perf_counter()
+
+    def _timed(self, function, attribute: str):
+        # Only calls during training steps are counted, the same functions are also used for evaluation
+        def timed_function(*args, **kwargs):
+            if not self._in_batch:
+                return function(*args, **kwargs)
+
+            start_time = self._now()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                setattr(self, attribute, getattr(self, attribute) + self._now() - start_time)
+
+        return timed_function
+
+    @TrainerPlugin.hook
+    def after_setup(self, **kwargs):
+        # Wrapped per instance, model files only store the parameters of the embeddings
+        self.model.forward_loss = self._timed(self.model.forward_loss, "_forward_time")
+        self.model.embeddings.embed = self._timed(self.model.embeddings.embed, "_embeddings_time")
+
+        if flair.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(flair.device)
+
+    @TrainerPlugin.hook
+    def before_training_epoch(self, epoch: int, **kwargs):
+        self._epoch = {"epoch": epoch, "tokens": 0, "bytes": 0, **{phase: 0.0 for phase in PROFILING_PHASES}}
+        self._last_time = self._now()
+
+    @TrainerPlugin.hook
+    def before_training_batch(self, batch: list, **kwargs):
+        self._batch_start_time = self._now()
+        self._forward_time = self._embeddings_time = 0.0
+        self._in_batch = True
+
+    @TrainerPlugin.hook
+    def before_training_optimizer_step(self, **kwargs):
+        self._in_batch = False
+        self._optimizer_step_time = self._now()
+
+    @TrainerPlugin.hook
+    def after_training_batch(self, batch: list, epoch: int, batch_no: int, **kwargs):
+        end_time = self._now()
+
+        phases = {
+            "data": self._batch_start_time - self._last_time,
+            "embeddings": self._embeddings_time,
+            "tagger": self._forward_time - self._embeddings_time,
+            "backward": self._optimizer_step_time - self._batch_start_time - self._forward_time,
+            "optimizer": end_time - self._optimizer_step_time,
+        }
+        self._last_time = end_time
+
+        tokens = sum(len(sentence) for sentence in batch)
+        number_of_bytes = sum(len(sentence.to_original_text().encode("utf-8")) for sentence in batch)
+
+        self.batches.append(
+            {"epoch": epoch, "batch": batch_no, "tokens": tokens, "bytes": number_of_bytes, **phases}
+        )
+
+        self._epoch["tokens"] += tokens
+        self._epoch["bytes"] += number_of_bytes
+        for phase, elapsed in phases.items():
+            self._epoch[phase] += elapsed
+
+    @TrainerPlugin.hook
+    def after_training_epoch(self, **kwargs):
+        self._last_time = self._now()
+
+    @TrainerPlugin.hook
+    def after_evaluation(self, **kwargs):
+        self._epoch["evaluation"] = self._now() - self._last_time
+        self._epoch.update(self._memory())
+        self.epochs.append(self._epoch)
+
+    def _memory(self) -> Dict[str, float]:
+        # ru_maxrss is given in kilobytes on Linux
+        memory = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+        if flair.device.type == "cuda":
+            memory["peak_cuda_memory_mb"] = torch.cuda.max_memory_allocated(flair.device) / 2**20
+
+        return memory
+
+    def summary(self) -> dict:
+        totals = {phase: sum(epoch[phase] for epoch in self.epochs) for phase in PROFILING_PHASES}
+        training_time = sum(totals[phase] for phase in PROFILING_PHASES if phase != "evaluation")
+
+        tokens = sum(epoch["tokens"] for epoch in self.epochs)
+        number_of_bytes = sum(epoch["bytes"] for epoch in self.epochs)
+
+        return {
+            "device": str(flair.device),
+            "epochs": len(self.epochs),
+            "batches": len(self.batches),
+            "phases": totals,
+            "tokens_per_second": tokens / training_time if training_time else 0.0,
+            "bytes_per_second": number_of_bytes / training_time if training_time else 0.0,
+            **self._memory(),
+        }
+
+    @TrainerPlugin.hook
+    def _training_finally(self, **kwargs):
+        # Also reached, when training is paused or interrupted
+        self.model.__dict__.pop("forward_loss", None)
+        self.model.embeddings.__dict__.pop("embed", None)
+        self._in_batch = False
+
+        if not self.epochs:
+            return
+
+        summary = self.summary()
+
+        with open(self.profile_file, "wt") as f_p:
+            json.dump({"summary": summary, "epochs": self.epochs, "batches": self.batches}, f_p, indent=2)
+
+        total_time = sum(summary["phases"].values())
+        number_of_batches = max(len(self.batches), 1)
+
+        table = [
+            [
+                phase,
+                round(elapsed, 2),
+                round(100 * elapsed / total_time, 1) if total_time else 0.0,
+                round(1000 * elapsed / (len(self.epochs) if phase == "evaluation" else number_of_batches), 2),
+            ]
+            for phase, elapsed in summary["phases"].items()
+        ]
+        header = ["Phase", "Time (s)", "Share (%)", "Mean per batch/evaluation (ms)"]
+
+        logger.info("Training profile:\n" + tabulate(table, headers=header, tablefmt="github"))
+        memory_info = f"peak RSS: {summary['peak_rss_mb']:.1f} MB"
+        if "peak_cuda_memory_mb" in summary:
+            memory_info += f" - peak CUDA memory: {summary['peak_cuda_memory_mb']:.1f} MB"
+
+        logger.info(
+            f"Tokens/s: {summary['tokens_per_second']:.1f} - bytes/s: {summary['bytes_per_second']:.1f} - {memory_info}"
+        )
+        logger.info(f"Wrote profile to {self.profile_file}")
+
+    @property
+    def attach_to_all_processes(self) -> bool:
+        return False
+
+    def get_state(self) -> dict:
+        return {**super().get_state(), "base_path": str(self.base_path)}
+
+
+class ExecutionModePlugin(TrainerPlugin):
+    """Records precision and compile mode of a run in training.log and the model card.
+
+    Training with autocast is enabled by `use_amp` of `fine_tune`, this plugin selects its dtype (bf16 or fp16) for the
+    duration of training.
+    """
+
+    def __init__(self, precision: str, compile_mode: str):
+        super().__init__()
+        self.precision = precision
+        self.compile_mode = compile_mode
+
+    @TrainerPlugin.hook
+    def after_setup(self, use_amp: bool, **kwargs):
+        if use_amp != (self.precision != "fp32"):
+            logger.warning(f"Precision {self.precision} does not match use_amp={use_amp} of the trainer")
+
+        self.trainer.context_stack.enter_context(autocast_dtype(flair.device, self.precision))
+
+        logger.info(f"Execution mode: precision {self.precision}, torch.compile {self.compile_mode}")
+        self.model.model_card["execution_mode"] = {"precision": self.precision, "compile": self.compile_mode}
+
+    def __str__(self) -> str:
+        return f"ExecutionModePlugin(precision={self.precision}, compile={self.compile_mode})"
+
+    def get_state(self) -> dict:
+        return {**super().get_state(), "precision": self.precision, "compile_mode": self.compile_mode}
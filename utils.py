@@ -1,385 +1,397 @@
-from flair.data import Sentence
-from flair.embeddings import TransformerWordEmbeddings
+import functools
 
 from pathlib import Path
 
-from typing import List
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
 
+# HIPE-2022 preprocessing is one fused pass over the corpus. Normalizers work on the raw lines, afterwards lines are
+# read in blocks into a columnar representation (HipeRows), on which de-hyphenation and post-processing are index
+# operations. Blocks are written as soon as their rows are final, so memory usage does not depend on the corpus size.
+# De-hyphenation only looks back at the (at most two) previous rows, which are kept for the next block.
+#
+# Stages are registered by name, and datasets select their stages in PREPROCESSING_STAGES.
 
-def prepare_ajmc_corpus(
-    file_in: Path, file_out: Path, eos_marker: str, document_separator: str, add_document_separator: bool
-):
-    with open(file_in, "rt") as f_p:
-        lines = f_p.readlines()
+# Row flags
+COMMENTED = 1
+DOCUMENT_START = 2
 
-    with open(file_out, "wt") as f_out:
-        # Add missing newline after header
-        f_out.write(lines[0] + "\n")
+# Number of lines that are read, processed and written at once
+BLOCK_SIZE = 4096
 
-        for line in lines[1:]:
-            if line.startswith(" \t"):
-                # Workaround for empty tokens
-                continue
 
-            line = line.strip()
+def _row_flags(token: str) -> int:
+    return (COMMENTED if token.startswith("#") else 0) | (DOCUMENT_START if token.startswith("-DOCSTART-") else 0)
 
-            # HIPE-2022 late pre-submission fix:
-            # Our hmBERT model has never seen Fraktur, so we replace long s
-            line = line.replace("ſ", "s")
 
-            # Add "real" document marker
-            if add_document_separator and line.startswith(document_separator):
-                f_out.write("-DOCSTART- O\n\n")
+class HipeRows:
+    """Columnar block of HIPE-2022 TSV rows.
 
-            f_out.write(line + "\n")
+    Every row is stored as token, NE tag columns (tab-separated, as they are never modified) and MISC column in
+    parallel lists, plus a flag per row. Rows with a single column (e.g. comments, empty lines or "-DOCSTART-") only
+    have a token, rows with two columns have no NE tags.
+    """
 
-            if eos_marker in line:
-                    f_out.write("\n")
+    def __init__(self):
+        self.tokens: List[str] = []
+        self.tags: List[Optional[str]] = []
+        self.misc: List[Optional[str]] = []
+        self.flags = bytearray()
 
-    print("Special preprocessing for AJMC has finished!")
+    @classmethod
+    def from_lines(cls, lines: List[str]) -> "HipeRows":
+        rows = cls()
+        rows.extend(lines)
+        return rows
 
+    def __len__(self) -> int:
+        return len(self.tokens)
 
-def prepare_clef_2020_corpus(
-        file_in: Path, file_out: Path, eos_marker: str, document_separator: str, add_document_separator: bool
-):
-    with open(file_in, "rt") as f_p:
-        original_lines = f_p.readlines()
+    def extend(self, lines: List[str]):
+        token_columns = [line.partition("\t") for line in lines]
+        tag_columns = [columns.rpartition("\t") if separator else None for _, separator, columns in token_columns]
 
-    lines = []
+        tokens = [token for token, _, _ in token_columns]
+        start = len(self.tokens)
 
-    # Add missing newline after header
-    lines.append(original_lines[0])
+        self.tokens.extend(tokens)
+        self.tags.extend([columns[0] if columns and columns[1] else None for columns in tag_columns])
+        self.misc.extend([columns[2] if columns else None for columns in tag_columns])
+        self.flags.extend(bytes(len(tokens)))
 
-    for line in original_lines[1:]:
-        if line.startswith(" \t"):
-            # Workaround for empty tokens
-            continue
+        # Only few rows are flagged
+        for index in [index for index, token in enumerate(tokens) if token.startswith(("#", "-DOCSTART-"))]:
+            self.flags[start + index] = _row_flags(tokens[index])
 
-        line = line.strip()
+    def set_token(self, index: int, token: str):
+        self.tokens[index] = token
+        self.flags[index] = _row_flags(token)
 
-        # Add "real" document marker
-        if add_document_separator and line.startswith(document_separator):
-            lines.append("-DOCSTART- O")
-            lines.append("")
+    def comment(self, index: int, comment_prefix: str):
+        if self.misc[index] is None:
+            # Token is also the last column
+            self.set_token(index, comment_prefix + self.tokens[index] + "|Commented")
+            return
 
-        lines.append(line)
+        self.set_token(index, comment_prefix + self.tokens[index])
+        self.misc[index] += "|Commented"
 
-        if eos_marker in line:
-            lines.append("")
+    def to_lines(self, end: Optional[int] = None) -> List[str]:
+        return [
+            token if misc is None else (f"{token}\t{misc}" if tags is None else f"{token}\t{tags}\t{misc}")
+            for token, tags, misc in zip(self.tokens[:end], self.tags[:end], self.misc[:end])
+        ]
 
-    # Now here comes the de-hyphenation part ;)
-    word_seperator = "¬"
+    def drop(self, end: int):
+        # Removes the first rows, once they are written
+        del self.tokens[:end]
+        del self.tags[:end]
+        del self.misc[:end]
+        del self.flags[:end]
 
-    for index, line in enumerate(lines):
-        if line.startswith("#"):
-            continue
 
-        if line.startswith(word_seperator):
-            continue
+# De-hyphenation and post-processing rules are called with a block of rows and the range of rows to process
+RowRule = Callable[[HipeRows, int, int], None]
 
-        if not line:
-            continue
 
-        prev_line = lines[index - 1]
+class Dehyphenator(NamedTuple):
+    # Number of previous rows, that the de-hyphenation rule may modify
+    previous_rows: int
+    # Called with every range of new rows. Rules only look at the current and previous rows, so processing a range in
+    # order gives the same result as processing row by row
+    dehyphenate_fn: RowRule
 
-        prev_prev_line = lines[index - 2]
 
-        if not prev_line.startswith(word_seperator):
-            continue
+class PreprocessingStages(NamedTuple):
+    # Applied to every (stripped) line when it is read
+    normalizers: Sequence[str] = ()
+    dehyphenation: Optional[str] = None
+    # Applied to rows once they are final (after de-hyphenation)
+    postprocessors: Sequence[str] = ()
 
-        # Example:
-        # Po  <- prev_prev_line
-        # ¬   <- prev_line
-        # len <- current_line
-        #
-        # will be de-hyphenated to:
-        #
-        # Polen Dehyphenated-3
-        # # ¬
-        # # len
-        suffix = line.split("\t")[0]
-
-        prev_prev_line_splitted = lines[index - 2].split("\t")
-        prev_prev_line_splitted[0] += suffix
-
-        prev_line_splitted = lines[index - 1].split("\t")
-        prev_line_splitted[0] = "#" + prev_line_splitted[0]
-        prev_line_splitted[-1] += "|Commented"
-
-        current_line_splitted = line.split("\t")
-        current_line_splitted[0] = "#" + current_line_splitted[0]
-        current_line_splitted[-1] += "|Commented"
 
-        # Add some meta information about suffix length
-        # Later, it is possible to re-construct original token and suffix
-        prev_prev_line_splitted[9] += f"|Dehyphenated-{len(suffix)}"
+NORMALIZERS: Dict[str, Callable[[str], str]] = {}
 
-        lines[index - 2] = "\t".join(prev_prev_line_splitted)
-        lines[index - 1] = "\t".join(prev_line_splitted)
-        lines[index] = "\t".join(current_line_splitted)
+DEHYPHENATORS: Dict[str, Dehyphenator] = {}
 
-    # Post-Processing I
-    for index, line in enumerate(lines):
-        if not line:
-            continue
+POSTPROCESSORS: Dict[str, RowRule] = {}
 
-        if not line.startswith(word_seperator):
-            continue
-
-        # oh noooo
-        current_line_splitted = line.split("\t")
-        current_line_splitted[0] = "#" + current_line_splitted[0]
 
-        current_line_splitted[-1] += "|Commented"
+def register_normalizer(name: str):
+    def decorator(normalize_fn: Callable[[str], str]):
+        NORMALIZERS[name] = normalize_fn
+        return normalize_fn
 
-        lines[index] = "\t".join(current_line_splitted)
+    return decorator
 
-    # Post-Processing II
-    # Beautify: _|Commented –> Commented
-    for index, line in enumerate(lines):
-        if not line:
-            continue
 
-        if not line.startswith("#"):
-            continue
+def register_dehyphenator(name: str, previous_rows: int):
+    def decorator(dehyphenate_fn: RowRule):
+        DEHYPHENATORS[name] = Dehyphenator(previous_rows, dehyphenate_fn)
+        return dehyphenate_fn
 
-        current_line_splitted = line.split("\t")
+    return decorator
 
-        if current_line_splitted[-1] == "_|Commented":
-            current_line_splitted[-1] = "Commented"
-            lines[index] = "\t".join(current_line_splitted)
 
-    # Finally, save it!
-    with open(file_out, "wt") as f_out:
-        for line in lines:
-            f_out.write(line + "\n")
+def register_postprocessor(name: str):
+    def decorator(postprocess_fn: RowRule):
+        POSTPROCESSORS[name] = postprocess_fn
+        return postprocess_fn
 
+    return decorator
 
-def prepare_newseye_fi_sv_corpus(
-    file_in: Path, file_out: Path, eos_marker: str, document_separator: str, add_document_separator: bool
-):
-    with open(file_in, "rt") as f_p:
-        original_lines = f_p.readlines()
 
-    lines = []
+@register_normalizer("replace_long_s")
+def replace_long_s(line: str) -> str:
+    # HIPE-2022 late pre-submission fix:
+    # Our hmBERT model has never seen Fraktur, so we replace long s
+    return line.replace("ſ", "s")
 
-    # Add missing newline after header
-    lines.append(original_lines[0])
 
-    for line in original_lines[1:]:
-        if line.startswith(" \t"):
-            # Workaround for empty tokens
-            continue
+@register_postprocessor("comment_not_sign_rows")
+def comment_not_sign_rows(rows: HipeRows, start: int, end: int):
+    # Remaining rows with a standalone "¬", that were not de-hyphenated
+    tokens = rows.tokens
 
-        line = line.strip()
+    for index in [index for index in range(start, end) if tokens[index].startswith("¬")]:
+        rows.comment(index, "#")
 
-        # Add "real" document marker
-        if add_document_separator and line.startswith(document_separator):
-            lines.append("-DOCSTART- O")
-            lines.append("")
 
-        lines.append(line)
+@register_postprocessor("comment_hyphen_rows")
+def comment_hyphen_rows(rows: HipeRows, start: int, end: int):
+    # Remaining rows with a standalone "-", that were not de-hyphenated
+    tokens, misc = rows.tokens, rows.misc
 
-        if eos_marker in line:
-            lines.append("")
+    for index in [index for index in range(start, end) if tokens[index] == "-" and misc[index] is not None]:
+        rows.comment(index, "# ")
 
-    # Now here comes the de-hyphenation part
-    # And we want to avoid matching "-DOCSTART-" lines here, so append a tab
-    word_seperator = "-\t"
 
-    for index, line in enumerate(lines):
-        if line.startswith("#"):
+@register_postprocessor("beautify_commented")
+def beautify_commented(rows: HipeRows, start: int, end: int):
+    # Beautify: _|Commented –> Commented
+    flags, misc = rows.flags, rows.misc
+
+    for index in range(start, end):
+        if flags[index] & COMMENTED and misc[index] == "_|Commented":
+            misc[index] = "Commented"
+
+
+@register_dehyphenator("not_sign_row", previous_rows=2)
+def dehyphenate_not_sign_row(rows: HipeRows, start: int, end: int):
+    # Example:
+    # Po  <- index - 2
+    # ¬   <- index - 1
+    # len <- index
+    #
+    # will be de-hyphenated to:
+    #
+    # Polen Dehyphenated-3
+    # # ¬
+    # # len
+    tokens = rows.tokens
+
+    # Commenting never turns a row into a "¬" row, so candidates can be selected upfront
+    candidates = [index for index in range(max(start, 2), end) if tokens[index - 1].startswith("¬")]
+
+    for index in candidates:
+        suffix = tokens[index]
+
+        if not tokens[index - 1].startswith("¬") or not suffix or rows.flags[index] & COMMENTED or suffix[0] == "¬":
             continue
 
-        if line.startswith(word_seperator):
-            continue
+        tokens[index - 2] += suffix
 
-        if not line:
+        # Add some meta information about suffix length
+        # Later, it is possible to re-construct original token and suffix
+        rows.misc[index - 2] += f"|Dehyphenated-{len(suffix)}"
+
+        rows.comment(index - 1, "#")
+        rows.comment(index, "#")
+
+
+@register_dehyphenator("hyphen_row", previous_rows=2)
+def dehyphenate_hyphen_row(rows: HipeRows, start: int, end: int):
+    # Example:
+    # Po  NoSpaceAfter <- index - 2
+    # -   <- index - 1
+    # len <- index
+    #
+    # will be de-hyphenated to:
+    #
+    # Polen Dehyphenated-3
+    # # -
+    # # len
+    #
+    # It is really important, that "NoSpaceAfter" in the previous
+    # row before hyphenation character! Otherwise, it is no real
+    # hyphenation!
+    tokens, tags, misc = rows.tokens, rows.tags, rows.misc
+
+    # Standalone hyphen rows have more than one column, so that "-DOCSTART-" rows are not matched. Commenting never
+    # turns a row into a hyphen row, so candidates can be selected upfront
+    candidates = [
+        index for index in range(max(start, 2), end) if tokens[index - 1] == "-" and misc[index - 1] is not None
+    ]
+
+    for index in candidates:
+        suffix = tokens[index]
+
+        if tokens[index - 1] != "-" or not suffix or rows.flags[index] & COMMENTED:
             continue
 
-        prev_line = lines[index - 1]
-
-        prev_prev_line = lines[index - 2]
-
-        if not prev_line.startswith(word_seperator):
+        if suffix == "-" and misc[index] is not None:
             continue
 
-        # Example:
-        # Po  NoSpaceAfter <- prev_prev_line
-        # -   <- prev_line
-        # len <- current_line
-        #
-        # will be de-hyphenated to:
-        #
-        # Polen Dehyphenated-3
-        # # -
-        # # len
-        #
-        # It is really important, that "NoSpaceAfter" in the previous
-        # line before hyphenation character! Otherwise, it is no real
-        # hyphenation!
-
-        if not "NoSpaceAfter" in prev_line:
+        if "NoSpaceAfter" not in misc[index - 1] and "NoSpaceAfter" not in (tags[index - 1] or ""):
             continue
 
-        if not prev_prev_line:
+        if not tokens[index - 2]:
             continue
 
-        suffix = line.split("\t")[0]
-
-        prev_prev_line_splitted = lines[index - 2].split("\t")
-        prev_prev_line_splitted[0] += suffix
-
-        prev_line_splitted = lines[index - 1].split("\t")
-        prev_line_splitted[0] = "# " + prev_line_splitted[0]
-        prev_line_splitted[-1] += "|Commented"
-
-        current_line_splitted = line.split("\t")
-        current_line_splitted[0] = "# " + current_line_splitted[0]
-        current_line_splitted[-1] += "|Commented"
+        tokens[index - 2] += suffix
 
         # Add some meta information about suffix length
         # Later, it is possible to re-construct original token and suffix
-        prev_prev_line_splitted[9] += f"|Dehyphenated-{len(suffix)}"
-
-        lines[index - 2] = "\t".join(prev_prev_line_splitted)
-        lines[index - 1] = "\t".join(prev_line_splitted)
-        lines[index]     = "\t".join(current_line_splitted)
-
-    # Post-Processing I
-    for index, line in enumerate(lines):
-        if not line:
+        misc[index - 2] += f"|Dehyphenated-{len(suffix)}"
+
+        rows.comment(index - 1, "# ")
+        rows.comment(index, "# ")
+
+
+@register_dehyphenator("trailing_not_sign", previous_rows=1)
+def dehyphenate_trailing_not_sign(rows: HipeRows, start: int, end: int):
+    # The following example
+    #
+    # den   O   O   O   null    null    SpaceAfter
+    # Ver¬  B-LOC   O   O   null    n                  <- index - 1
+    # einigten  I-LOC   O   O   null    n   SpaceAfter <- index
+    # Staaten   I-LOC   O   O   null    n
+    # . O   O   O   null    null
+    #
+    # will be transformed to:
+    #
+    # den   O   O   O   null    null    SpaceAfter
+    # Vereinigten   B-LOC   O   O   null    n   |Dehyphenated-8
+    # # einigten I-LOC   O   O   null    n   SpaceAfter|Commented
+    # Staaten   I-LOC   O   O   null    n
+    # . O   O   O   null    null
+    tokens = rows.tokens
+
+    # Only the row at the candidate itself gets a new trailing "¬" (from its prefix), so candidates can be selected
+    # upfront
+    candidates = [index for index in range(max(start, 1), end) if tokens[index - 1].endswith("¬")]
+
+    for index in candidates:
+        prefix = tokens[index]
+
+        if not tokens[index - 1].endswith("¬") or not prefix or rows.flags[index] & COMMENTED:
             continue
 
-        if not line.startswith(word_seperator):
-            continue
-
-        # oh noooo
-        current_line_splitted = line.split("\t")
-        current_line_splitted[0] = "# " + current_line_splitted[0]
-
-        current_line_splitted[-1] += "|Commented"
-
-        lines[index] = "\t".join(current_line_splitted)
-
-    # Post-Processing II
-    # Beautify: _|Commented –> Commented
-    for index, line in enumerate(lines):
-        if not line:
-            continue
-
-        if not line.startswith("#"):
-            continue
-
-        current_line_splitted = line.split("\t")
-
-        if current_line_splitted[-1] == "_|Commented":
-            current_line_splitted[-1] = "Commented"
-            lines[index] = "\t".join(current_line_splitted)
-
-    # Finally, save it!
-    with open(file_out, "wt") as f_out:
-        for line in lines:
-            f_out.write(line + "\n")
-
-
-def prepare_newseye_de_fr_corpus(
-    file_in: Path, file_out: Path, eos_marker: str, document_separator: str, add_document_separator: bool
+        # Ver¬ will be transformed to Vereinigten with normalized information at the end
+        rows.set_token(index - 1, tokens[index - 1].replace("¬", "") + prefix)
+        rows.misc[index - 1] += f"|Dehyphenated-{len(prefix)}"
+
+        rows.comment(index, "# ")
+
+
+# Preprocessing stages per dataset, or per dataset and language. Datasets without an entry use Flair's default
+# preprocessing
+PREPROCESSING_STAGES: Dict[str, PreprocessingStages] = {
+    "ajmc": PreprocessingStages(normalizers=["replace_long_s"]),
+    "hipe2020": PreprocessingStages(
+        dehyphenation="not_sign_row", postprocessors=["comment_not_sign_rows", "beautify_commented"]
+    ),
+    "newseye/fi": PreprocessingStages(
+        dehyphenation="hyphen_row", postprocessors=["comment_hyphen_rows", "beautify_commented"]
+    ),
+    "newseye/sv": PreprocessingStages(
+        dehyphenation="hyphen_row", postprocessors=["comment_hyphen_rows", "beautify_commented"]
+    ),
+    "newseye/de": PreprocessingStages(dehyphenation="trailing_not_sign", postprocessors=["beautify_commented"]),
+    "newseye/fr": PreprocessingStages(dehyphenation="trailing_not_sign", postprocessors=["beautify_commented"]),
+}
+
+
+def preprocess_hipe_corpus(
+    file_in: Path,
+    file_out: Path,
+    eos_marker: str,
+    document_separator: str,
+    add_document_separator: bool,
+    stages: PreprocessingStages = PreprocessingStages(),
 ):
-    with open(file_in, "rt") as f_p:
-        original_lines = f_p.readlines()
+    normalize_fns = [NORMALIZERS[name] for name in stages.normalizers]
+    postprocess_fns = [POSTPROCESSORS[name] for name in stages.postprocessors]
 
-    lines = []
+    previous_rows, dehyphenate_fn = 0, None
+    if stages.dehyphenation:
+        previous_rows, dehyphenate_fn = DEHYPHENATORS[stages.dehyphenation]
 
-    # Add missing newline after header
-    lines.append(original_lines[0])
+    split_rows = dehyphenate_fn is not None or len(postprocess_fns) > 0
 
-    for line in original_lines[1:]:
-        if line.startswith(" \t"):
-            # Workaround for empty tokens
-            continue
-
-        line = line.strip()
+    rows = HipeRows()
+    block: List[str] = []
 
-        # Add "real" document marker
-        if add_document_separator and line.startswith(document_separator):
-            lines.append("-DOCSTART- O")
-            lines.append("")
+    def process_block(final: bool):
+        # Only de-hyphenate the new rows, previous rows were kept for the rules to look at (and modify)
+        start = len(rows)
+        rows.extend(block)
+        block.clear()
 
-        lines.append(line)
+        if dehyphenate_fn is not None:
+            dehyphenate_fn(rows, start, len(rows))
 
-        if eos_marker in line:
-            lines.append("")
+        # The last rows can still be modified by de-hyphenation of the next block
+        end = len(rows) if final else max(len(rows) - previous_rows, 0)
 
-    # Now here comes the de-hyphenation part ;)
-    word_seperator = "¬"
+        for postprocess_fn in postprocess_fns:
+            postprocess_fn(rows, 0, end)
 
-    for index, line in enumerate(lines):
-        if line.startswith("#"):
-            continue
+        f_out.write("".join(line + "\n" for line in rows.to_lines(end)))
+        rows.drop(end)
 
-        if not line:
-            continue
+    with open(file_in, "rt") as f_p, open(file_out, "wt") as f_out:
+        # Header keeps its newline, which adds the missing newline after header
+        block.append(next(f_p))
 
-        last_line = lines[index - 1]
-        last_line_splitted = last_line.split("\t")
+        for line in f_p:
+            if line.startswith(" \t"):
+                # Workaround for empty tokens
+                continue
 
-        if not last_line_splitted[0].endswith(word_seperator):
-            continue
+            line = line.strip()
 
-        # The following example
-        #
-        # den   O   O   O   null    null    SpaceAfter
-        # Ver¬  B-LOC   O   O   null    n                  <- last_line
-        # einigten  I-LOC   O   O   null    n   SpaceAfter <- current_line
-        # Staaten   I-LOC   O   O   null    n
-        # . O   O   O   null    null
-        #
-        # will be transformed to:
-        #
-        # den   O   O   O   null    null    SpaceAfter
-        # Vereinigten   B-LOC   O   O   null    n   |Normalized-8
-        # #einigten I-LOC   O   O   null    n   SpaceAfter|Commented
-        # Staaten   I-LOC   O   O   null    n
-        # . O   O   O   null    null
-
-        suffix = last_line.split("\t")[0].replace(word_seperator, "")  # Will be "Ver" 
-
-        prefix_length = len(line.split("\t")[0])
-
-        # Override last_line:
-        # Ver¬ will be transformed to Vereinigten with normalized information at the end
+            for normalize_fn in normalize_fns:
+                line = normalize_fn(line)
 
-        last_line_splitted[0] = suffix + line.split("\t")[0]
+            # Add "real" document marker
+            if add_document_separator and line.startswith(document_separator):
+                block.extend(["-DOCSTART- O", ""])
 
-        last_line_splitted[9] += f"|Dehyphenated-{prefix_length}"
+            block.append(line)
 
-        current_line_splitted = line.split("\t")
-        current_line_splitted[0] = "# " + current_line_splitted[0]
-        current_line_splitted[-1] += "|Commented"
+            if eos_marker in line:
+                block.append("")
 
-        lines[index - 1] = "\t".join(last_line_splitted)
-        lines[index]     = "\t".join(current_line_splitted)
+            if len(block) >= BLOCK_SIZE:
+                if not split_rows:
+                    # Without row stages, lines are written as they are and never split into columns
+                    f_out.write("".join(line + "\n" for line in block))
+                    block.clear()
+                else:
+                    process_block(final=False)
 
-    # Post-Processing I
-    # Beautify: _|Commented –> Commented
-    for index, line in enumerate(lines):
-        if not line:
-            continue
+        process_block(final=True)
 
-        if not line.startswith("#"):
-            continue
 
-        current_line_splitted = line.split("\t")
+def get_preprocessing_stages(dataset_name: str, language: str) -> Optional[PreprocessingStages]:
+    return PREPROCESSING_STAGES.get(f"{dataset_name}/{language}", PREPROCESSING_STAGES.get(dataset_name))
 
-        if current_line_splitted[-1] == "_|Commented":
-            current_line_splitted[-1] = "Commented"
-            lines[index] = "\t".join(current_line_splitted)
 
-    # Finally, save it!
-    with open(file_out, "wt") as f_out:
-        for line in lines:
-            f_out.write(line + "\n")
+def get_preproc_fn(dataset_name: str, language: str) -> Optional[Callable]:
+    stages = get_preprocessing_stages(dataset_name, language)
 
-    print("Special preprocessing for German/French NewsEye dataset has finished!")
+    if stages is None:
+        # E.g. topres19th needs no special preprocessing
+        return None
 
+    return functools.partial(preprocess_hipe_corpus, stages=stages)